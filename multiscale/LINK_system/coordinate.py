@@ -33,6 +33,7 @@ import warnings
 import multiscale.itk.process as proc
 import multiscale.microscopy.ome as ome
 import multiscale.ultrasound.reconstruction as recon
+import multiscale.ultrasound.conversion as conv
 
 
 def open_us(us_path, pl_path, params_path, spacing, gauge_value, dynamic_range=None):
@@ -47,7 +48,10 @@ def open_us(us_path, pl_path, params_path, spacing, gauge_value, dynamic_range=N
         :return: SimpleITK US image with appropriate origin, direction, and spacing
         """
         # todo: Read in param.start depth to properly set the origin
-        raw_image = sitk.ReadImage(str(us_path))
+        if ome.is_pyramid(us_path):
+                raw_image = sitk.GetImageFromArray(ome.read_pyramid_region(us_path))
+        else:
+                raw_image = sitk.ReadImage(str(us_path))
         return convert_sitk_to_us(raw_image, pl_path, params_path, spacing, gauge_value,
                                       dynamic_range=dynamic_range)
 
@@ -64,7 +68,9 @@ def convert_sitk_to_us(sitk_image, pl_path, params_path, spacing, gauge_value, d
         :return: SimpleITK US image with appropriate origin, direction, and spacing
         """
         if dynamic_range is not None:
-                windowed_image = proc.window_image(sitk_image, dynamic_range)
+                windowed_array = conv.window_dynamic_range(sitk.GetArrayViewFromImage(sitk_image), dynamic_range)
+                windowed_image = sitk.GetImageFromArray(windowed_array)
+                windowed_image.CopyInformation(sitk_image)
         else:
                 windowed_image = sitk_image
 
@@ -193,26 +199,29 @@ def rotate_axes_to_microscope(image):
         return sitk.GetImageFromArray(arr_rot)
 
 
-def get_fiducial_stats(connected_img):
+def get_fiducial_stats(connected_img, num_threads=None):
         """
-        Get statistics for each object in a label image
+        Get statistics for each object in a label image.  Only the pixel counts, centroids, bounding boxes and
+        equivalent ellipsoids used for the fiducials are computed
         :param connected_img: A color image with each object a different color; taken from the connected component filter.
+        :param num_threads: Number of threads ITK uses.  Default is the ITK global default
         :return: Object statistics for each unique object
         """
         stats = sitk.LabelShapeStatisticsImageFilter()
-        stats.ComputeOrientedBoundingBoxOn()
-        stats.ComputePerimeterOn()
-        stats.Execute(connected_img)
+        stats.ComputeFeretDiameterOff()
+        stats.ComputePerimeterOff()
+        _execute(stats, num_threads, connected_img)
         return stats
 
 
-def filter_labels(stats):
+def filter_labels(stats, pixel_scale=1):
         """
         Filter labels by property so you only get the fiducial circles
         :param stats: Object statistics for whole connected component image
+        :param pixel_scale: Number of full resolution pixels each pixel of the labelled image covers
         :return: Labels for the right objects
         """
-        return [l for l in stats.GetLabels() if (stats.GetNumberOfPixels(l) < 300000
+        return [l for l in stats.GetLabels() if (stats.GetNumberOfPixels(l)*pixel_scale < 300000
                                                  and stats.GetEquivalentEllipsoidDiameter(l)[1] > 2000)]
 
 
@@ -239,15 +248,28 @@ def get_ellipsoid_radius(stats, true_labels):
         return rad
 
 
-def calculate_centroid(us_image, radius=False, output_label_img=False):
+def calculate_centroid(us_image, radius=False, output_label_img=False, shrink_factors=None, num_threads=None):
         """
         Get the leveled Z height (i.e., brought down to microscope plane at 0) location of each fiducial
         :param us_image: US image to calculate the fiducials from
         :param radius: Boolean whether or not to add the ellipsoid radius to the leveled centroid
+        :param shrink_factors: X, Y, Z factors to find fiducial candidates at before refining them at full
+        resolution, as in detect_fiducials.  Default segments the whole image at full resolution
+        :param num_threads: Number of threads ITK uses.  Default is the ITK global default
         :return: list of Z heights
         """
-        connected_image = connected_components(us_image)
-        stats = get_fiducial_stats(connected_image)
+        if shrink_factors is not None:
+                fiducials, label_image = detect_fiducials(us_image, shrink_factors, num_threads=num_threads)
+                centroid = get_leveled_centroid(fiducials, fiducials.GetLabels())
+                if radius:
+                        centroid = centroid - get_ellipsoid_radius(fiducials, fiducials.GetLabels())
+                if output_label_img:
+                        return centroid, label_image
+
+                return centroid
+
+        connected_image = connected_components(us_image, num_threads=num_threads)
+        stats = get_fiducial_stats(connected_image, num_threads)
         labels = filter_labels(stats)
         centroid = get_leveled_centroid(stats, labels)
         if radius:
@@ -281,18 +303,143 @@ def apply_filtered_labels(connected_image, orig_labels, sorted_labels):
         return filtered_image
 
 
-def connected_components(us_image):
-        """Process the US image using Otsu thresholding and binary opening/closing to get the connected components"""
+def connected_components(us_image, threshold=None, kernel_radius=(4, 4, 2), num_threads=None):
+        """
+        Process the US image using Otsu thresholding and binary opening/closing to get the connected components
+        :param us_image: US image to segment
+        :param threshold: Intensity above which pixels are foreground.  Default finds it with Otsu's method
+        :param kernel_radius: X, Y, Z radius in pixels of the opening and closing
+        :param num_threads: Number of threads ITK uses.  Default is the ITK global default
+        :return: Connected component image
+        """
+        if threshold is None:
+                thresh_filter = sitk.OtsuThresholdImageFilter()
+                thresh_filter.SetInsideValue(0)
+                thresh_filter.SetOutsideValue(1)
+                thresh_img = _execute(thresh_filter, num_threads, us_image)
+                thresh_value = thresh_filter.GetThreshold()
+                
+                print("Threshold used: {}".format(thresh_value))
+        else:
+                thresh_img = sitk.Cast(us_image > threshold, sitk.sitkUInt8)
+        
+        kernel_radius = [int(radius) for radius in kernel_radius]
+        opening = sitk.BinaryOpeningByReconstructionImageFilter()
+        opening.SetKernelRadius(kernel_radius)
+        cleaned_thresh_img = _execute(opening, num_threads, thresh_img)
+        closing = sitk.BinaryClosingByReconstructionImageFilter()
+        closing.SetKernelRadius(kernel_radius)
+        cleaned_thresh_img = _execute(closing, num_threads, cleaned_thresh_img)
+        
+        connected_img = _execute(sitk.ConnectedComponentImageFilter(), num_threads, cleaned_thresh_img)
+        return connected_img
+
+
+def detect_fiducials(us_image, shrink_factors=(4, 4, 2), margin=2, num_threads=None):
+        """
+        Find the fiducials coarse to fine.  Candidates are segmented and filtered on a block-averaged copy of the image,
+        and each is then segmented again at full resolution within its bounding box, padded by a margin, using the
+        coarse Otsu threshold.
+        
+        Fiducials are labelled in the order ConnectedComponent would label them at full resolution, so the leveling of
+        get_leveled_centroid matches the full resolution result.
+        :param us_image: US image to find the fiducials in
+        :param shrink_factors: X, Y, Z factors to average the image over for the coarse segmentation
+        :param margin: Coarse pixels added to each side of a candidate's bounding box
+        :param num_threads: Number of threads ITK uses.  Default is the ITK global default
+        :return: Statistics of the fiducial label image, and the label image
+        """
+        shrink_factors = [int(factor) for factor in shrink_factors]
+        coarse_image = sitk.BinShrink(us_image, shrink_factors)
+        
         thresh_filter = sitk.OtsuThresholdImageFilter()
-        thresh_filter.SetInsideValue(0)
-        thresh_filter.SetOutsideValue(1)
-        thresh_img = thresh_filter.Execute(us_image)
-        thresh_value = thresh_filter.GetThreshold()
+        _execute(thresh_filter, num_threads, coarse_image)
+        threshold = thresh_filter.GetThreshold()
+        print("Threshold used: {}".format(threshold))
+        
+        coarse_radius = [max(1, int(round(radius / factor))) for radius, factor in zip([4, 4, 2], shrink_factors)]
+        coarse_labels = connected_components(coarse_image, threshold, coarse_radius, num_threads)
+        coarse_stats = get_fiducial_stats(coarse_labels, num_threads)
+        candidates = filter_labels(coarse_stats, pixel_scale=int(np.prod(shrink_factors)))
+        
+        label_array = np.zeros(sitk.GetArrayViewFromImage(us_image).shape, dtype=np.uint32)
+        coarse_array = sitk.GetArrayViewFromImage(coarse_labels)
+        fiducials = {}
+        for candidate in candidates:
+                fiducial = _refine_fiducial(us_image, coarse_array == candidate, coarse_stats.GetBoundingBox(candidate),
+                                            shrink_factors, margin, threshold, num_threads)
+                # Candidates split from one object at the coarse scale find the same object
+                if fiducial is not None:
+                        fiducials[tuple(fiducial[0])] = fiducial
         
-        print("Threshold used: {}".format(thresh_value))
+        # Raster order of the first pixel, as ConnectedComponent labels
+        fiducials = [fiducials[first_pixel] for first_pixel in sorted(fiducials)]
+        for label, (first_pixel, roi_slices, mask) in enumerate(fiducials, 1):
+                label_array[roi_slices][mask] = label
         
-        cleaned_thresh_img = sitk.BinaryOpeningByReconstruction(thresh_img, [4, 4, 2])
-        cleaned_thresh_img = sitk.BinaryClosingByReconstruction(cleaned_thresh_img, [4, 4, 2])
+        label_image = sitk.GetImageFromArray(label_array)
+        label_image.CopyInformation(us_image)
+        return get_fiducial_stats(label_image, num_threads), label_image
+
+
+def _refine_fiducial(us_image, coarse_mask, coarse_box, shrink_factors, margin, threshold, num_threads):
+        """
+        Segment a fiducial candidate at full resolution within its padded coarse bounding box.  The padded box can hold
+        neighbouring fiducials too, so the object kept is the one that overlaps the candidate's coarse mask most.
+        :param coarse_mask: ZYX mask of the candidate in the coarse image
+        :return: ZYX index of its first pixel, the ZYX slices of the region, and its mask within them.  None if no
+        object in the region passes filter_labels and overlaps the candidate
+        """
+        dims = len(shrink_factors)
+        size = us_image.GetSize()
+        start = [max(0, (coarse_box[axis] - margin)*shrink_factors[axis]) for axis in range(dims)]
+        stop = [min(size[axis], (coarse_box[axis] + coarse_box[axis + dims] + margin)*shrink_factors[axis])
+                for axis in range(dims)]
+        
+        roi = sitk.RegionOfInterest(us_image, [b - a for a, b in zip(start, stop)], start)
+        roi_labels = connected_components(roi, threshold, num_threads=num_threads)
+        roi_stats = get_fiducial_stats(roi_labels, num_threads)
+        labels = filter_labels(roi_stats)
+        if not labels:
+                return None
+        
+        roi_slices = tuple(slice(a, b) for a, b in zip(reversed(start), reversed(stop)))
+        roi_array = sitk.GetArrayViewFromImage(roi_labels)
+        candidate_mask = _upsample_mask(coarse_mask, list(reversed(shrink_factors)), roi_slices)
+        overlap = np.bincount(roi_array[candidate_mask], minlength=max(labels) + 1)
+        label = max(labels, key=lambda label: overlap[label])
+        if overlap[label] == 0:
+                return None
+        
+        mask = roi_array == label
+        first_pixel = np.argwhere(mask)[0] + np.array(list(reversed(start)))
+        return first_pixel, roi_slices, mask
+
+
+def _upsample_mask(coarse_mask, factors, slices):
+        """
+        Get the full resolution region of a mask from BinShrink, by repeating each coarse pixel over its block
+        :param coarse_mask: Coarse mask
+        :param factors: Shrink factor along each axis, in the order of the mask's axes
+        :param slices: Full resolution region to return.  Pixels past the last whole block are False
+        :return: Boolean mask of the region
+        """
+        coarse_slices = tuple(slice(region.start // factor, -(-region.stop // factor))
+                              for region, factor in zip(slices, factors))
+        mask = coarse_mask[coarse_slices]
+        for axis, factor in enumerate(factors):
+                mask = np.repeat(mask, factor, axis=axis)
+        
+        offsets = [region.start - coarse.start*factor for region, coarse, factor in zip(slices, coarse_slices, factors)]
+        region_mask = np.zeros([region.stop - region.start for region in slices], dtype=bool)
+        upsampled = mask[tuple(slice(offset, offset + size) for offset, size in zip(offsets, region_mask.shape))]
+        region_mask[tuple(slice(0, size) for size in upsampled.shape)] = upsampled
+        return region_mask
+
+
+def _execute(image_filter, num_threads, *images):
+        """Run a SimpleITK filter, with the given number of threads if set"""
+        if num_threads is not None:
+                image_filter.SetNumberOfThreads(int(num_threads))
         
-        connected_img = sitk.ConnectedComponent(cleaned_thresh_img)
-        return connected_img
\ No newline at end of file
+        return image_filter.Execute(*images)
\ No newline at end of file
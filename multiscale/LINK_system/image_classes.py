@@ -2,7 +2,7 @@ import numpy as np
 import multiscale.utility_functions as util
 import tiffile as tif
 from pathlib import Path
-import multiscale.ultrasound.reconstruction as recon
+import multiscale.ultrasound.conversion as conv
 
 
 def convert_oct_to_tif(mat_path: Path, output_folder, resolution, overwrite=False):
@@ -21,10 +21,11 @@ def convert_oct_to_tif(mat_path: Path, output_folder, resolution, overwrite=Fals
                 print('File already exists.  Skipping writing.')
                 return
         
-        oct_array = util.load_mat(mat_path, 'ropd_vol')
-        bmode_array = recon.iq_to_db(oct_array)
+        # load_mat returns v7.3 variables in MATLAB axis order, [x, z, y] for ropd_vol
+        oct_array = util.load_mat(mat_path, 'ropd_vol')['ropd_vol']
+        bmode_array = conv.decibels(oct_array)
         
-        zyx_array = np.transpose(bmode_array, (2, 0, 1))
+        zyx_array = np.transpose(bmode_array, (1, 2, 0))
         
         
         ijstyle = zyx_array.astype(np.float32)
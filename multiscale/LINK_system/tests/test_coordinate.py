@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+import SimpleITK as sitk
+
+import multiscale.LINK_system.coordinate as coord
+
+
+@pytest.fixture()
+def fiducial_image():
+        shape = (60, 120, 120)
+        z, y, x = np.indices(shape)
+        array = np.random.rand(*shape).astype(np.float32)*0.2
+        for center in [(20, 30, 30), (35, 30, 85), (25, 90, 40), (40, 85, 90)]:
+                array[(z - center[0])**2 + (y - center[1])**2 + (x - center[2])**2 < 13**2] += 1
+
+        # A large object that is not a fiducial
+        array[50:] += 1
+
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing([100, 100, 100])
+        return image
+
+
+class TestCalculateCentroid(object):
+        def test_full_resolution_finds_fiducials(self, fiducial_image):
+                centroid = coord.calculate_centroid(fiducial_image)
+                assert len(centroid) == 4
+
+        @pytest.mark.parametrize('radius', [False, True])
+        def test_coarse_to_fine_matches_full_resolution(self, fiducial_image, radius):
+                expected, expected_labels = coord.calculate_centroid(fiducial_image, radius=radius,
+                                                                     output_label_img=True)
+                centroid, labels = coord.calculate_centroid(fiducial_image, radius=radius, output_label_img=True,
+                                                            shrink_factors=(4, 4, 2), num_threads=2)
+
+                assert np.allclose(centroid, expected)
+                assert np.array_equal(sitk.GetArrayFromImage(labels), sitk.GetArrayFromImage(expected_labels))
+
+
+class TestDetectFiducials(object):
+        def test_adjacent_fiducials_of_different_sizes(self):
+                shape = (64, 64, 120)
+                z, y, x = np.indices(shape)
+                array = np.random.rand(*shape).astype(np.float32)*0.2
+                # The padded box of the small fiducial holds a larger cap of the big one than the small one itself
+                for center, radius in [((32, 32, 40), 24), ((32, 32, 78), 12)]:
+                        array[(z - center[0])**2 + (y - center[1])**2 + (x - center[2])**2 < radius**2] += 1
+                image = sitk.GetImageFromArray(array)
+                image.SetSpacing([100, 100, 100])
+                
+                connected_image = coord.connected_components(image)
+                stats = coord.get_fiducial_stats(connected_image)
+                expected = coord.apply_filtered_labels(connected_image, stats.GetLabels(), coord.filter_labels(stats))
+                fiducials, labels = coord.detect_fiducials(image, margin=4)
+                
+                assert fiducials.GetLabels() == (1, 2)
+                assert np.array_equal(sitk.GetArrayFromImage(labels), sitk.GetArrayFromImage(expected))
@@ -0,0 +1,27 @@
+import numpy as np
+import h5py
+import tiffile as tif
+
+import multiscale.LINK_system.image_classes as ic
+import multiscale.ultrasound.conversion as conv
+
+
+def test_oct_tif_is_in_matlab_axis_order(tmp_path):
+        """A v7.3 ropd_vol of MATLAB size [x, z, y] is written as a z, y, x stack, as before load_mat read v7.3
+        variables lazily"""
+        ropd_vol = np.random.rand(5, 6, 7) + 1j*np.random.rand(5, 6, 7)
+        stored = np.empty(ropd_vol.T.shape, dtype=[('real', np.float64), ('imag', np.float64)])
+        stored['real'] = ropd_vol.T.real
+        stored['imag'] = ropd_vol.T.imag
+        
+        mat_path = tmp_path / 'oct.mat'
+        with h5py.File(str(mat_path), 'w') as file:
+                file['ropd_vol'] = stored
+        
+        ic.convert_oct_to_tif(mat_path, tmp_path, np.array([1, 1, 2]))
+        output = tif.imread(str(tmp_path / 'oct.tif'))
+        
+        # The orientation load_mat gave through read_hdf_matlab, transposed as convert_oct_to_tif used to
+        baseline_array = np.transpose(np.swapaxes(ropd_vol.T, -1, -2), (2, 0, 1))
+        assert output.shape == (6, 7, 5)
+        assert np.allclose(output, conv.decibels(baseline_array))
@@ -28,32 +28,302 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."""
 import h5py
 from pathlib import Path
 import re
+import zlib
+import itertools
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 
 class BigViewerDatasetWriter(object):
-        def __init__(self, dataset_name=None, output_dir=None):
+        def __init__(self, dataset_name=None, output_dir=None, subsampling_factors='[{ {1,1,1}, {2,2,2}, {4,4,4} }]',
+                     hdf5_chunk_sizes='[{ {16,16,16}, {16,16,16}, {16,16,16} }]', compression_level=4,
+                     num_workers=1):
+                """
+                Write numpy images directly into a BigDataViewer HDF5/XML dataset, so BigStitcher can open them without
+                the Define dataset step.
+                :param dataset_name: Name of the dataset.  The data is saved as <name>.h5 and the project as <name>.xml
+                :param output_dir: Directory to save the dataset in
+                :param subsampling_factors: XYZ factor of each resolution level, in BigStitcher's argument format
+                :param hdf5_chunk_sizes: XYZ chunk size of each resolution level, in BigStitcher's argument format
+                :param compression_level: Deflate level of the HDF5 chunks
+                :param num_workers: Number of threads compressing chunks in parallel
+                """
                 self.datset_name = dataset_name
                 self.output_dir = output_dir
+                self.subsampling_factors = parse_bdv_factors(subsampling_factors)
+                self.chunk_sizes = parse_bdv_factors(hdf5_chunk_sizes)
+                self.compression_level = compression_level
+                self.num_workers = num_workers
+                
+                if len(self.subsampling_factors) != len(self.chunk_sizes):
+                        raise ValueError('There must be one chunk size for each subsampling factor')
+                if np.any(self.subsampling_factors[1:] % self.subsampling_factors[:-1]):
+                        raise ValueError('Each subsampling factor must be a multiple of the one before it, as each '
+                                         'level is downsampled from the previous level')
 
         def set_dataset_name(self, dataset_name):
                 self.datset_name = dataset_name
 
         def set_output_dir(self, output_dir):
                 self.output_dir = output_dir
+        
+        def get_hdf5_path(self) -> Path:
+                return Path(self.output_dir, self.datset_name + '.h5')
+        
+        def get_xml_path(self) -> Path:
+                return Path(self.output_dir, self.datset_name + '.xml')
+        
+        def write_dataset(self, images, positions, spacing, unit='\u03bcm', display_range=None):
+                """
+                Write a set of 3D tiles and the dataset.xml describing their positions
+                :param images: Sequence of [Z, Y, X] uint16 numpy images, one per tile.  Other types can be converted
+                with convert_to_uint16
+                :param positions: XYZ position of each tile, in units
+                :param spacing: XYZ voxel size of the images
+                :param unit: Unit of the positions and spacing
+                :param display_range: Original [min, max] values mapped to 0 and 65535, as from convert_to_uint16.
+                Recorded as the 'display_range' attribute of each setup
+                :return:
+                """
+                self._create_new_dataset()
+                position_list_with_metadata = []
+                for setup, image in enumerate(images):
+                        self._append_to_dataset(image, setup, display_range)
+                        shape = np.shape(image)
+                        position_list_with_metadata.append({'position': positions[setup], 'id': str(setup),
+                                                            'size': [shape[2], shape[1], shape[0]],
+                                                            'unit': unit, 'spacing': spacing})
+                
+                write_dataset_xml(position_list_with_metadata, self.output_dir, self.get_xml_path().name,
+                                  hdf5_name=self.get_hdf5_path().name)
 
         def _create_new_dataset(self):
-                return
+                """Start an empty HDF5 file, replacing any existing dataset of the same name"""
+                Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+                with h5py.File(str(self.get_hdf5_path()), 'w'):
+                        pass
+
+        def _append_to_dataset(self, image, setup, display_range=None):
+                """
+                Write the resolution pyramid of one tile as a new setup of the HDF5 file
+                :param image: [Z, Y, X] uint16 numpy image
+                :param setup: Index of the setup
+                :param display_range: Original [min, max] values of the image, recorded with the setup
+                :return:
+                """
+                image = np.asarray(image)
+                if image.dtype != np.uint16:
+                        raise TypeError('BigDataViewer HDF5 datasets hold 16 bit unsigned data, not {}.  Please '
+                                        'convert the images with convert_to_uint16'.format(image.dtype))
+                
+                with h5py.File(str(self.get_hdf5_path()), 'a') as file:
+                        setup_name = 's{:02d}'.format(setup)
+                        file.create_dataset(setup_name + '/resolutions', data=self.subsampling_factors.astype(np.float64))
+                        file.create_dataset(setup_name + '/subdivisions', data=self.chunk_sizes.astype(np.int32))
+                        if display_range is not None:
+                                file[setup_name].attrs['display_range'] = np.array(display_range, dtype=np.float64)
+                        
+                        level_image = image
+                        previous_factors = np.ones(3, dtype=int)
+                        for level, factors in enumerate(self.subsampling_factors):
+                                level_image = downsample_image(level_image, (factors // previous_factors)[::-1])
+                                previous_factors = factors
+                                
+                                # BigDataViewer stores unsigned 16 bit data as int16.  Only the written levels are
+                                # viewed as signed, so the pyramid averages the unsigned values
+                                path = 't00000/{}/{}/cells'.format(setup_name, level)
+                                self._write_chunked(file, path, level_image.view(np.int16),
+                                                    self.chunk_sizes[level][::-1])
+        
+        def _write_chunked(self, file, path, image, chunks):
+                """Deflate each chunk of the image in a thread pool and write it directly into the HDF5 file"""
+                chunks = tuple(int(min(size, chunk)) for size, chunk in zip(image.shape, chunks))
+                dataset = file.create_dataset(path, shape=image.shape, dtype=image.dtype, chunks=chunks,
+                                              compression='gzip', compression_opts=self.compression_level)
+                
+                starts = list(itertools.product(*[range(0, size, chunk) for size, chunk in zip(image.shape, chunks)]))
+                
+                def compress_chunk(start):
+                        block = np.zeros(chunks, dtype=image.dtype)
+                        region = tuple(slice(begin, begin + chunk) for begin, chunk in zip(start, chunks))
+                        data = image[region]
+                        block[tuple(slice(0, size) for size in data.shape)] = data
+                        return zlib.compress(block.tobytes(), self.compression_level)
+                
+                if self.num_workers > 1:
+                        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                                compressed = executor.map(compress_chunk, starts)
+                                for start, data in zip(starts, compressed):
+                                        dataset.id.write_direct_chunk(start, data)
+                else:
+                        for start in starts:
+                                dataset.id.write_direct_chunk(start, compress_chunk(start))
+
+
+def parse_bdv_factors(factors) -> np.ndarray:
+        """
+        Read a BigStitcher resolution argument such as '[{ {1,1,1}, {2,2,2} }]' into an array of XYZ rows
+        """
+        if not isinstance(factors, str):
+                return np.array(factors, dtype=int).reshape([-1, 3])
+        
+        triplets = re.findall(r'\{\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\}', factors)
+        if len(triplets) == 0:
+                raise ValueError('No XYZ factors found in {}'.format(factors))
+        
+        return np.array(triplets, dtype=int)
+
+
+def convert_to_uint16(images, display_range=None) -> (list, list):
+        """
+        Rescale images to uint16 for a BigDataViewer dataset, as the 16 bit conversion of Define dataset does
+        :param images: Sequence of numpy images, e.g. the tiles of a dataset
+        :param display_range: [min, max] values mapped to 0 and 65535.  Default is the range of all images, so every
+        tile is scaled the same way.  Values outside it are clipped
+        :return: List of uint16 images, and the [min, max] display range used
+        """
+        if display_range is None:
+                display_range = [float(min(np.min(image) for image in images)),
+                                 float(max(np.max(image) for image in images))]
+        
+        minimum, maximum = display_range
+        scale = 65535 / (maximum - minimum) if maximum > minimum else 0
+        converted = []
+        for image in images:
+                scaled = (np.asarray(image, dtype=np.float64) - minimum) * scale
+                converted.append(np.clip(np.rint(scaled), 0, 65535).astype(np.uint16))
+        
+        return converted, list(display_range)
+
+
+def downsample_image(image: np.ndarray, factors) -> np.ndarray:
+        """
+        Average the image over blocks of the given ZYX size.  Partial blocks at the end of an axis are dropped, unless
+        the axis is smaller than its factor.
+        """
+        factors = [int(min(factor, size)) for factor, size in zip(factors, image.shape)]
+        if all(factor == 1 for factor in factors):
+                return image
+        
+        new_shape = [size // factor for size, factor in zip(image.shape, factors)]
+        cropped = image[tuple(slice(0, size * factor) for size, factor in zip(new_shape, factors))]
+        blocks = cropped.reshape([new_shape[0], factors[0], new_shape[1], factors[1], new_shape[2], factors[2]])
+        mean = blocks.mean(axis=(1, 3, 5))
+        
+        if np.issubdtype(image.dtype, np.integer):
+                mean = np.rint(mean)
+        return mean.astype(image.dtype)
 
-        def _append_to_dataset(self):
-                return
 
 def calculate_affine_transform(spacing):
-        return
+        """
+        Get the BigDataViewer calibration transform for an XYZ voxel size, scaled so the smallest voxel side is 1
+        :param spacing: XYZ voxel size
+        :return: Row-major 3x4 affine, flattened
+        """
+        scale = np.array(spacing, dtype=float) / np.min(spacing)
+        affine = np.zeros([3, 4])
+        affine[[0, 1, 2], [0, 1, 2]] = scale
+        return list(affine.flatten())
+
+
+def calculate_translation_transform(position, spacing):
+        """Get the affine translating a tile to its XYZ position, in the calibrated pixel units of the dataset"""
+        affine = np.zeros([3, 4])
+        affine[[0, 1, 2], [0, 1, 2]] = 1
+        affine[:, 3] = np.array(position, dtype=float) / np.min(spacing)
+        return list(affine.flatten())
+
+
+def write_dataset_xml(position_list_with_metadata, output_dir, output_name, hdf5_name=None):
+        """
+        Write the BigDataViewer XML for a set of tiles stored in an HDF5 dataset
+        :param position_list_with_metadata: List of dictionaries with the 'position', 'id', 'size', 'unit', and
+        'spacing' of each tile, in XYZ order
+        :param output_dir: Directory to save the XML in
+        :param output_name: Name of the XML file
+        :param hdf5_name: Name of the HDF5 file, relative to the XML.  Defaults to the XML name with a .h5 suffix
+        :return: Path of the XML file
+        """
+        if hdf5_name is None:
+                hdf5_name = Path(output_name).stem + '.h5'
+        
+        root = ET.Element('SpimData', version='0.2')
+        ET.SubElement(root, 'BasePath', type='relative').text = '.'
+        sequence = ET.SubElement(root, 'SequenceDescription')
+        loader = ET.SubElement(sequence, 'ImageLoader', format='bdv.hdf5')
+        ET.SubElement(loader, 'hdf5', type='relative').text = hdf5_name
+        setups = ET.SubElement(sequence, 'ViewSetups')
+        for name in ['illumination', 'channel', 'tile', 'angle']:
+                attribute = ET.SubElement(setups, 'Attributes', name=name)
+                if name != 'tile':
+                        _add_id_name(ET.SubElement(attribute, name.capitalize()), 0, '0')
+        timepoints = ET.SubElement(sequence, 'Timepoints', type='range')
+        ET.SubElement(timepoints, 'first').text = '0'
+        ET.SubElement(timepoints, 'last').text = '0'
+        ET.SubElement(root, 'ViewRegistrations')
+        
+        xml_path = Path(output_dir, output_name)
+        _write_xml(root, xml_path)
+        for position_with_metadata in position_list_with_metadata:
+                append_new_setup_to_dataset_xml(xml_path, position_with_metadata)
+        
+        return xml_path
+
+
+def append_new_setup_to_dataset_xml(xml_path, position_with_metadata):
+        """
+        Add a tile to an existing BigDataViewer XML, as the next setup
+        :param xml_path: Path to the XML file
+        :param position_with_metadata: Dictionary with the 'position', 'id', 'size', 'unit', and 'spacing' of the tile
+        :return:
+        """
+        root = ET.parse(str(xml_path)).getroot()
+        setups = root.find('SequenceDescription/ViewSetups')
+        setup_id = len(setups.findall('ViewSetup'))
+        
+        setup = ET.Element('ViewSetup')
+        _add_id_name(setup, setup_id, position_with_metadata['id'])
+        ET.SubElement(setup, 'size').text = _join(position_with_metadata['size'])
+        voxel_size = ET.SubElement(setup, 'voxelSize')
+        ET.SubElement(voxel_size, 'unit').text = position_with_metadata['unit']
+        ET.SubElement(voxel_size, 'size').text = _join(position_with_metadata['spacing'])
+        attributes = ET.SubElement(setup, 'attributes')
+        for name in ['illumination', 'channel', 'tile', 'angle']:
+                ET.SubElement(attributes, name).text = str(setup_id) if name == 'tile' else '0'
+        setups.insert(setup_id, setup)
+        
+        tile = ET.SubElement(setups.find("Attributes[@name='tile']"), 'Tile')
+        _add_id_name(tile, setup_id, position_with_metadata['id'])
+        ET.SubElement(tile, 'location').text = _join(position_with_metadata['position'])
+        
+        registration = ET.SubElement(root.find('ViewRegistrations'), 'ViewRegistration',
+                                     timepoint='0', setup=str(setup_id))
+        transforms = [('Translation to Regular Grid',
+                       calculate_translation_transform(position_with_metadata['position'],
+                                                       position_with_metadata['spacing'])),
+                      ('calibration', calculate_affine_transform(position_with_metadata['spacing']))]
+        for name, affine in transforms:
+                transform = ET.SubElement(registration, 'ViewTransform', type='affine')
+                ET.SubElement(transform, 'Name').text = name
+                ET.SubElement(transform, 'affine').text = _join(affine)
+        
+        _write_xml(root, xml_path)
+
+
+def _add_id_name(element, element_id, name):
+        ET.SubElement(element, 'id').text = str(element_id)
+        ET.SubElement(element, 'name').text = str(name)
 
-def write_dataset_xml(position_list_with_metadata, output_dir, output_name):
-        return
 
+def _join(values):
+        return ' '.join(str(value) for value in values)
 
-def append_new_setup_to_dataset_xml():
-        return
 
+def _write_xml(root, xml_path):
+        tree = ET.ElementTree(root)
+        if hasattr(ET, 'indent'):
+                ET.indent(tree)
+        tree.write(str(xml_path), encoding='utf-8', xml_declaration=True)
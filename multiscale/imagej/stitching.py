@@ -32,8 +32,10 @@ from pathlib import Path
 import tempfile
 import tiffile as tif
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import multiscale.utility_functions as util
+import multiscale.imagej.bigdata as bd
 
 
 class BigStitcher(object):
@@ -50,7 +52,8 @@ class BigStitcher(object):
                 self._fuse_dataset(fuse_args, output_name)
 
         def stitch_from_numpy(self, images_np: np.ndarray, dataset_args: dict, fuse_args: dict,
-                              intermediate_save_dir=None, output_name='fused_tp_0_ch_0.tif', overwrite_dataset=True):
+                              intermediate_save_dir=None, output_name='fused_tp_0_ch_0.tif', overwrite_dataset=True,
+                              native_dataset=False):
                 """
                 Stitch images from a 4d numpy array
                 :param images_np: The array of numpy images
@@ -59,6 +62,8 @@ class BigStitcher(object):
                 :param intermediate_save_dir: Where to save the intermediate .tif files
                 :param output_name: Name of resulting saved image
                 :param overwrite_dataset: Whether to overwrite the tif/dataset or not.
+                :param native_dataset: Write the BigDataViewer HDF5/XML dataset directly from the array, instead of
+                saving tifs and defining the dataset in ImageJ
                 :return:
                 """
                 # todo: Have it save the set/save spacing correctly as well
@@ -70,10 +75,10 @@ class BigStitcher(object):
                                 dataset_args['export_path'] = str(temp_dir) + '/dataset'
                                 fuse_args['select'] = xml_path
                                 self._dataset_from_numpy(images_np, dataset_args, fuse_args, temp_dir, output_name,
-                                                         overwrite_dataset)
+                                                         overwrite_dataset, native_dataset)
                 else:
                         self._dataset_from_numpy(images_np, dataset_args, fuse_args, intermediate_save_dir, output_name,
-                                                 overwrite_dataset)
+                                                 overwrite_dataset, native_dataset)
                         
         def _rename_output(self, fuse_args, output_name='fused_tp_0_ch_0.tif'):
                 if fuse_args['fused_image'] == '[Display using ImageJ]':
@@ -93,9 +98,14 @@ class BigStitcher(object):
                                 raise FileNotFoundError("{} not found".format(original_path))
         
         def _dataset_from_numpy(self, images_np, dataset_args, fuse_args, intermediate_save_dir, output_name,
-                                overwrite_dataset=True):
+                                overwrite_dataset=True, native_dataset=False):
                 """Helper for stitch from numpy"""
                 dataset_args['path'] = intermediate_save_dir
+                if native_dataset:
+                        self._write_native_dataset(images_np, dataset_args, overwrite_dataset)
+                        self._fuse_dataset(fuse_args, output_name)
+                        return
+                
                 self._save_numpy_images(intermediate_save_dir, images_np, dataset_args, overwrite_dataset)
                 self.stitch_from_files(dataset_args, fuse_args, output_name, overwrite_dataset)
 
@@ -128,6 +138,36 @@ class BigStitcher(object):
                                     resolution=(1. / dataset_args['voxel_size_x'], 1. / dataset_args['voxel_size_y']),
                                     metadata={'spacing': dataset_args['voxel_size_z'], 'unit': 'um'})
 
+        def _write_native_dataset(self, numpy_images: np.ndarray, dataset_args, overwrite_dataset=True):
+                """
+                Write the images into a BigDataViewer dataset on the grid described by the define dataset arguments.
+                Images that are not uint16 are rescaled to uint16 over their combined range, which is recorded in the
+                HDF5 file.
+                :param numpy_images: Array of 2D or 3D images, one per tile
+                :param dataset_args: Arguments for the dataset, as for the Define dataset plugin
+                :param overwrite_dataset: Whether to overwrite an existing dataset
+                :return:
+                """
+                args = self._populate_dataset_args(dataset_args)
+                writer = bd.BigViewerDatasetWriter(Path(args['project_filename']).stem, args['dataset_save_path'],
+                                                   subsampling_factors=args['subsampling_factors'],
+                                                   hdf5_chunk_sizes=args['hdf5_chunk_sizes'])
+                if writer.get_xml_path().is_file() and not overwrite_dataset:
+                        print('{} already exists, skipping save dataset.'.format(writer.get_xml_path()))
+                        return
+                
+                images = [np.asarray(image) for image in numpy_images]
+                images = [image[np.newaxis] if image.ndim == 2 else image for image in images]
+                display_range = None
+                if any(image.dtype != np.uint16 for image in images):
+                        images, display_range = bd.convert_to_uint16(images)
+                spacing = [float(args['voxel_size_x']), float(args['voxel_size_y']), float(args['voxel_size_z'])]
+                positions = grid_positions(np.shape(images[0]), len(images), args, spacing)
+                
+                print('Writing dataset to {}'.format(writer.get_hdf5_path()))
+                writer.write_dataset(images, positions, spacing, unit=args['voxel_size_unit'],
+                                     display_range=display_range)
+
         def _define_dataset(self, dataset_args, overwrite_dataset=True):
                 """
                 Use the BigStitcher Define dataset macro to make an HDF5 dataset for the given files
@@ -227,3 +267,127 @@ class BigStitcher(object):
                         
                 return args
 
+
+def grid_positions(shape, num_tiles: int, dataset_args: dict, spacing: list) -> list:
+        """
+        Get the XYZ position of each tile on the Right & Down grid of the define dataset arguments
+        :param shape: ZYX shape of each tile
+        :param num_tiles: Number of tiles
+        :param dataset_args: Arguments holding tiles_x and the overlap_x_(%) and overlap_y_(%) of the grid
+        :param spacing: XYZ voxel size
+        :return: List of XYZ positions, in the units of spacing
+        """
+        tiles_x = int(dataset_args['tiles_x'])
+        step_x = shape[2] * (1 - float(dataset_args['overlap_x_(%)']) / 100) * spacing[0]
+        step_y = shape[1] * (1 - float(dataset_args['overlap_y_(%)']) / 100) * spacing[1]
+        return [[(idx % tiles_x) * step_x, (idx // tiles_x) * step_y, 0] for idx in range(num_tiles)]
+
+
+def fuse_tiles_to_tif(tiles: np.ndarray, overlap_percent, output_path: Path, spacing: list, num_workers: int=1,
+                      slices_per_chunk: int=8):
+        """
+        Fuse tiles laid out along X into a float32 ImageJ tif, without the BigStitcher dataset round trip.
+        
+        The tif is memory-mapped and filled a chunk of slices at a time, so the fused image does not need to fit in
+        memory.  It is written under a temporary name and only moved to output_path once complete.
+        :param tiles: Array of [tile, Z, Y, X] images, ordered along X
+        :param overlap_percent: Percent overlap in X between neighbouring tiles, as given to BigStitcher
+        :param output_path: Path of the fused tif
+        :param spacing: X, Y, and Z spacing of the image in microns
+        :param num_workers: Number of threads fusing chunks in parallel
+        :param slices_per_chunk: Number of Z slices fused by each task
+        :return:
+        """
+        num_slices, size_y = np.shape(tiles)[1:3]
+        size_x = fused_width(np.shape(tiles)[-1], len(tiles), overlap_percent)
+        print('Fusing {} tiles into {}'.format(len(tiles), output_path))
+        
+        with util.atomic_write(output_path) as temp_path:
+                ijstyle = tif.memmap(str(temp_path), shape=(1, num_slices, 1, size_y, size_x, 1), dtype=np.float32,
+                                     imagej=True, resolution=(1. / spacing[0], 1. / spacing[1]),
+                                     metadata={'spacing': spacing[2], 'unit': 'um'})
+                fuse_tiles_along_x(tiles, overlap_percent, ijstyle.reshape([num_slices, size_y, size_x]),
+                                   num_workers=num_workers, slices_per_chunk=slices_per_chunk)
+                ijstyle.flush()
+                del ijstyle
+
+
+def fuse_tiles_along_x(tiles: np.ndarray, overlap_percent, output: np.ndarray=None, num_workers: int=1,
+                       slices_per_chunk: int=8) -> np.ndarray:
+        """
+        Place tiles on a regular grid along X and blend their overlaps with linear feathering.
+        
+        Tile offsets are those of BigStitcher's Move Tile to Grid, rounded to the nearest pixel, and each overlap is
+        a linear ramp from one tile to the next.  Pixels no tile covers are 0.
+        :param tiles: Array of [tile, Z, Y, X] images, ordered along X
+        :param overlap_percent: Percent overlap in X between neighbouring tiles
+        :param output: Array of [Z, Y, X] to write the fused image into, e.g. a memory map.  Default allocates one
+        :param num_workers: Number of threads fusing chunks in parallel
+        :param slices_per_chunk: Number of Z slices fused by each task
+        :return: The fused image
+        """
+        width = np.shape(tiles)[-1]
+        offsets = tile_offsets(width, len(tiles), overlap_percent)
+        weights = normalized_feather_weights(width, offsets)
+        
+        num_slices, size_y = np.shape(tiles)[1:3]
+        if output is None:
+                output = np.zeros([num_slices, size_y, fused_width(width, len(tiles), overlap_percent)],
+                                  dtype=np.float32)
+        
+        def fuse_chunk(start):
+                stop = min(start + slices_per_chunk, num_slices)
+                chunk = np.zeros((stop - start,) + np.shape(output)[1:], dtype=np.float32)
+                for tile, offset, weight in zip(tiles, offsets, weights):
+                        chunk[..., offset:offset + width] += tile[start:stop] * weight
+                output[start:stop] = chunk
+        
+        starts = range(0, num_slices, slices_per_chunk)
+        if num_workers > 1:
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                        list(executor.map(fuse_chunk, starts))
+        else:
+                for start in starts:
+                        fuse_chunk(start)
+        
+        return output
+
+
+def tile_offsets(width: int, num_tiles: int, overlap_percent) -> np.ndarray:
+        """Get the X pixel offset of each tile on a regular grid with the given percent overlap"""
+        step = width * (1 - float(overlap_percent) / 100)
+        return np.round(np.arange(num_tiles) * step).astype(int)
+
+
+def fused_width(width: int, num_tiles: int, overlap_percent) -> int:
+        """Get the X size of the fused image"""
+        return int(tile_offsets(width, num_tiles, overlap_percent)[-1] + width)
+
+
+def normalized_feather_weights(width: int, offsets: np.ndarray) -> np.ndarray:
+        """
+        Get the blending weight of each tile column, so that the weights of every fused column sum to 1
+        :param width: X size of each tile
+        :param offsets: X offset of each tile
+        :return: Array of [tile, X] weights
+        """
+        columns = np.arange(width) + 0.5
+        weights = np.ones([len(offsets), width], dtype=np.float32)
+        for idx in range(len(offsets)):
+                if idx > 0:
+                        overlap_left = offsets[idx - 1] + width - offsets[idx]
+                        if overlap_left > 0:
+                                weights[idx] = np.minimum(weights[idx], columns / overlap_left)
+                if idx < len(offsets) - 1:
+                        overlap_right = offsets[idx] + width - offsets[idx + 1]
+                        if overlap_right > 0:
+                                weights[idx] = np.minimum(weights[idx], (width - columns) / overlap_right)
+        
+        total = np.zeros(offsets[-1] + width, dtype=np.float32)
+        for offset, weight in zip(offsets, weights):
+                total[offset:offset + width] += weight
+        
+        for idx, offset in enumerate(offsets):
+                weights[idx] = weights[idx] / total[offset:offset + width]
+        
+        return weights
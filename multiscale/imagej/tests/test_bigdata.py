@@ -1,6 +1,10 @@
 import pytest
-import numpy
+import numpy as np
 import multiscale.imagej.bigdata as bd
+import multiscale.imagej.stitching as stitch
+import xml.etree.ElementTree as ET
+import h5py
+from pathlib import Path
 import argparse
 import sys
 import imagej
@@ -16,5 +20,93 @@ class TestWriteDatasetXML(object):
                 output_dir = tmpdir.mkdir('bigdata')
                 output_name = 'test.xml'
                 
-                assert True
-                
\ No newline at end of file
+                xml_path = bd.write_dataset_xml(position_list_with_metadata, output_dir, output_name)
+                root = ET.parse(str(xml_path)).getroot()
+                
+                assert root.find('SequenceDescription/ImageLoader/hdf5').text == 'test.h5'
+                assert len(root.findall('SequenceDescription/ViewSetups/ViewSetup')) == 2
+                registrations = root.findall('ViewRegistrations/ViewRegistration')
+                assert [reg.get('setup') for reg in registrations] == ['0', '1']
+                translation = registrations[1].find('ViewTransform/affine').text.split()
+                assert [float(value) for value in translation] == [1, 0, 0, 5, 0, 1, 0, 0, 0, 0, 1, 0]
+        
+        def test_calibration_scales_to_smallest_voxel(self):
+                affine = bd.calculate_affine_transform([2, 2, 5])
+                assert affine == [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 2.5, 0]
+
+
+class TestBigViewerDatasetWriter(object):
+        @pytest.fixture()
+        def images(self):
+                return [np.random.randint(0, 65536, size=(9, 20, 33), dtype=np.uint16) for _ in range(2)]
+        
+        @pytest.mark.parametrize('num_workers', [1, 3])
+        def test_pyramid_levels(self, tmpdir, images, num_workers):
+                writer = bd.BigViewerDatasetWriter('dataset', str(tmpdir),
+                                                   hdf5_chunk_sizes='[{ {8,8,4}, {8,8,4}, {4,4,4} }]',
+                                                   num_workers=num_workers)
+                writer.write_dataset(images, [[0, 0, 0], [30, 0, 0]], [1, 1, 2])
+                
+                with h5py.File(str(writer.get_hdf5_path()), 'r') as file:
+                        assert (file['s01/resolutions'][()] == [[1, 1, 1], [2, 2, 2], [4, 4, 4]]).all()
+                        assert (file['s01/subdivisions'][()] == [[8, 8, 4], [8, 8, 4], [4, 4, 4]]).all()
+                        assert (file['t00000/s01/0/cells'][()].view(np.uint16) == images[1]).all()
+                        assert file['t00000/s01/0/cells'].chunks == (4, 8, 8)
+                        assert file['t00000/s00/1/cells'].shape == (4, 10, 16)
+                        expected = images[0][:8, :, :32].reshape([4, 2, 10, 2, 16, 2]).mean(axis=(1, 3, 5))
+                        assert (file['t00000/s00/1/cells'][()].view(np.uint16) == np.rint(expected)).all()
+                        assert file['t00000/s00/2/cells'].shape == (2, 5, 8)
+                
+                assert writer.get_xml_path().is_file()
+        
+        def test_uint16_is_stored_as_int16(self, tmpdir):
+                image = np.full([4, 4, 4], 100, dtype=np.uint16)
+                image[::2] = 60000
+                writer = bd.BigViewerDatasetWriter('dataset', str(tmpdir), subsampling_factors='[{ {1,1,1}, {2,2,2} }]',
+                                                   hdf5_chunk_sizes='[{ {16,16,16}, {16,16,16} }]')
+                writer.write_dataset([image], [[0, 0, 0]], [1, 1, 1])
+                with h5py.File(str(writer.get_hdf5_path()), 'r') as file:
+                        assert file['t00000/s00/0/cells'].dtype == np.int16
+                        assert (file['t00000/s00/0/cells'][()].view(np.uint16) == image).all()
+                        assert (file['t00000/s00/1/cells'][()].view(np.uint16) == 30050).all()
+        
+        def test_other_types_raise_error(self, tmpdir):
+                writer = bd.BigViewerDatasetWriter('dataset', str(tmpdir))
+                with pytest.raises(TypeError):
+                        writer.write_dataset([np.random.rand(4, 4, 4).astype(np.float32)], [[0, 0, 0]], [1, 1, 1])
+        
+        def test_mismatched_levels_raise_error(self):
+                with pytest.raises(ValueError):
+                        bd.BigViewerDatasetWriter(subsampling_factors='[{ {1,1,1}, {2,2,2} }]',
+                                                  hdf5_chunk_sizes='[{ {16,16,16} }]')
+        
+        def test_factors_that_do_not_divide_raise_error(self):
+                with pytest.raises(ValueError):
+                        bd.BigViewerDatasetWriter(subsampling_factors='[{ {1,1,1}, {2,2,2}, {3,3,3} }]',
+                                                  hdf5_chunk_sizes='[{ {16,16,16}, {16,16,16}, {16,16,16} }]')
+
+
+def test_convert_to_uint16_shares_range_between_images():
+        images = [np.array([[-1.0, 0.0]]), np.array([[1.0, 0.5]])]
+        converted, display_range = bd.convert_to_uint16(images)
+        
+        assert display_range == [-1.0, 1.0]
+        assert all(image.dtype == np.uint16 for image in converted)
+        assert (converted[0] == [[0, 32768]]).all() and (converted[1] == [[65535, 49151]]).all()
+
+
+def test_native_dataset_on_grid(tmpdir):
+        images = np.random.rand(3, 4, 16, 20).astype(np.float32)
+        dataset_args = {'voxel_size_x': 0.5, 'voxel_size_y': 0.5, 'voxel_size_z': 2, 'tiles_x': 3,
+                        'overlap_x_(%)': '10', 'overlap_y_(%)': '10', 'dataset_save_path': str(tmpdir),
+                        'voxel_size_unit': 'um'}
+        stitcher = stitch.BigStitcher(None)
+        stitcher._write_native_dataset(images, dataset_args)
+        
+        root = ET.parse(str(Path(tmpdir, 'dataset.xml'))).getroot()
+        locations = [tile.find('location').text for tile in root.findall(
+                "SequenceDescription/ViewSetups/Attributes[@name='tile']/Tile")]
+        assert locations == ['0.0 0.0 0', '9.0 0.0 0', '18.0 0.0 0']
+        with h5py.File(str(Path(tmpdir, 'dataset.h5')), 'r') as file:
+                assert file['t00000/s00/0/cells'].dtype == np.int16
+                assert np.allclose(file['s02'].attrs['display_range'], [np.min(images), np.max(images)])
@@ -3,6 +3,8 @@ import numpy as np
 from pathlib import Path
 import imagej
 import pytest
+import tiffile as tif
+import os
 
 
 class TestBigStitcher(object):
@@ -82,4 +84,43 @@ class TestBigStitcher(object):
                 
                 for idx in range(len(array)):
                         save_path = Path(outdir, 'Image_{}.tif'.format(idx))
-                        assert save_path.is_file()
\ No newline at end of file
+                        assert save_path.is_file()
+
+class TestNativeFusion(object):
+        @pytest.fixture()
+        def tiled_image(self):
+                """Cut a smooth image into three 20 pixel wide tiles, overlapping by 25%"""
+                image = np.random.rand(4, 6, 50).astype(np.float32)
+                tiles = np.array([image[..., offset:offset + 20] for offset in [0, 15, 30]])
+                return image, tiles
+        
+        def test_fused_tiles_recover_image(self, tiled_image):
+                image, tiles = tiled_image
+                output = stitch.fuse_tiles_along_x(tiles, 25, slices_per_chunk=3)
+                assert output.shape == image.shape
+                assert np.allclose(output, image, atol=1E-6)
+        
+        def test_overlap_is_feathered(self):
+                tiles = np.array([np.zeros([1, 1, 20]), np.ones([1, 1, 20])])
+                output = stitch.fuse_tiles_along_x(tiles, 25)[0, 0]
+                assert (output[:15] == 0).all()
+                assert (output[20:] == 1).all()
+                assert (np.diff(output[15:20]) > 0).all()
+        
+        def test_weights_sum_to_one(self):
+                offsets = stitch.tile_offsets(20, 4, 60)
+                weights = stitch.normalized_feather_weights(20, offsets)
+                total = np.zeros(stitch.fused_width(20, 4, 60))
+                for offset, weight in zip(offsets, weights):
+                        total[offset:offset + 20] += weight
+                assert np.allclose(total, 1)
+        
+        def test_fuse_to_tif_with_threads(self, tmpdir, tiled_image):
+                image, tiles = tiled_image
+                output_path = Path(tmpdir, 'fused.tif')
+                stitch.fuse_tiles_to_tif(tiles, 25, output_path, [1, 1, 2], num_workers=2, slices_per_chunk=1)
+                
+                output = tif.imread(str(output_path))
+                assert output.dtype == np.float32
+                assert np.allclose(output, image, atol=1E-6)
+                assert len(os.listdir(str(tmpdir))) == 1
@@ -147,9 +147,13 @@ def read_metadata(image_path: Path):
         
 
 def write_image(image: sitk.Image, image_path: Path):
+        """Write an image and its metadata file.  The image is written last, and atomically, so it only exists once
+        both are complete"""
         # todo: Write using tiffile so that resolution saves properly?
-        sitk.WriteImage(image, str(image_path))
+        image_path = Path(image_path)
         write_metadata(image_path, image)
+        with util.atomic_write(image_path) as path_temp:
+                sitk.WriteImage(image, str(path_temp))
 
         
 # deprecated methods
@@ -9,8 +9,6 @@ import multiscale.utility_functions as util
 
 import multiscale.itk.metadata as meta
 import multiscale.itk.transform as tran
-from multiscale.itk.itk_plotting import RegistrationPlot
-import multiscale.itk.itk_plotting as itkplt
 
 import SimpleITK as sitk
 import numpy as np
@@ -18,10 +16,11 @@ import os
 
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-
 from multiscale.itk.process import rgb_to_grayscale_img
 
+itkplt = util.lazy_import('multiscale.itk.itk_plotting')
+plt = util.lazy_import('matplotlib.pyplot')
+
 
 class RegistrationHelper(object):
         """
@@ -140,7 +139,7 @@ def define_registration_method(parameters: dict=None) -> sitk.ImageRegistrationM
         return registration_method
 
 
-def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: RegistrationPlot=None,
+def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: 'itkplt.RegistrationPlot'=None,
              registration_method: sitk.ImageRegistrationMethod=None,
              initial_transform: sitk.Transform=None,
              fixed_mask: sitk.Image=None, moving_mask: sitk.Image=None):
@@ -367,7 +366,7 @@ def supervised_register_images(fixed_image: sitk.Image, moving_image: sitk.Image
                                                                                 initial_transform, registration_method,
                                                                                 moving_path)
                 
-                reg_plot = RegistrationPlot(fixed_final, moving_final, transform=initial_transform)
+                reg_plot = itkplt.RegistrationPlot(fixed_final, moving_final, transform=initial_transform)
                 
                 (transform, metric, stop) = register(fixed_final, moving_final, reg_plot,
                                                      registration_method=registration_method,
@@ -31,6 +31,9 @@ import tiffile as tif
 import numpy as np
 import warnings
 
+import multiscale.utility_functions as util
+import multiscale.imagej.bigdata as bdv
+
 
 def get_positions(file_path):
         """Read a .ome.tif file and grab the image positions as a numpy array"""
@@ -72,11 +75,15 @@ def get_spacing(file_path, order=None):
                                    pixel_info['PhysicalSize' + order[2]]]
                         
                 elif type(info['OME']['Image']) is dict:
-                        warnings.warn('These images are 2D.  Setting Z size to 1 micron.')
                         pixel_info = info['OME']['Image']['Pixels']
+                        if 'PhysicalSize' + order[2] in pixel_info:
+                                size_z = pixel_info['PhysicalSize' + order[2]]
+                        else:
+                                warnings.warn('These images are 2D.  Setting Z size to 1 micron.')
+                                size_z = 1
                         spacing = [pixel_info['PhysicalSize' + order[0]],
                                    pixel_info['PhysicalSize' + order[1]],
-                                   1]
+                                   size_z]
 
         except:
                 spacing = [1, 1, 1]
@@ -110,10 +117,8 @@ def get_info(file_path):
         :param file_path: Path to the file.
         :return: XML data as dict
         """
-        reader = sitk.ImageFileReader()
-        reader.SetFileName(str(file_path))
-        reader.ReadImageInformation()
-        raw_info = reader.GetMetaData('ImageDescription')
+        with tif.TiffFile(str(file_path)) as tifr:
+                raw_info = tifr.pages[0].description
         return tif.xml2dict(raw_info)
 
 
@@ -188,4 +193,124 @@ def sitk_to_ijstyle(img):
         shape = arr.shape
         arr.shape = 1, shape[0], 1, shape[1], shape[2], 1
         
-        return arr
\ No newline at end of file
+        return arr
+
+def write_pyramid(image, output_path: Path, spacing, origin=None, num_levels: int=3, tile_size: int=128,
+                  compression='zlib', unit='\u00b5m'):
+        """
+        Save a 3D image as a tiled, compressed OME-TIFF with a resolution pyramid in SubIFDs.
+
+        The image is read one slice at a time, so it may be a memory-mapped array larger than memory.  Each level
+        halves X and Y by block averaging, and is read back lazily with read_pyramid_region.
+        :param image: Array of [Z, Y, X]
+        :param output_path: Path of the .ome.tif file
+        :param spacing: [x, y, z] spacing of the full resolution image
+        :param origin: [x, y, z] position of the first voxel, saved as the OME plane positions.  Default omits it
+        :param num_levels: Number of resolution levels, including the full resolution image
+        :param tile_size: Side of the square tiles, a multiple of 16
+        :param compression: Compression used by tiffile for each tile
+        :param unit: Unit of the spacing and origin
+        :return:
+        """
+        num_slices = np.shape(image)[0]
+        metadata = {'axes': 'ZYX',
+                    'PhysicalSizeX': spacing[0], 'PhysicalSizeXUnit': unit,
+                    'PhysicalSizeY': spacing[1], 'PhysicalSizeYUnit': unit,
+                    'PhysicalSizeZ': spacing[2], 'PhysicalSizeZUnit': unit}
+        if origin is not None:
+                metadata['Plane'] = {'PositionX': [float(origin[0])]*num_slices,
+                                     'PositionY': [float(origin[1])]*num_slices,
+                                     'PositionZ': [float(origin[2] + idx*spacing[2]) for idx in range(num_slices)]}
+
+        options = {'photometric': 'minisblack', 'tile': (tile_size, tile_size), 'compression': compression}
+        with util.atomic_write(output_path) as temp_path:
+                with tif.TiffWriter(str(temp_path), bigtiff=True, ome=True) as writer:
+                        for level in range(num_levels):
+                                factor = 2**level
+                                shape = tuple(size // min(factor, size) for size in np.shape(image)[1:3])
+                                tiles = _iterate_tiles(image, factor, tile_size)
+                                if level == 0:
+                                        writer.write(tiles, shape=(num_slices,) + shape, dtype=np.float32,
+                                                     subifds=num_levels - 1, metadata=metadata, **options)
+                                else:
+                                        writer.write(tiles, shape=(num_slices,) + shape, dtype=np.float32,
+                                                     subfiletype=1, metadata=None, **options)
+
+
+def _iterate_tiles(image, factor: int, tile_size: int):
+        """Yield the tiles of each downsampled slice in the order tiffile writes them"""
+        for idx in range(np.shape(image)[0]):
+                page = np.asarray(image[idx], dtype=np.float32)
+                page = bdv.downsample_image(page[np.newaxis], (1, factor, factor))[0]
+                for y in range(0, page.shape[0], tile_size):
+                        for x in range(0, page.shape[1], tile_size):
+                                yield page[y:y + tile_size, x:x + tile_size]
+
+
+def is_pyramid(file_path) -> bool:
+        """Check whether a file is a tif holding more than one resolution level"""
+        try:
+                with tif.TiffFile(str(file_path)) as tifr:
+                        return len(tifr.series[0].levels) > 1
+        except tif.TiffFileError:
+                return False
+
+
+def get_pyramid_shapes(file_path) -> list:
+        """Get the [Z, Y, X] shape of each resolution level of a tif written by write_pyramid"""
+        with tif.TiffFile(str(file_path)) as tifr:
+                return [level.shape for level in tifr.series[0].levels]
+
+
+def read_pyramid_region(file_path, level: int=0, region=None) -> np.ndarray:
+        """
+        Read part of one resolution level of a tif written by write_pyramid.  Only the slices and tiles that overlap
+        the region are read from disk and decompressed.
+        :param file_path: Path to the tif
+        :param level: Resolution level, 0 being the full resolution image
+        :param region: Tuple of slices along Z, Y, and X, e.g. np.s_[10:20, :, 100:300].  Default reads the level
+        :return: Array of the region in [Z, Y, X]
+        """
+        with tif.TiffFile(str(file_path)) as tifr:
+                series = tifr.series[0].levels[level]
+                shape = series.shape
+                if region is None:
+                        region = (slice(None),)*3
+                z_range, y_range, x_range = [range(*axis_slice.indices(size))
+                                             for axis_slice, size in zip(region, shape)]
+
+                output = np.empty([len(z_range), len(y_range), len(x_range)], dtype=series.dtype)
+                for out_idx, z in enumerate(z_range):
+                        page = series.pages[z]
+                        if hasattr(page, 'aspage'):
+                                page = page.aspage()
+                        output[out_idx] = _read_page_region(tifr.filehandle, page, y_range, x_range)
+
+        return output
+
+
+def _read_page_region(filehandle, page, y_range: range, x_range: range) -> np.ndarray:
+        """Decode only the tiles of a page that overlap the Y and X ranges, then select the ranges"""
+        if not page.is_tiled:
+                return page.asarray()[y_range.start:y_range.stop:y_range.step,
+                                      x_range.start:x_range.stop:x_range.step]
+
+        y_start, y_stop = min(y_range, default=0), max(y_range, default=-1) + 1
+        x_start, x_stop = min(x_range, default=0), max(x_range, default=-1) + 1
+        tiles_across = int(np.ceil(page.imagewidth / page.tilewidth))
+
+        bounding = np.zeros([y_stop - y_start, x_stop - x_start], dtype=page.dtype)
+        for tile_y in range(y_start // page.tilelength, int(np.ceil(y_stop / page.tilelength))):
+                for tile_x in range(x_start // page.tilewidth, int(np.ceil(x_stop / page.tilewidth))):
+                        index = tile_y*tiles_across + tile_x
+                        filehandle.seek(page.dataoffsets[index])
+                        tile = page.decode(filehandle.read(page.databytecounts[index]), index)[0]
+                        tile = np.reshape(tile, [page.tilelength, page.tilewidth])
+
+                        top, left = tile_y*page.tilelength, tile_x*page.tilewidth
+                        rows = slice(max(top, y_start), min(top + page.tilelength, y_stop))
+                        cols = slice(max(left, x_start), min(left + page.tilewidth, x_stop))
+                        bounding[rows.start - y_start:rows.stop - y_start, cols.start - x_start:cols.stop - x_start] = \
+                                tile[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+
+        return bounding[::y_range.step, ::x_range.step]
@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+from pathlib import Path
+
+import multiscale.microscopy.ome as ome
+import multiscale.imagej.bigdata as bdv
+
+
+class TestPyramid(object):
+        @pytest.fixture()
+        def pyramid(self, tmpdir):
+                image = np.random.rand(4, 300, 270).astype(np.float32)
+                path = Path(tmpdir, 'pyramid.ome.tif')
+                ome.write_pyramid(image, path, [2, 3, 4], origin=[10, 20, 30], num_levels=3)
+                return image, path
+
+        def test_levels_are_block_averages(self, pyramid):
+                image, path = pyramid
+                assert ome.is_pyramid(path)
+                assert ome.get_pyramid_shapes(path) == [(4, 300, 270), (4, 150, 135), (4, 75, 67)]
+                for level in range(3):
+                        expected = bdv.downsample_image(image, (1, 2**level, 2**level))
+                        assert np.allclose(ome.read_pyramid_region(path, level), expected)
+
+        @pytest.mark.parametrize('region', [np.s_[1:3, 100:290, 5:200:3], np.s_[::-1, 250:20:-7, :],
+                                            np.s_[2:3, 127:129, 255:270]])
+        def test_region_matches_full_image(self, pyramid, region):
+                image, path = pyramid
+                assert np.array_equal(ome.read_pyramid_region(path, 0, region), image[region])
+
+        def test_spacing_and_origin_are_saved(self, pyramid):
+                image, path = pyramid
+                planes = ome.get_info(path)['OME']['Image']['Pixels']['Plane']
+
+                assert ome.get_spacing(path) == [2, 3, 4]
+                assert [planes[1]['PositionX'], planes[1]['PositionY'], planes[1]['PositionZ']] == [10, 20, 34]
+
+        def test_imagej_tif_is_not_a_pyramid(self, tmpdir):
+                path = Path(tmpdir, 'flat.tif')
+                ome.save_ijstyle(np.zeros([1, 2, 1, 8, 8, 1], dtype=np.float32), str(path), [1, 1, 1])
+                assert not ome.is_pyramid(path)
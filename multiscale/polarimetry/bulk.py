@@ -0,0 +1,145 @@
+"""
+Run a per-image function over a cohort of polarimetry images, optionally in parallel
+
+Each task names the images it reads, the outputs it writes, and the arguments to the per-image function.  Tasks whose
+outputs all exist are skipped, so the per-image functions should only create their outputs once they are complete,
+e.g. through util.atomic_write.
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import namedtuple, deque
+from pathlib import Path
+import os
+import time
+
+try:
+        import resource
+except ImportError:
+        resource = None
+
+
+BulkTask = namedtuple('BulkTask', ['input_paths', 'output_paths', 'args'])
+
+
+def run_bulk(function, tasks: list, num_workers: int=1, memory_limit: int=None,
+             skip_existing_images: bool=True) -> dict:
+        """
+        Call function(*task.args) for every task, and report the time and read throughput of each image
+
+        :param function: Picklable function that processes one image, e.g. a module level function
+        :param tasks: List of BulkTask.  input_paths are used for names and throughput, and output_paths to skip
+        finished images
+        :param num_workers: Number of processes running tasks in parallel.  1 runs them in this process
+        :param memory_limit: Maximum address space of each worker process, in bytes.  A task that needs more fails
+        alone with a MemoryError instead of exhausting the machine.  Only applies with more than one worker, on
+        platforms with the resource module.  If a worker dies instead, e.g. when a native allocation aborts, the pool
+        is restarted and the tasks it was running are retried one at a time, so only the task that kills its worker
+        fails
+        :param skip_existing_images: Skip tasks whose output paths all exist
+        :return: Dictionary of seconds taken to process each image that succeeded, keyed by the first input name.
+        Images that raise an exception are reported and left out, without stopping the others
+        """
+        if skip_existing_images:
+                tasks = [task for task in tasks if not all(Path(path).exists() for path in task.output_paths)]
+
+        if memory_limit is not None and resource is None:
+                print('Memory limits are not supported on this platform, running without them')
+                memory_limit = None
+
+        timings = {}
+        start = time.perf_counter()
+        if num_workers <= 1:
+                for task in tasks:
+                        try:
+                                elapsed = _run_task(function, task.args)
+                        except Exception as error:
+                                _report_failure(task, error)
+                                continue
+
+                        timings[_task_name(task)] = elapsed
+                        _report_throughput(task, elapsed)
+        else:
+                pending = deque(tasks)
+                while pending:
+                        suspects = _run_pool(function, pending, num_workers, memory_limit, timings)
+                        if suspects:
+                                print('A worker process died, retrying the {} images it may have been running one at '
+                                      'a time'.format(len(suspects)))
+                        for task in suspects:
+                                if _run_pool(function, deque([task]), 1, memory_limit, timings):
+                                        _report_failure(task, BrokenProcessPool('The worker process died'))
+
+        total = time.perf_counter() - start
+        if tasks:
+                print('Processed {} of {} images in {:.1f} s, {:.2f} images/minute'.format(
+                        len(timings), len(tasks), total, 60*len(timings)/total))
+
+        return timings
+
+
+def _run_pool(function, pending: deque, num_workers: int, memory_limit: int, timings: dict) -> list:
+        """
+        Run tasks from the pending queue in a process pool, with at most num_workers submitted at once, until the queue
+        is empty or a worker process dies
+        :return: Tasks that were submitted to the pool when a worker died, of which any may have killed it
+        """
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                while pending or in_flight:
+                        while pending and len(in_flight) < num_workers:
+                                task = pending.popleft()
+                                in_flight[executor.submit(_run_task, function, task.args, memory_limit)] = task
+                        
+                        suspects = []
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                                task = in_flight.pop(future)
+                                try:
+                                        elapsed = future.result()
+                                except BrokenProcessPool:
+                                        suspects.append(task)
+                                        continue
+                                except Exception as error:
+                                        _report_failure(task, error)
+                                        continue
+                                
+                                timings[_task_name(task)] = elapsed
+                                _report_throughput(task, elapsed)
+                        
+                        if suspects:
+                                return suspects + list(in_flight.values())
+        
+        return []
+
+
+def _run_task(function, args, memory_limit=None) -> float:
+        """Worker for run_bulk: process one image, returning only the time taken so no outputs are pickled back"""
+        _limit_worker_memory(memory_limit)
+        start = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - start
+
+
+def _limit_worker_memory(memory_limit):
+        """Cap the address space of a run_bulk worker process.  Applied by each task, as pool initializers need
+        Python 3.7"""
+        if memory_limit is None:
+                return
+
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        if hard_limit != resource.RLIM_INFINITY:
+                memory_limit = min(memory_limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (int(memory_limit), hard_limit))
+
+
+def _task_name(task: BulkTask) -> str:
+        return Path(task.input_paths[0]).name
+
+
+def _report_throughput(task: BulkTask, elapsed: float):
+        size = sum(os.path.getsize(str(path)) for path in task.input_paths)
+        print('Processed {} in {:.2f} s, {:.1f} MB/s'.format(_task_name(task), elapsed, size/1E6/max(elapsed, 1E-9)))
+
+
+def _report_failure(task: BulkTask, error: Exception):
+        print('Could not process {}: {!r}'.format(_task_name(task), error))
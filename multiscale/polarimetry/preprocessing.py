@@ -2,11 +2,13 @@ import os
 from pathlib import Path
 
 import SimpleITK as sitk
-import bioformats as bf
 import numpy as np
 
 from multiscale import utility_functions as util
-from multiscale.itk import itk_plotting as itkplot, registration as reg, transform as tran, metadata as meta
+from multiscale.itk import registration as reg, transform as tran, metadata as meta
+
+bf = util.lazy_import('bioformats')
+itkplot = util.lazy_import('multiscale.itk.itk_plotting')
 
 
 def plot_overlay_from_czi_timepoints(path_file, timepoint_one, timepoint_two):
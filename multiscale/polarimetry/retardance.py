@@ -2,13 +2,20 @@ import multiscale.tiling as til
 import multiscale.bulk_img_processing as blk
 import multiscale.itk.metadata as meta
 import multiscale.utility_functions as util
+import multiscale.polarimetry.bulk as bulk
 
 import scipy.stats as st
 import numpy as np
+import pandas as pd
 import SimpleITK as sitk
 import os
+import shutil
+import uuid
 
-import csv
+from pathlib import Path
+
+pa = util.lazy_import('pyarrow')
+pa_dataset = util.lazy_import('pyarrow.dataset')
 
 
 def calculate_retardance_over_area(retardance, orientation, ret_thresh=0):
@@ -70,8 +77,191 @@ def calculate_alignment(orient_tile):
         return alignment
 
 
+def calculate_tile_statistics(ret_array, orient_array, tile_size, tile_separation=None, roi_size=None,
+                              summed_area=None):
+        """
+        Calculate the average retardance, orientation, and alignment of every tile, or every ROI within every tile, at
+        once.
+        
+        The orientation weighted retardance and the alignment angles are found once for the whole image, and each
+        tile is then a reduction over a view of them, instead of a Python loop over calculate_retardance_over_area
+        and calculate_alignment.  Tiles are laid out as in til.generate_tile.
+        
+        When tiles overlap heavily, their sums are instead looked up from summed-area tables, so each tile costs the
+        same whatever its size and dense maps at a separation of 1 pixel are practical.  The tables are built over
+        strips of rows, as a table of the whole image would take 16 bytes per pixel for each of the two complex
+        arrays, on top of the arrays themselves.
+        :param ret_array: 2D retardance array, in degrees
+        :param orient_array: 2D orientation array of the same shape, in degrees
+        :param tile_size: Size in pixels of the tiles
+        :param tile_separation: Distance between tiles.  Default places them side by side
+        :param roi_size: Size of regions of interest within tiles.  Default gives one value per tile
+        :param summed_area: Whether to sum tiles from summed-area tables.  Default uses them when each pixel is in
+        16 or more tiles, past which building the tables is faster than summing the tiles.  ROIs are always summed
+        directly
+        :return: Retardance, orientation, and alignment arrays, [tiles_y, tiles_x] or [tiles_y, tiles_x, rois_y, rois_x]
+        """
+        # Orientation doubled, as in calculate_retardance_over_area.  exp(-i*angle) is built from the real cos and
+        # sin, which numpy evaluates several times faster than the complex exp
+        circular_orientation = (2 * np.pi / 180) * orient_array
+        complex_orientation = np.empty(np.shape(circular_orientation),
+                                       dtype=np.result_type(circular_orientation, np.complex64))
+        np.cos(circular_orientation, out=complex_orientation.real)
+        np.sin(circular_orientation, out=complex_orientation.imag)
+        np.negative(complex_orientation.imag, out=complex_orientation.imag)
+        
+        retardance_weighted_by_orientation = ret_array * complex_orientation
+        
+        nonzero_orient = orient_array > 0
+        complex_angles = np.where(nonzero_orient, complex_orientation, 0)
+        
+        if summed_area is None:
+                summed_area = (roi_size is None and tile_separation is not None
+                               and np.prod(np.array(tile_size) / np.array(tile_separation)) >= 16)
+        
+        def tile_sums(array):
+                if summed_area:
+                        sums = til.tile_sums_from_strips(array, tile_size, tile_separation)
+                        # Back to the precision a direct sum would have
+                        return sums.astype(np.sum(array[:1, :1]).dtype)
+                
+                tiles = til.tile_view(array, tile_size, tile_separation)
+                if roi_size is not None:
+                        tiles = til.tile_view(tiles, roi_size, axes=(2, 3))
+                
+                return np.sum(tiles, axis=(-2, -1))
+        
+        if roi_size is None:
+                num_pixels = int(np.prod(tile_size))
+        else:
+                num_pixels = int(np.prod(roi_size))
+        average_retardance = tile_sums(retardance_weighted_by_orientation) / num_pixels
+        
+        ret_mag = np.absolute(average_retardance)
+        ret_angle = (np.angle(average_retardance, deg=True) + 180) / 2
+        
+        sum_angles = tile_sums(complex_angles)
+        num_nonzero = tile_sums(nonzero_orient)
+        with np.errstate(divide='ignore', invalid='ignore'):
+                alignment = np.abs(sum_angles / num_nonzero.astype(sum_angles.real.dtype))
+        alignment[num_nonzero == 0] = np.nan
+        
+        return ret_mag, ret_angle, alignment
+
+
+TILE_STATISTICS_PARTITIONS = ['Mouse', 'Slide', 'Modality']
+
+
+def tile_statistics_table(retardance, orientation, alignment, mouse, slide, modality):
+        """
+        Arrange the output of calculate_tile_statistics as a table, with one row per tile or ROI
+        
+        Tile and ROI numbers are stored as integer columns instead of labels like '3x-5y'.  As in those labels, X is
+        the first array index and Y the second.
+        :param retardance: Retardance array, [tiles, tiles] or [tiles, tiles, rois, rois]
+        :param orientation: Orientation array of the same shape
+        :param alignment: Alignment array of the same shape
+        :param mouse: Mouse the image came from
+        :param slide: Slide the image came from
+        :param modality: Imaging modality
+        :return: DataFrame with Mouse, Slide, Modality, Tile X, Tile Y, [ROI X, ROI Y,] Retardance, Orientation, and
+        Alignment columns
+        """
+        shape = np.shape(retardance)
+        index = np.indices(shape).reshape(len(shape), -1)
+        num_rows = index.shape[1]
+        
+        columns = {'Mouse': np.full(num_rows, str(mouse), dtype=object),
+                   'Slide': np.full(num_rows, str(slide), dtype=object),
+                   'Modality': np.full(num_rows, str(modality), dtype=object),
+                   'Tile X': index[0], 'Tile Y': index[1]}
+        if len(shape) == 4:
+                columns['ROI X'] = index[2]
+                columns['ROI Y'] = index[3]
+        
+        columns['Retardance'] = np.ravel(retardance)
+        columns['Orientation'] = np.ravel(orientation)
+        columns['Alignment'] = np.ravel(alignment)
+        
+        return pd.DataFrame(columns)
+
+
+def write_tile_statistics(table, dataset_path):
+        """
+        Write tile statistics to a Parquet dataset, partitioned by mouse, slide, and modality
+        
+        Each partition in the table replaces the partition of the same name in the dataset, so processing an image
+        again overwrites its rows.  The files are first written to a hidden directory in the dataset, which readers
+        ignore, and each finished partition is then renamed into place.  Processes writing different partitions at
+        once do not interfere.
+        :param table: DataFrame from tile_statistics_table
+        :param dataset_path: Directory of the dataset.  Created if it does not exist
+        """
+        path_temp = Path(dataset_path, '.tmp-' + uuid.uuid4().hex)
+        try:
+                table.to_parquet(str(path_temp), partition_cols=TILE_STATISTICS_PARTITIONS, index=False)
+                
+                for partition_temp in {path.parent for path in path_temp.rglob('*') if path.is_file()}:
+                        partition_path = Path(dataset_path, partition_temp.relative_to(path_temp))
+                        os.makedirs(str(partition_path.parent), exist_ok=True)
+                        
+                        path_old = Path(dataset_path, '.old-' + uuid.uuid4().hex)
+                        if partition_path.exists():
+                                os.replace(str(partition_path), str(path_old))
+                        os.replace(str(partition_temp), str(partition_path))
+                        shutil.rmtree(str(path_old), ignore_errors=True)
+        finally:
+                shutil.rmtree(str(path_temp), ignore_errors=True)
+
+
+def read_tile_statistics(dataset_path, columns=None, filters=None):
+        """
+        Read tile statistics from a Parquet dataset
+        
+        The mouse, slide, and modality are read as strings, keeping IDs like '01' as they were written.
+        :param dataset_path: Directory of the dataset
+        :param columns: Columns to read.  Default reads all of them
+        :param filters: Row filters, e.g. [('Modality', '==', 'PS-O')].  Filters on partition columns skip the files
+        of the other partitions
+        :return: DataFrame of the tile statistics
+        """
+        schema = pa.schema([(name, pa.string()) for name in TILE_STATISTICS_PARTITIONS])
+        partitioning = pa_dataset.partitioning(schema, flavor='hive')
+        return pd.read_parquet(str(dataset_path), columns=columns, filters=filters, partitioning=partitioning)
+
+
+def get_dataset_path(output_dir, output_suffix, tile_size, tile_separation=None, roi_size=None):
+        """Name the dataset of a batch after its output suffix, tile size, and ROI size"""
+        if tile_separation is not None and np.any(np.array(tile_separation) != np.array(tile_size)):
+                output_suffix = (output_suffix + '_SimRes-' + str(tile_separation[0]) + 'x')
+        
+        output_suffix_with_tilenum = output_suffix + '_' + str(tile_size[0])
+        
+        if roi_size is not None:
+                output_suffix_with_tilenum = output_suffix_with_tilenum + '_' + str(roi_size[0])
+        
+        return Path(output_dir, output_suffix_with_tilenum + '.parquet')
+
+
+def get_partition_path(dataset_path, mouse, slide, modality):
+        """Get the directory of a dataset that holds the tile statistics of a mouse, slide, and modality"""
+        return Path(dataset_path, 'Mouse=' + str(mouse), 'Slide=' + str(slide), 'Modality=' + str(modality))
+
+
+def has_tile_statistics(dataset_path, mouse, slide, modality):
+        """Whether a dataset already has a partition for a mouse, slide, and modality"""
+        return get_partition_path(dataset_path, mouse, slide, modality).is_dir()
+
+
+def get_sample_and_modality(ret_image_path, orient_image_path):
+        """Get the mouse, slide, and modality of a retardance/orientation image pair from their file names"""
+        mouse, slide = blk.get_core_file_name(orient_image_path).split('-')
+        modality = blk.file_name_parts(ret_image_path)[1] + '-O'
+        return mouse, slide, modality
+
+
 def process_orientation_alignment(ret_image_path, orient_image_path,
-                                  output_path,
+                                  dataset_path,
                                   tile_size, tile_separation=None,
                                   roi_size=None,
                                   intensity_thresh=1, number_thresh=10):
@@ -80,147 +270,68 @@ def process_orientation_alignment(ret_image_path, orient_image_path,
         
         :param ret_image_path: Path to the retardance image
         :param orient_image_path:  path to the orientaiton image
-        :param output_path: Path to save the output csv file
+        :param dataset_path: Parquet dataset to append the results to
         :param tile_size: Size in pixels of the tile
         :param tile_separation: Distance between tiles, defaults to 0
         :param roi_size: Size of regions of interest within tiles
         :param intensity_thresh:
         :param number_thresh:
-        :return:
+        :return: DataFrame of the results, as from tile_statistics_table
         """
         
-        modality = blk.file_name_parts(ret_image_path)[1] + '-O'
+        mouse, slide, modality = get_sample_and_modality(ret_image_path, orient_image_path)
         
         ret_image = sitk.ReadImage(str(ret_image_path))
         ret_array = sitk.GetArrayFromImage(ret_image)
-        ret_max = np.max(ret_array)
         
         orient_image = sitk.ReadImage(str(orient_image_path))
         orient_array = sitk.GetArrayFromImage(orient_image)
         
-        array_shape = np.shape(orient_array)
-        
-        pixel_num, offset = til.calculate_number_of_tiles(
-                array_shape, tile_size, tile_separation)
+        retardance, orientation, alignment = calculate_tile_statistics(ret_array, orient_array, tile_size,
+                                                                       tile_separation=tile_separation,
+                                                                       roi_size=roi_size)
         
         if roi_size is None:
-                with open(output_path, 'w', newline='') as csvfile:
-                        print('\nWriting average retardance file for {} at tile size {}'.format(
-                                ret_image_path.name, tile_size[0]))
-                        writer = csv.writer(csvfile)
-                        writer.writerow(['Mouse', 'Slide', 'Modality', 'Tile',
-                                         'Retardance', 'Orientation', 'Alignment'])
-                        
-                        for start, end, tile_number in til.generate_tile_start_end_index(
-                                    pixel_num, tile_size, tile_offset=offset,
-                                    tile_separation=tile_separation):
-                                
-                                ret_tile = ret_array[start[0]:end[0],
-                                           start[1]:end[1]]
-                                
-                                orient_tile = orient_array[start[0]:end[0],
-                                              start[1]:end[1]]
-                                
-                                retardance, orientation = calculate_retardance_over_area(
-                                        ret_tile, orient_tile)
-                                
-                                if retardance is np.nan:
-                                        continue
-                                
-                                alignment = calculate_alignment(orient_tile)
-                                
-                                sample = blk.get_core_file_name(output_path)
-                                mouse, slide = sample.split('-')
-                                
-                                tile = str(tile_number[0]) + 'x-' + str(tile_number[1]) + 'y'
-                                
-                                writer.writerow([mouse, slide, modality, tile,
-                                                 retardance, orientation, alignment])
-        
+                print('\nWriting average retardance for {} at tile size {}'.format(
+                        Path(ret_image_path).name, tile_size[0]))
         else:
-                num_rois, roi_offset = til.calculate_number_of_tiles(tile_size, roi_size)
-                
-                with open(output_path, 'w', newline='') as csvfile:
-                        print('\nWriting average retardance file for {} at tile size {} and roi size {}'.format(
-                                ret_image_path.name, tile_size[0], roi_size[0]))
-                        writer = csv.writer(csvfile)
-                        writer.writerow(['Mouse', 'Slide', 'Modality', 'Tile', 'ROI',
-                                         'Retardance', 'Orientation', 'Alignment'])
-                        
-                        for start, end, tile_number in til.generate_tile_start_end_index(
-                                    pixel_num, tile_size, tile_offset=offset,
-                                    tile_separation=tile_separation):
-                                
-                                ret_tile = ret_array[start[0]:end[0],
-                                           start[1]:end[1]]
-                                
-                                orient_tile = orient_array[start[0]:end[0],
-                                              start[1]:end[1]]
-                                
-                                tile = str(tile_number[0]) + 'x-' + str(tile_number[1]) + 'y'
-                                
-                                for start_roi, end_roi, roi_number in til.generate_tile_start_end_index(
-                                            num_rois, roi_size, tile_offset=roi_offset):
-                                        
-                                        ret_roi = ret_tile[start_roi[0]:end_roi[0],
-                                                  start_roi[1]:end_roi[1]]
-                                        
-                                        orient_roi = orient_tile[start_roi[0]:end_roi[0],
-                                                     start_roi[1]:end_roi[1]]
-                                        
-                                        retardance, orientation = calculate_retardance_over_area(
-                                                ret_roi, orient_roi)
-                                        
-                                        if retardance is np.nan:
-                                                continue
-                                        
-                                        alignment = calculate_alignment(orient_roi)
-                                        
-                                        sample = blk.get_core_file_name(output_path)
-                                        mouse, slide = sample.split('-')
-                                        
-                                        roi = 'ROI' + str(roi_number[0]) + 'x' + str(roi_number[1]) + 'y'
-                                        
-                                        writer.writerow([mouse, slide, modality, tile, roi,
-                                                         retardance, orientation, alignment])
+                print('\nWriting average retardance for {} at tile size {} and roi size {}'.format(
+                        Path(ret_image_path).name, tile_size[0], roi_size[0]))
+        
+        table = tile_statistics_table(retardance, orientation, alignment, mouse, slide, modality)
+        write_tile_statistics(table, dataset_path)
+        
+        return table
 
 
 def bulk_process_orientation_alignment(
             ret_dir, orient_dir, output_dir, output_suffix,
             tile_size,
             tile_separation=None, skip_existing_images=True,
-            roi_size=None):
-        """Calculate average retardance images
-        """
-        # todo: add ROI capability
-        
-        output_suffix_with_tilenum = output_suffix + '_' + str(tile_size[0])
-        
-        if roi_size is not None:
-                output_suffix_with_tilenum = output_suffix_with_tilenum + '_' + str(roi_size[0])
+            roi_size=None, num_workers=1, memory_limit=None):
+        """Calculate average retardance for every image pair, into one Parquet dataset named after the output suffix
+        and tile size
         
-        if tile_separation and tile_separation != tile_size:
-                output_suffix = (output_suffix + '_SimRes-' + str(tile_separation) + 'x')
+        :param num_workers: Number of processes handling images in parallel
+        :param memory_limit: Maximum memory of each process in bytes, as in bulk.run_bulk
+        :return: Path to the dataset
+        """
+        dataset_path = get_dataset_path(output_dir, output_suffix, tile_size, tile_separation, roi_size)
         
         ret_image_path_list, orient_image_path_list = blk.find_shared_images(
                 ret_dir, orient_dir)
         
-        for i in range(0, np.size(ret_image_path_list)):
-                
-                output_path = blk.create_new_image_path(
-                        orient_image_path_list[i], output_dir,
-                        output_suffix_with_tilenum,
-                        extension='.csv')
-                
-                if output_path.exists() and skip_existing_images:
-                        continue
-                
-                process_orientation_alignment(ret_image_path_list[i],
-                                              orient_image_path_list[i],
-                                              output_path,
-                                              tile_size,
-                                              tile_separation=tile_separation,
-                                              roi_size=roi_size)
+        tasks = []
+        for ret_path, orient_path in zip(ret_image_path_list, orient_image_path_list):
+                partition_path = get_partition_path(dataset_path, *get_sample_and_modality(ret_path, orient_path))
+                tasks.append(bulk.BulkTask([ret_path, orient_path], [partition_path],
+                                           (ret_path, orient_path, dataset_path, tile_size, tile_separation,
+                                            roi_size)))
+        
+        bulk.run_bulk(process_orientation_alignment, tasks, num_workers=num_workers, memory_limit=memory_limit,
+                      skip_existing_images=skip_existing_images)
+        
+        return dataset_path
 
 
 def convert_intensity_to_retardance(itk_image,
@@ -237,8 +348,20 @@ def convert_intensity_to_retardance(itk_image,
         :return A new ITK image with retardance values either in degrees or in nm
         """
         
-        input_array = sitk.GetArrayFromImage(itk_image)
+        output_array = intensity_to_retardance(sitk.GetArrayFromImage(itk_image), ret_ceiling=ret_ceiling,
+                                               wavelength=wavelength, nm_input=nm_input, deg_output=deg_output)
         
+        output_image = sitk.GetImageFromArray(output_array)
+        meta.copy_relevant_metadata(output_image, itk_image)
+        
+        return output_image
+
+
+def intensity_to_retardance(input_array, ret_ceiling=35, wavelength=549, nm_input=True, deg_output=True):
+        """Convert an array of retardance intensities into retardance values, as convert_intensity_to_retardance
+        
+        :return: float32 array of retardance values, computed without a float64 temporary
+        """
         # todo: implement a check for pixel type
         
         pixel_type_factor = ret_ceiling / 65535
@@ -250,58 +373,165 @@ def convert_intensity_to_retardance(itk_image,
         else:
                 wavelength_factor = 1
         
-        output_array = input_array * pixel_type_factor * wavelength_factor
+        return np.multiply(input_array, np.float32(pixel_type_factor * wavelength_factor), dtype=np.float32)
+
+
+def intensity_file_to_retardance(input_path, output_path):
+        print('Converting {} to degrees linear retardance'.format(input_path.name))
         
-        output_image = sitk.GetImageFromArray(output_array)
-        output_image = sitk.Cast(output_image, sitk.sitkFloat32)
-        meta.copy_relevant_metadata(output_image, itk_image)
+        int_image = meta.setup_image(input_path)
+        ret_image = convert_intensity_to_retardance(int_image)
         
-        return output_image
+        meta.write_image(ret_image, output_path)
 
 
 def bulk_intensity_to_retardance(input_dir, output_dir, output_suffix,
-                                 skip_existing_images=True):
+                                 skip_existing_images=True, num_workers=1, memory_limit=None):
         path_list = util.list_filetype_in_dir(input_dir, '.tif')
         
-        for i in range(len(path_list)):
-                output_path = blk.create_new_image_path(
-                        path_list[i], output_dir, output_suffix)
-                if output_path.exists() and skip_existing_images:
-                        continue
-                
-                print('Converting {} to degrees linear retardance'.format(path_list[i].name))
-                
-                int_image = meta.setup_image(path_list[i])
-                ret_image = convert_intensity_to_retardance(int_image)
-
-                meta.write_image(ret_image, output_path)
+        tasks = []
+        for input_path in path_list:
+                output_path = blk.create_new_image_path(input_path, output_dir, output_suffix)
+                tasks.append(bulk.BulkTask([input_path], [output_path], (input_path, output_path)))
+        
+        bulk.run_bulk(intensity_file_to_retardance, tasks, num_workers=num_workers, memory_limit=memory_limit,
+                      skip_existing_images=skip_existing_images)
 
 
 def rotate_90_degrees(img: sitk.Image):
         array = sitk.GetArrayFromImage(img)
-        above = array > 90
-        below = array <= 90
-        array[above] = array[above] - 90
-        array[below] = array[below] + 90
-        img = sitk.GetImageFromArray(array)
+        img = sitk.GetImageFromArray(rotate_90_degrees_array(array))
         return img
 
 
+def rotate_90_degrees_array(array):
+        """Rotate orientations in [0, 180] degrees by 90 degrees, in place"""
+        above = array > 90
+        np.subtract(array, 90, out=array, where=above)
+        np.add(array, 90, out=array, where=np.invert(above, out=above))
+        return array
+
+
+def orientation_to_proper_degrees(orient_array):
+        """Convert an orientation array in hundredths of a degree to proper degrees, in place
+        
+        Integer arrays are divided with truncation, as sitk.Divide does, and keep their type
+        """
+        if np.issubdtype(orient_array.dtype, np.integer):
+                np.floor_divide(orient_array, 100, out=orient_array)
+        else:
+                np.divide(orient_array, 100, out=orient_array)
+        
+        return rotate_90_degrees_array(orient_array)
+
+
+def orientation_file_to_proper_degrees(input_path, output_path):
+        print('Converting {} to degrees proper'.format(input_path.name))
+        orient_img = meta.setup_image(input_path)
+        deg_img = sitk.Divide(orient_img, 100)
+        img = rotate_90_degrees(deg_img)
+        
+        meta.write_image(img, output_path)
+
+
 def bulk_orientation_to_proper_degrees(input_dir, output_dir, output_suffix,
-                                       skip_existing_images=True):
+                                       skip_existing_images=True, num_workers=1, memory_limit=None):
         path_list = util.list_filetype_in_dir(input_dir, '.tif')
-        for i in range(len(path_list)):
-                output_path = blk.create_new_image_path(
-                        path_list[i], output_dir, output_suffix)
-                if output_path.exists() and skip_existing_images:
-                        continue
+        
+        tasks = []
+        for input_path in path_list:
+                output_path = blk.create_new_image_path(input_path, output_dir, output_suffix)
+                tasks.append(bulk.BulkTask([input_path], [output_path], (input_path, output_path)))
+        
+        bulk.run_bulk(orientation_file_to_proper_degrees, tasks, num_workers=num_workers, memory_limit=memory_limit,
+                      skip_existing_images=skip_existing_images)
+
+
+def process_ps_image_pair(intensity_path, orient_path, dataset_path,
+                          tile_size, tile_separation=None, roi_size=None,
+                          ret_output_path=None, orient_output_path=None):
+        """
+        Convert a PS intensity and orientation image pair and calculate their tile statistics in memory
+        
+        Gives the results of convert_intensity_to_retardance, rotate_90_degrees after division by 100, and then
+        process_orientation_alignment, without writing the converted images and reading them back.
+        :param intensity_path: Path to the retardance intensity image
+        :param orient_path: Path to the orientation image, in hundredths of a degree
+        :param dataset_path: Parquet dataset to append the results to.  None only returns them
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between tiles.  Default places them side by side
+        :param roi_size: Size of regions of interest within tiles
+        :param ret_output_path: Path to also save the retardance image to
+        :param orient_output_path: Path to also save the orientation image in degrees to
+        :return: DataFrame of the results, as from tile_statistics_table
+        """
+        mouse, slide, modality = get_sample_and_modality(intensity_path, orient_path)
+        print('\nProcessing {} and {}'.format(Path(intensity_path).name, Path(orient_path).name))
+        
+        intensity_image = meta.setup_image(Path(intensity_path))
+        ret_array = intensity_to_retardance(sitk.GetArrayFromImage(intensity_image))
+        orient_array = orientation_to_proper_degrees(sitk.GetArrayFromImage(meta.setup_image(Path(orient_path))))
+        
+        if ret_output_path is not None:
+                ret_image = sitk.GetImageFromArray(ret_array)
+                meta.copy_relevant_metadata(ret_image, intensity_image)
+                meta.write_image(ret_image, ret_output_path)
+        
+        if orient_output_path is not None:
+                meta.write_image(sitk.GetImageFromArray(orient_array), orient_output_path)
+        
+        retardance, orientation, alignment = calculate_tile_statistics(ret_array, orient_array, tile_size,
+                                                                       tile_separation=tile_separation,
+                                                                       roi_size=roi_size)
+        
+        table = tile_statistics_table(retardance, orientation, alignment, mouse, slide, modality)
+        if dataset_path is not None:
+                write_tile_statistics(table, dataset_path)
+        
+        return table
+
+
+def bulk_process_ps_images(intensity_dir, orient_dir, output_dir, output_suffix,
+                           tile_size, tile_separation=None, roi_size=None,
+                           ret_output_dir=None, orient_output_dir=None,
+                           skip_existing_images=True, num_workers=1, memory_limit=None):
+        """
+        Convert every PS intensity and orientation image pair and calculate their tile statistics, with
+        process_ps_image_pair
+        
+        :param ret_output_dir: Directory to also save the retardance images to, as <core>_<output_suffix>_Ret.tif
+        :param orient_output_dir: Directory to also save the orientation images to, as
+        <core>_<output_suffix>_Orient.tif
+        :param num_workers: Number of processes handling images in parallel
+        :param memory_limit: Maximum memory of each process in bytes, as in bulk.run_bulk
+        :return: Path to the dataset, named as in bulk_process_orientation_alignment
+        """
+        dataset_path = get_dataset_path(output_dir, output_suffix, tile_size, tile_separation, roi_size)
+        
+        intensity_path_list, orient_path_list = blk.find_shared_images(intensity_dir, orient_dir)
+        
+        tasks = []
+        for intensity_path, orient_path in zip(intensity_path_list, orient_path_list):
+                output_paths = [get_partition_path(dataset_path, *get_sample_and_modality(intensity_path, orient_path))]
                 
-                print('Converting {} to degrees proper'.format(path_list[i].name))
-                orient_img = meta.setup_image(path_list[i])
-                deg_img = sitk.Divide(orient_img, 100)
-                img = rotate_90_degrees(deg_img)
+                ret_output_path, orient_output_path = None, None
+                if ret_output_dir is not None:
+                        ret_output_path = blk.create_new_image_path(intensity_path, ret_output_dir,
+                                                                    output_suffix + '_Ret')
+                        output_paths.append(ret_output_path)
+                if orient_output_dir is not None:
+                        orient_output_path = blk.create_new_image_path(orient_path, orient_output_dir,
+                                                                       output_suffix + '_Orient')
+                        output_paths.append(orient_output_path)
                 
-                meta.write_image(img, output_path)
+                tasks.append(bulk.BulkTask([intensity_path, orient_path], output_paths,
+                                           (intensity_path, orient_path, dataset_path, tile_size, tile_separation,
+                                            roi_size, ret_output_path, orient_output_path)))
+        
+        bulk.run_bulk(process_ps_image_pair, tasks, num_workers=num_workers, memory_limit=memory_limit,
+                      skip_existing_images=skip_existing_images)
+        
+        return dataset_path
 
 
 def downsample_retardance_image(ret_image_path, orient_image_path,
@@ -310,49 +540,41 @@ def downsample_retardance_image(ret_image_path, orient_image_path,
         if not tile_separation:
                 tile_separation = tile_size
         
-        ret_image = sitk.ReadImage(ret_image_path)
-        orient_image = sitk.ReadImage(orient_image_path)
+        ret_image = sitk.ReadImage(str(ret_image_path))
+        orient_image = sitk.ReadImage(str(orient_image_path))
         
         ret_array = sitk.GetArrayFromImage(ret_image)
         orient_array = sitk.GetArrayFromImage(orient_image)
         
-        array_size = np.shape(ret_array)
-        
-        pixel_num, offset = til.calculate_number_of_tiles(
-                array_size, tile_size, tile_separation)
-        
-        down_ret_array = np.zeros(pixel_num)
-        down_orient_array = np.zeros(pixel_num)
-        
-        for start, end, tile_number in til.generate_tile_start_end_index(
-                    pixel_num, tile_size, tile_offset=offset,
-                    tile_separation=tile_separation):
-                ret_tile = ret_array[range(start[0], end[0]),
-                                     range(start[1], end[1])]
-                
-                orient_tile = orient_array[range(start[0], end[0]),
-                                           range(start[1], end[1])]
-                
-                ret_pixel, orient_pixel = calculate_retardance_over_area(
-                        ret_tile, orient_tile)
-                
-                down_ret_array[tile_number[0], tile_number[1]] = ret_pixel
-                down_orient_array[tile_number[0], tile_number[1]] = orient_pixel
+        down_ret_array, down_orient_array, _ = calculate_tile_statistics(ret_array, orient_array, tile_size,
+                                                                         tile_separation=tile_separation)
         
         down_ret_image = sitk.GetImageFromArray(down_ret_array)
         down_ret_image = sitk.Cast(down_ret_image, ret_image.GetPixelID())
-        down_ret_image.SetMetaData(ret_image.GetMetaData())
+        for key in ret_image.GetMetaDataKeys():
+                down_ret_image.SetMetaData(key, ret_image.GetMetaData(key))
         
         down_orient_image = sitk.GetImageFromArray(down_orient_array)
         down_orient_image = sitk.Cast(down_orient_image, orient_image.GetPixelID())
-        down_orient_image.GetMetaData(orient_image.GetMetaData())
+        for key in orient_image.GetMetaDataKeys():
+                down_orient_image.SetMetaData(key, orient_image.GetMetaData(key))
         
         return down_ret_image, down_orient_image
 
 
+def downsample_retardance_files(ret_image_path, orient_image_path, down_ret_path, down_orient_path,
+                                tile_size, tile_separation=None):
+        down_ret_image, down_orient_image = downsample_retardance_image(ret_image_path, orient_image_path,
+                                                                        tile_size, tile_separation)
+        
+        meta.write_image(down_orient_image, down_orient_path)
+        meta.write_image(down_ret_image, down_ret_path)
+
+
 def batch_downsample_retardance(ret_dir, orient_dir, output_dir,
                                 scale_factor,
-                                simulated_resolution_factor=None):
+                                simulated_resolution_factor=None,
+                                skip_existing_images=False, num_workers=1, memory_limit=None):
         output_suffix = 'DownSample-' + str(scale_factor) + 'x'
         
         if (simulated_resolution_factor
@@ -363,22 +585,25 @@ def batch_downsample_retardance(ret_dir, orient_dir, output_dir,
         (ret_image_path_list, orient_image_path_list) = blk.find_shared_images(
                 ret_dir, orient_dir)
         
-        for i in range(0, np.size(ret_image_path_list)):
-                (down_ret_image, down_orient_image) = downsample_retardance_image(
-                        ret_image_path_list[i], orient_image_path_list[i],
-                        scale_factor, simulated_resolution_factor)
-                
-                down_ret_dir = os.path.join(output_dir, output_suffix, '_ret', )
-                down_orient_dir = os.path.join(output_dir, output_suffix, 'SlowAxis', )
-                
-                down_ret_path = blk.create_new_image_path(ret_image_path_list[i],
+        down_ret_dir = os.path.join(output_dir, output_suffix, '_ret', )
+        down_orient_dir = os.path.join(output_dir, output_suffix, 'SlowAxis', )
+        os.makedirs(down_ret_dir, exist_ok=True)
+        os.makedirs(down_orient_dir, exist_ok=True)
+        
+        tasks = []
+        for ret_path, orient_path in zip(ret_image_path_list, orient_image_path_list):
+                down_ret_path = blk.create_new_image_path(ret_path,
                                                           down_ret_dir,
                                                           '__ret_' + output_suffix)
                 
                 down_orient_path = blk.create_new_image_path(
-                        orient_image_path_list[i],
+                        orient_path,
                         down_orient_dir,
                         '_SlowAxis_' + output_suffix)
                 
-                meta.write_image(down_ret_image, down_ret_path)
-                meta.write_image(down_orient_image, down_orient_path)
+                tasks.append(bulk.BulkTask([ret_path, orient_path], [down_ret_path, down_orient_path],
+                                           (ret_path, orient_path, down_ret_path, down_orient_path,
+                                            scale_factor, simulated_resolution_factor)))
+        
+        bulk.run_bulk(downsample_retardance_files, tasks, num_workers=num_workers, memory_limit=memory_limit,
+                      skip_existing_images=skip_existing_images)
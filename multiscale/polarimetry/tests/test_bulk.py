@@ -0,0 +1,86 @@
+import operator
+import os
+import time
+
+import pytest
+import numpy as np
+import SimpleITK as sitk
+
+import multiscale.polarimetry.bulk as bulk
+import multiscale.polarimetry.retardance as ret
+import multiscale.itk.metadata as meta
+
+
+@pytest.fixture()
+def orientation_dir(tmp_path):
+        input_dir = tmp_path / 'input'
+        input_dir.mkdir()
+        for sample in ['1134-1', '1134-2', '1135-1']:
+                image = sitk.GetImageFromArray((np.random.rand(20, 30)*18000).astype(np.uint16))
+                image.SetMetaData('Unit', 'microns')
+                meta.write_image(image, input_dir / (sample + '_PS_Orient.tif'))
+        return input_dir
+
+
+def exit_on_negative(value):
+        """Kill the worker process without raising, as an aborted native allocation does"""
+        if value < 0:
+                os._exit(1)
+        time.sleep(0.05)
+
+
+class TestRunBulk(object):
+        @pytest.mark.parametrize('num_workers', [1, 2])
+        def test_images_match_serial_conversion(self, orientation_dir, tmp_path, num_workers):
+                output_dir = tmp_path / 'output'
+                output_dir.mkdir()
+                ret.bulk_orientation_to_proper_degrees(orientation_dir, output_dir, 'Proper', num_workers=num_workers)
+
+                for input_path in orientation_dir.glob('*.tif'):
+                        expected = sitk.Divide(meta.setup_image(input_path), 100)
+                        expected = sitk.GetArrayFromImage(ret.rotate_90_degrees(expected))
+                        output_path = output_dir / (input_path.name.split('_')[0] + '_Proper.tif')
+
+                        assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(output_path))), expected)
+                        assert meta.read_metadata(output_path) is not None
+
+                assert not list(output_dir.glob('.tmp-*'))
+
+        def test_existing_outputs_are_skipped(self, tmp_path):
+                input_path, output_path = tmp_path / 'a.npy', tmp_path / 'b.npy'
+                np.save(str(input_path), np.zeros(10))
+                np.save(str(output_path), np.zeros(10))
+                tasks = [bulk.BulkTask([input_path], [output_path], (10,))]
+
+                assert bulk.run_bulk(np.zeros, tasks) == {}
+                assert list(bulk.run_bulk(np.zeros, tasks, skip_existing_images=False)) == ['a.npy']
+
+        @pytest.mark.parametrize('num_workers', [1, 2])
+        def test_failing_image_does_not_stop_others(self, tmp_path, num_workers):
+                tasks = []
+                for name, args in [('bad.npy', ({}, 'missing')), ('good.npy', ({'key': 1}, 'key'))]:
+                        np.save(str(tmp_path / name), np.zeros(10))
+                        tasks.append(bulk.BulkTask([tmp_path / name], [tmp_path / 'missing'], args))
+                
+                timings = bulk.run_bulk(operator.getitem, tasks, num_workers=num_workers)
+                assert list(timings) == ['good.npy']
+        
+        @pytest.mark.skipif(bulk.resource is None, reason='Memory limits need the resource module')
+        def test_memory_limit_fails_only_oversized_image(self, tmp_path):
+                tasks = []
+                for name, size in [('small.npy', 1000), ('huge.npy', 2**40)]:
+                        np.save(str(tmp_path / name), np.zeros(10))
+                        tasks.append(bulk.BulkTask([tmp_path / name], [tmp_path / 'missing'], (size, np.uint8)))
+
+                timings = bulk.run_bulk(np.ones, tasks, num_workers=2, memory_limit=8*2**30)
+                assert list(timings) == ['small.npy']
+        
+        def test_dead_worker_fails_only_its_image(self, tmp_path):
+                tasks = []
+                for idx, value in enumerate([-1, 1, 2, 3, 4, 5]):
+                        name = '{}.npy'.format(idx)
+                        np.save(str(tmp_path / name), np.zeros(10))
+                        tasks.append(bulk.BulkTask([tmp_path / name], [tmp_path / 'missing'], (value,)))
+                
+                timings = bulk.run_bulk(exit_on_negative, tasks, num_workers=2)
+                assert sorted(timings) == ['1.npy', '2.npy', '3.npy', '4.npy', '5.npy']
@@ -85,4 +85,247 @@
 #                         inputImg, deg_output = False, nm_input = False), outputImg)
 #
 # if __name__ == '__main__':
-#         unittest.main(verbosity=2)
\ No newline at end of file
+#         unittest.main(verbosity=2)
+
+import pytest
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+import multiscale.polarimetry.retardance as ret
+import multiscale.itk.metadata as meta
+import multiscale.tiling as til
+
+
+@pytest.fixture()
+def ret_orient_arrays():
+        ret_array = np.random.rand(61, 53)*35
+        orient_array = np.random.rand(61, 53)*180
+        orient_array[:10, :10] = 0
+        return ret_array, orient_array
+
+
+class TestCalculateTileStatistics(object):
+        @pytest.mark.parametrize('tile_size, tile_separation', [
+                ([8, 8], None),
+                ([10, 10], [4, 6]),
+                ([5, 7], [9, 9]),
+        ])
+        def test_tiles_match_per_tile_functions(self, ret_orient_arrays, tile_size, tile_separation):
+                ret_array, orient_array = ret_orient_arrays
+                tile_size = np.array(tile_size)
+                if tile_separation is not None:
+                        tile_separation = np.array(tile_separation)
+                
+                retardance, orientation, alignment = ret.calculate_tile_statistics(ret_array, orient_array,
+                                                                                   tile_size, tile_separation)
+                
+                num_tiles, offset = til.calculate_number_of_tiles(np.shape(ret_array), tile_size, tile_separation)
+                assert np.shape(retardance) == tuple(num_tiles)
+                for start, end, number in til.generate_tile_start_end_index(num_tiles, tile_size, tile_offset=offset,
+                                                                            tile_separation=tile_separation):
+                        ret_tile = ret_array[start[0]:end[0], start[1]:end[1]]
+                        orient_tile = orient_array[start[0]:end[0], start[1]:end[1]]
+                        expected = ret.calculate_retardance_over_area(ret_tile, orient_tile)
+                        
+                        assert retardance[tuple(number)] == pytest.approx(expected[0], rel=1E-9)
+                        assert orientation[tuple(number)] == pytest.approx(expected[1], rel=1E-9)
+                        assert alignment[tuple(number)] == pytest.approx(ret.calculate_alignment(orient_tile),
+                                                                         rel=1E-9, nan_ok=True)
+        
+        def test_rois_match_per_roi_functions(self, ret_orient_arrays):
+                ret_array, orient_array = ret_orient_arrays
+                tile_size, roi_size = np.array([20, 20]), np.array([6, 6])
+                
+                retardance, orientation, alignment = ret.calculate_tile_statistics(ret_array, orient_array,
+                                                                                   tile_size, roi_size=roi_size)
+                assert np.shape(retardance) == (3, 2, 3, 3)
+                
+                num_rois, roi_offset = til.calculate_number_of_tiles(tile_size, roi_size)
+                tiles = til.generate_tile(ret_array, tile_size)
+                orient_tiles = til.generate_tile(orient_array, tile_size)
+                for (ret_tile, number), (orient_tile, _) in zip(tiles, orient_tiles):
+                        for start, end, roi in til.generate_tile_start_end_index(num_rois, roi_size,
+                                                                                 tile_offset=roi_offset):
+                                ret_roi = ret_tile[start[0]:end[0], start[1]:end[1]]
+                                orient_roi = orient_tile[start[0]:end[0], start[1]:end[1]]
+                                index = tuple(number) + tuple(roi)
+                                expected = ret.calculate_retardance_over_area(ret_roi, orient_roi)
+                                
+                                assert retardance[index] == pytest.approx(expected[0], rel=1E-9)
+                                assert orientation[index] == pytest.approx(expected[1], rel=1E-9)
+                                assert alignment[index] == pytest.approx(ret.calculate_alignment(orient_roi),
+                                                                         rel=1E-9, nan_ok=True)
+        
+        @pytest.mark.parametrize('tile_separation, summed_area', [(None, False), ([2, 2], False), ([2, 2], True)])
+        def test_image_smaller_than_tile_gives_no_tiles(self, ret_orient_arrays, tile_separation, summed_area):
+                ret_array, orient_array = ret_orient_arrays
+                if tile_separation is not None:
+                        tile_separation = np.array(tile_separation)
+                
+                output = ret.calculate_tile_statistics(ret_array, orient_array, np.array([64, 64]), tile_separation,
+                                                       summed_area=summed_area)
+                for array in output:
+                        assert np.shape(array) == (0, 0)
+        
+        def test_roi_larger_than_tile_gives_no_rois(self, ret_orient_arrays):
+                ret_array, orient_array = ret_orient_arrays
+                output = ret.calculate_tile_statistics(ret_array, orient_array, np.array([20, 20]),
+                                                       roi_size=np.array([30, 30]))
+                for array in output:
+                        assert np.shape(array) == (3, 2, 0, 0)
+        
+        @pytest.mark.parametrize('tile_separation', [[4, 4], [1, 1], [3, 5]])
+        def test_summed_area_tables_match_direct_sums(self, ret_orient_arrays, tile_separation):
+                ret_array, orient_array = ret_orient_arrays
+                tile_size, tile_separation = np.array([12, 12]), np.array(tile_separation)
+                
+                direct = ret.calculate_tile_statistics(ret_array, orient_array, tile_size, tile_separation,
+                                                       summed_area=False)
+                summed = ret.calculate_tile_statistics(ret_array, orient_array, tile_size, tile_separation,
+                                                       summed_area=True)
+                
+                for expected, output in zip(direct, summed):
+                        assert np.allclose(output, expected, rtol=1E-9, equal_nan=True)
+
+
+class TestSummedAreaTable(object):
+        @pytest.mark.parametrize('tile_size, tile_separation', [([7, 5], None), ([7, 5], [2, 3]), ([4, 4], [6, 6])])
+        def test_tile_sums_match_tile_view(self, tile_size, tile_separation):
+                array = np.random.rand(40, 33)
+                table = til.summed_area_table(array)
+                
+                expected = np.sum(til.tile_view(array, tile_size, tile_separation), axis=(-2, -1))
+                assert np.allclose(til.tile_sums_from_table(table, tile_size, tile_separation), expected)
+        
+        @pytest.mark.parametrize('tile_separation, strip_rows', [([2, 3], 1), ([2, 3], 7), ([6, 6], 12), (None, 1024)])
+        def test_strips_match_whole_table(self, tile_separation, strip_rows):
+                array = np.random.rand(40, 33) + 1j*np.random.rand(40, 33)
+                expected = til.tile_sums_from_table(til.summed_area_table(array), [7, 5], tile_separation)
+                
+                output = til.tile_sums_from_strips(array, [7, 5], tile_separation, strip_rows=strip_rows)
+                assert output.dtype == expected.dtype
+                assert np.allclose(output, expected)
+        
+        def test_strips_of_image_smaller_than_tile_are_empty(self):
+                assert np.shape(til.tile_sums_from_strips(np.random.rand(10, 40), [12, 12], [2, 2])) == (0, 10)
+        
+        def test_counts_are_exact(self):
+                array = np.random.rand(40, 33) > 0.5
+                table = til.summed_area_table(array)
+                
+                assert table.dtype == np.int64
+                assert table[-1, -1] == np.count_nonzero(array)
+
+
+class TestTileStatisticsTable(object):
+        def test_roi_rows_have_integer_indices(self):
+                retardance = np.random.rand(2, 3, 4, 5)
+                table = ret.tile_statistics_table(retardance, retardance + 1, retardance + 2, '1134', '2', 'PS-O')
+                
+                assert len(table) == retardance.size
+                for column in ['Tile X', 'Tile Y', 'ROI X', 'ROI Y']:
+                        assert np.issubdtype(table[column].dtype, np.integer)
+                
+                row = table[(table['Tile X'] == 1) & (table['Tile Y'] == 2) & (table['ROI X'] == 3)
+                            & (table['ROI Y'] == 4)]
+                assert row['Retardance'].item() == retardance[1, 2, 3, 4]
+                assert row['Alignment'].item() == retardance[1, 2, 3, 4] + 2
+                assert set(table['Modality']) == {'PS-O'}
+        
+        def test_tile_rows_have_no_roi_columns(self):
+                table = ret.tile_statistics_table(*np.random.rand(3, 4, 6), '1134', '2', 'MHR-O')
+                
+                assert 'ROI X' not in table.columns
+                assert list(table['Tile Y'][:6]) == list(range(6))
+        
+        def test_dataset_appends_partitions(self, tmp_path):
+                pytest.importorskip('pyarrow')
+                dataset_path = tmp_path / 'PS_512_64.parquet'
+                for modality in ['PS-O', 'MHR-O']:
+                        table = ret.tile_statistics_table(*np.random.rand(3, 2, 2, 2, 2), '1134', '2', modality)
+                        ret.write_tile_statistics(table, dataset_path)
+                
+                assert ret.has_tile_statistics(dataset_path, '1134', '2', 'PS-O')
+                assert not ret.has_tile_statistics(dataset_path, '1134', '3', 'PS-O')
+                
+                output = ret.read_tile_statistics(dataset_path, columns=['Modality', 'Retardance'],
+                                                  filters=[('Modality', '==', 'MHR-O')])
+                assert list(output.columns) == ['Modality', 'Retardance']
+                assert len(output) == 16
+        
+        def test_rewriting_partition_replaces_rows(self, tmp_path):
+                pytest.importorskip('pyarrow')
+                dataset_path = tmp_path / 'PS_512_64.parquet'
+                for _ in range(2):
+                        table = ret.tile_statistics_table(*np.random.rand(3, 2, 2, 2, 2), '1134', '2', 'PS-O')
+                        ret.write_tile_statistics(table, dataset_path)
+                
+                output = ret.read_tile_statistics(dataset_path)
+                assert len(output) == 16
+                assert np.array_equal(output.sort_values(['Tile X', 'Tile Y', 'ROI X', 'ROI Y'])['Retardance'],
+                                      table['Retardance'])
+                assert not [path for path in dataset_path.iterdir() if path.name.startswith('.')]
+        
+        def test_zero_padded_ids_are_kept(self, tmp_path):
+                pytest.importorskip('pyarrow')
+                dataset_path = tmp_path / 'PS_512.parquet'
+                for mouse in ['01', '10']:
+                        table = ret.tile_statistics_table(*np.random.rand(3, 2, 2), mouse, '002', 'PS-O')
+                        ret.write_tile_statistics(table, dataset_path)
+                
+                output = ret.read_tile_statistics(dataset_path, filters=[('Mouse', '==', '01')])
+                assert len(output) == 4
+                assert set(output['Mouse']) == {'01'}
+                assert set(output['Slide']) == {'002'}
+
+
+class TestProcessPsImagePair(object):
+        @pytest.fixture()
+        def ps_dirs(self, tmp_path):
+                dirs = [tmp_path / name for name in ['intensity', 'orient', 'ret', 'degrees']]
+                for directory in dirs:
+                        directory.mkdir()
+                
+                intensity = (np.random.rand(48, 40)*65535).astype(np.uint16)
+                orientation = (np.random.rand(48, 40)*18000).astype(np.uint16)
+                orientation[:4, :4] = 9000
+                for directory, array, name in [(dirs[0], intensity, '1134-2_PS.tif'),
+                                               (dirs[1], orientation, '1134-2_PS_Orient.tif')]:
+                        image = sitk.GetImageFromArray(array)
+                        image.SetMetaData('Unit', 'microns')
+                        meta.write_image(image, directory / name)
+                
+                return dirs
+        
+        def test_matches_conversion_through_files(self, ps_dirs):
+                intensity_dir, orient_dir, ret_dir, degrees_dir = ps_dirs
+                tile_size, roi_size = np.array([16, 16]), np.array([4, 4])
+                
+                ret.bulk_intensity_to_retardance(intensity_dir, ret_dir, 'PS_Ret')
+                ret.bulk_orientation_to_proper_degrees(orient_dir, degrees_dir, 'PS_Orient')
+                ret_array = sitk.GetArrayFromImage(sitk.ReadImage(str(ret_dir / '1134-2_PS_Ret.tif')))
+                orient_array = sitk.GetArrayFromImage(sitk.ReadImage(str(degrees_dir / '1134-2_PS_Orient.tif')))
+                expected = ret.tile_statistics_table(*ret.calculate_tile_statistics(ret_array, orient_array, tile_size,
+                                                                                    roi_size=roi_size),
+                                                     '1134', '2', 'PS-O')
+                
+                output_ret, output_orient = ret_dir / 'fused_ret.tif', degrees_dir / 'fused_orient.tif'
+                table = ret.process_ps_image_pair(intensity_dir / '1134-2_PS.tif', orient_dir / '1134-2_PS_Orient.tif',
+                                                  None, tile_size, roi_size=roi_size,
+                                                  ret_output_path=output_ret, orient_output_path=output_orient)
+                
+                pd.testing.assert_frame_equal(table, expected)
+                assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(output_ret))), ret_array)
+                assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(output_orient))), orient_array)
+        
+        @pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+        def test_orientation_matches_itk_division_and_rotation(self, dtype):
+                orientation = (np.random.rand(30, 20)*18000).astype(dtype)
+                orientation[0, :3] = [9000, 9099, 9100]
+                
+                expected = ret.rotate_90_degrees(sitk.Divide(sitk.GetImageFromArray(orientation), 100))
+                output = ret.orientation_to_proper_degrees(orientation.copy())
+                
+                assert output.dtype == dtype
+                assert np.allclose(output, sitk.GetArrayFromImage(expected), rtol=1E-6, atol=0)
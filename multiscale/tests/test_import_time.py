@@ -0,0 +1,59 @@
+import pytest
+import subprocess
+import sys
+from pathlib import Path
+
+import multiscale
+
+
+deferred_modules = ['matplotlib', 'ipywidgets', 'IPython', 'bioformats', 'javabridge', 'imagej', 'jnius']
+
+
+def run_import(module: str, *args) -> subprocess.CompletedProcess:
+        """Import a module in a fresh interpreter, printing the name of every module loaded"""
+        root = Path(multiscale.__file__).parent.parent
+        script = 'import sys, {}; print("\\n".join(sys.modules))'.format(module)
+        return subprocess.run([sys.executable] + list(args) + ['-c', script], cwd=str(root), stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def modules_after_import(module: str) -> set:
+        """Import a module in a fresh interpreter and get the top level names of every module it loaded"""
+        return {name.split('.')[0] for name in run_import(module).stdout.splitlines()}
+
+
+def import_times(module: str) -> dict:
+        """Import a module in a fresh interpreter and get the cumulative import time of each module, in seconds"""
+        times = {}
+        for line in run_import(module, '-X', 'importtime').stderr.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                        continue
+                _, cumulative, name = line.split('|')
+                times[name.strip()] = int(cumulative) / 1E6
+
+        return times
+
+
+@pytest.mark.parametrize('module', [
+        'multiscale.ultrasound.reconstruction',
+        'multiscale.itk.registration',
+        'multiscale.polarimetry.retardance'
+])
+def test_heavy_modules_are_not_imported(module):
+        loaded = modules_after_import(module)
+
+        assert 'multiscale' in loaded
+        assert not loaded.intersection(deferred_modules)
+
+
+# Budgets are several times the usual import time, so they catch regressions such as an eager heavy import without
+# failing on a busy machine
+@pytest.mark.parametrize('module, budget', [
+        ('multiscale.ultrasound.reconstruction', 4),
+        ('multiscale.itk.registration', 5),
+        ('multiscale.polarimetry.retardance', 10)
+])
+def test_import_time_budget(module, budget):
+        times = import_times(module)
+
+        assert times[module] < budget
@@ -4,6 +4,8 @@ import json
 from pathlib import Path
 import os
 import numpy as np
+import h5py
+import scipy.io as sio
 
 
 @pytest.fixture()
@@ -225,4 +227,121 @@ class TestListValuesApproxEqual(object):
                 ([1, 1.0001, 1.0002], 1E-5, False)
         ])
         def test_values_approx_equal(self, num_list, rel_tol, expected):
-                assert util.list_values_approx_equal(num_list, rel_tol) == expected
\ No newline at end of file
+                assert util.list_values_approx_equal(num_list, rel_tol) == expected
+
+class TestAtomicWrite(object):
+        def test_file_is_moved_into_place(self, tmpdir):
+                output_path = Path(tmpdir, 'out.txt')
+                with util.atomic_write(output_path) as temp_path:
+                        assert temp_path.suffix == '.txt'
+                        temp_path.write_text('new')
+                        assert not output_path.exists()
+                
+                assert output_path.read_text() == 'new'
+                assert os.listdir(str(tmpdir)) == ['out.txt']
+
+        def test_failed_write_keeps_original(self, tmpdir):
+                output_path = Path(tmpdir, 'out.txt')
+                output_path.write_text('old')
+                with pytest.raises(RuntimeError):
+                        with util.atomic_write(output_path) as temp_path:
+                                temp_path.write_text('partial')
+                                raise RuntimeError
+                
+                assert output_path.read_text() == 'old'
+                assert os.listdir(str(tmpdir)) == ['out.txt']
+
+
+class TestMatlabHDF5Array(object):
+        @pytest.fixture()
+        def hdf5_mat(self, tmpdir):
+                """Write arrays the way MATLAB v7.3 does: reversed axes, and complex values as a real/imag compound"""
+                complex_array = np.random.rand(4, 5, 3) + 1j*np.random.rand(4, 5, 3)
+                real_array = np.random.rand(4, 5).astype(np.float32)
+                compound = np.dtype([('real', np.float64), ('imag', np.float64)])
+                stored = np.empty(complex_array.T.shape, dtype=compound)
+                stored['real'] = complex_array.T.real
+                stored['imag'] = complex_array.T.imag
+                
+                mat_path = Path(tmpdir, 'test.mat')
+                with h5py.File(str(mat_path), 'w') as file:
+                        file['IQData'] = stored
+                        file['Real'] = real_array.T
+                        file.create_group('P')['a'] = np.array([[1.0]])
+                
+                return mat_path, complex_array, real_array
+        
+        def test_complex_array_in_matlab_order(self, hdf5_mat):
+                mat_path, complex_array, _ = hdf5_mat
+                with util.MatlabHDF5Array(mat_path, 'IQData') as array:
+                        assert array.shape == complex_array.shape
+                        assert array.dtype == np.complex128
+                        assert (array[()] == complex_array).all()
+        
+        @pytest.mark.parametrize('key', [(slice(None), slice(None), 1), (2,), (Ellipsis, 0), (slice(1, 3), 4)])
+        def test_hyperslab_matches_full_array(self, hdf5_mat, key):
+                mat_path, complex_array, _ = hdf5_mat
+                with util.MatlabHDF5Array(mat_path, 'IQData') as array:
+                        assert (array[key] == complex_array[key]).all()
+        
+        def test_real_array(self, hdf5_mat):
+                mat_path, _, real_array = hdf5_mat
+                with util.MatlabHDF5Array(mat_path, 'Real') as array:
+                        assert array.dtype == np.float32
+                        assert (np.asarray(array) == real_array).all()
+        
+        def test_integer_complex_array_is_cast(self, tmpdir):
+                complex_array = (np.arange(24).reshape(2, 3, 4) + 1j*np.arange(24, 48).reshape(2, 3, 4))
+                stored = np.empty(complex_array.T.shape, dtype=[('real', np.int16), ('imag', np.int16)])
+                stored['real'] = complex_array.T.real
+                stored['imag'] = complex_array.T.imag
+                
+                mat_path = Path(tmpdir, 'int.mat')
+                with h5py.File(str(mat_path), 'w') as file:
+                        file['IQData'] = stored
+                
+                with util.MatlabHDF5Array(mat_path, 'IQData') as array:
+                        assert array.dtype == np.complex64
+                        assert (array[()] == complex_array).all()
+                        assert (array[1, :, 2] == complex_array[1, :, 2]).all()
+        
+        def test_struct_raises_not_implemented(self, hdf5_mat):
+                with pytest.raises(NotImplementedError):
+                        util.MatlabHDF5Array(hdf5_mat[0], 'P')
+        
+        def test_load_mat_reads_only_requested_variable(self, hdf5_mat):
+                mat_path, complex_array, _ = hdf5_mat
+                output = util.load_mat(mat_path, 'IQData')
+                assert list(output.keys()) == ['IQData']
+                assert (output['IQData'] == complex_array).all()
+        
+        def test_struct_is_read_with_load_mat(self, hdf5_mat):
+                output = util.load_mat(hdf5_mat[0], 'P')
+                assert list(output) == ['P']
+                assert output['P']['a'] == 1.0
+        
+        def test_whos_mat_lists_shapes_in_matlab_order(self, hdf5_mat):
+                mat_path, complex_array, real_array = hdf5_mat
+                output = util.whos_mat(mat_path)
+                assert output['IQData'][0] == complex_array.shape
+                assert output['Real'][0] == real_array.shape
+                assert 'P' in output
+
+
+def test_whos_mat_v5(tmpdir):
+        mat_path = Path(tmpdir, 'test.mat')
+        sio.savemat(str(mat_path), {'IQData': np.ones([6, 5, 3], dtype=complex), 'P': {'a': 1}})
+        output = util.whos_mat(mat_path)
+        assert output['IQData'] == ((6, 5, 3), 'double')
+        assert output['P'] == ((1, 1), 'struct')
+
+
+class TestLazyImport(object):
+        def test_module_is_imported_on_first_use(self):
+                imported = []
+                module = util.lazy_import('json', on_import=imported.append)
+                assert imported == []
+                
+                assert module.dumps([1]) == '[1]'
+                module.loads('1')
+                assert imported == [json]
@@ -57,6 +57,130 @@ def generate_tile(input_array, tile_size, tile_separation=None):
                 yield input_array[start[0]:end[0], start[1]:end[1]], tile_number
 
 
+def tile_view(input_array, tile_size, tile_separation=None, axes=(0, 1)) -> np.ndarray:
+        """
+        View the tiles of generate_tile as one array, without copying.
+        
+        The two tiled axes are replaced by the tile number along each, and the tile pixels are appended as the last
+        two axes, e.g. a [Y, X] image becomes [tiles_y, tiles_x, tile_y, tile_x].  Tiles may overlap or be spread
+        apart by tile_separation.
+        :param input_array: Array to tile
+        :param tile_size: Size of the tiles along the two axes
+        :param tile_separation: Distance between the starts of neighbouring tiles.  Default is tile_size
+        :param axes: The two axes to tile
+        :return: Read-only view of the tiles.  It has no tiles along an axis where none fit, e.g. when the image is
+        smaller than a tile
+        """
+        input_array = np.asarray(input_array)
+        tile_size = np.array(tile_size)
+        if tile_separation is None:
+                tile_separation = tile_size
+        tile_separation = np.array(tile_separation)
+        
+        image_dimens = [np.shape(input_array)[axis] for axis in axes]
+        total_num_tiles, tile_offset = calculate_number_of_tiles(image_dimens, tile_size, tile_separation)
+        
+        # Strided by hand rather than with sliding_window_view, which needs numpy 1.20
+        shape = list(input_array.shape)
+        strides = list(input_array.strides)
+        start = [slice(None)]*input_array.ndim
+        for i, axis in enumerate(axes):
+                shape[axis] = max(total_num_tiles[i], 0)
+                strides[axis] = input_array.strides[axis]*int(tile_separation[i])
+                if shape[axis] > 0:
+                        start[axis] = slice(tile_offset[i], None)
+        
+        shape += [int(size) for size in tile_size]
+        strides += [input_array.strides[axis] for axis in axes]
+        
+        return np.lib.stride_tricks.as_strided(input_array[tuple(start)], shape=shape, strides=strides,
+                                               writeable=False)
+
+
+def summed_area_table(input_array, dtype=None) -> np.ndarray:
+        """
+        Get the integral image of a 2D array, padded with a leading row and column of zeros so that table[y, x] is the
+        sum of input_array[:y, :x]
+        :param input_array: 2D array to integrate
+        :param dtype: Type to accumulate in.  Default is float64 or complex128 for floating point input, and int64
+        otherwise, so large images keep their precision
+        :return: The summed-area table
+        """
+        if dtype is None:
+                if np.issubdtype(np.asarray(input_array).dtype, np.inexact):
+                        dtype = np.result_type(input_array, np.float64)
+                else:
+                        dtype = np.int64
+        
+        table = np.zeros([size + 1 for size in np.shape(input_array)], dtype=dtype)
+        np.cumsum(input_array, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+
+def tile_sums_from_table(table: np.ndarray, tile_size, tile_separation=None) -> np.ndarray:
+        """
+        Sum every tile of generate_tile from a summed-area table, with four lookups per tile whatever its size
+        :param table: Summed-area table of the image, from summed_area_table
+        :param tile_size: Size of the tiles along each axis
+        :param tile_separation: Distance between the starts of neighbouring tiles.  Default is tile_size
+        :return: Array of [tiles_y, tiles_x] sums
+        """
+        image_dimens = [size - 1 for size in np.shape(table)]
+        starts = _tile_starts(image_dimens, tile_size, tile_separation)
+        
+        return _sums_from_table(table, starts, tile_size)
+
+
+def tile_sums_from_strips(input_array, tile_size, tile_separation=None, strip_rows: int=1024) -> np.ndarray:
+        """
+        Sum every tile of generate_tile from summed-area tables of strips of tile rows, as tile_sums_from_table does
+        from a table of the whole image.
+        
+        A table takes 8 or 16 bytes per pixel, so only a strip of about strip_rows + tile_size[0] rows is held at
+        once.  Rows covered by two strips are integrated twice.
+        :param input_array: 2D array to sum
+        :param tile_size: Size of the tiles along each axis
+        :param tile_separation: Distance between the starts of neighbouring tiles.  Default is tile_size
+        :param strip_rows: Approximate number of image rows integrated at a time
+        :return: Array of [tiles_y, tiles_x] sums, of the type summed_area_table accumulates in
+        """
+        tile_size = np.array(tile_size)
+        if tile_separation is None:
+                tile_separation = tile_size
+        tile_separation = np.array(tile_separation)
+        
+        starts = _tile_starts(np.shape(input_array), tile_size, tile_separation)
+        tiles_per_strip = max(1, strip_rows // int(tile_separation[0]))
+        
+        strips = [np.zeros([0, len(starts[1])], dtype=summed_area_table(input_array[:0, :0]).dtype)]
+        for first in range(0, len(starts[0]), tiles_per_strip):
+                strip_starts = starts[0][first:first + tiles_per_strip]
+                top, bottom = strip_starts[0], strip_starts[-1] + int(tile_size[0])
+                table = summed_area_table(input_array[top:bottom])
+                strips.append(_sums_from_table(table, [strip_starts - top, starts[1]], tile_size))
+        
+        return np.concatenate(strips)
+
+
+def _tile_starts(image_dimens, tile_size, tile_separation=None) -> list:
+        """Get the first index of every tile of generate_tile along each of the two axes"""
+        tile_size = np.array(tile_size)
+        if tile_separation is None:
+                tile_separation = tile_size
+        tile_separation = np.array(tile_separation)
+        
+        total_num_tiles, tile_offset = calculate_number_of_tiles(image_dimens, tile_size, tile_separation)
+        return [tile_offset[i] + np.arange(max(total_num_tiles[i], 0))*int(tile_separation[i]) for i in range(2)]
+
+
+def _sums_from_table(table: np.ndarray, starts: list, tile_size) -> np.ndarray:
+        """Sum the tiles starting at every pair of starts from a summed-area table"""
+        ends = [starts[i] + int(tile_size[i]) for i in range(2)]
+        return (table[np.ix_(ends[0], ends[1])] - table[np.ix_(starts[0], ends[1])]
+                - table[np.ix_(ends[0], starts[1])] + table[np.ix_(starts[0], starts[1])])
+
+
 def calculate_number_of_tiles(size_of_image_dimension, tile_size,
                               tile_separation=None):
         """Calculate the number of tiles that fit along an image dimension,
@@ -0,0 +1,213 @@
+"""
+Cache of decoded Verasonics acquisitions, so a scan is only parsed from its .mat files once
+
+Copyright (c) 2018, Michael Pinkert
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Laboratory for Optical and Computational Instrumentation nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+import scipy.io as sio
+
+import multiscale.utility_functions as util
+
+
+class AcquisitionCache(object):
+        def __init__(self, mat_list: list, cache_path: Path, pl_path: Path=None, compression=None):
+                """
+                Store the decoded frames of a Verasonics acquisition, along with the P parameter struct and the position
+                list, in a single HDF5 file.
+
+                Each variable (e.g. IQData or RData) is converted from the .mat files the first time it is requested.
+                The whole cache is rebuilt whenever a source file is added, removed, or changes size or modification
+                time.  Frames are stored with every axis, as scipy.io.loadmat reads them without squeeze_me.
+                :param mat_list: Sorted list of the .mat files of the acquisition
+                :param cache_path: Path of the HDF5 cache file
+                :param pl_path: Path to the position list of the acquisition
+                :param compression: HDF5 compression filter, with one chunk per frame, e.g. 'lzf' to roughly halve the
+                size of IQ data on disk.  Default stores the frames uncompressed and contiguous, so reopened caches are
+                memory-mapped directly instead of decompressed on every read.
+                """
+                self.mat_list = [Path(path) for path in mat_list]
+                self.cache_path = Path(cache_path)
+                self.pl_path = pl_path
+                self.compression = compression
+                self._file = None
+
+        def is_valid(self) -> bool:
+                """Check that the cache exists and was built from the current source files"""
+                if not self.cache_path.is_file():
+                        return False
+
+                try:
+                        with h5py.File(str(self.cache_path), 'r') as file:
+                                manifest = json.loads(file.attrs['manifest'])
+                except (OSError, KeyError):
+                        return False
+
+                return manifest == self._manifest()
+
+        def get_parameters(self) -> dict:
+                """Get the raw P parameter struct of the first .mat file"""
+                return json.loads(self._open().attrs['params'])
+
+        def get_positions(self):
+                """Get the contents of the position list file, or None if the acquisition has no position list"""
+                return json.loads(self._open().attrs['positions'])
+
+        def get_frames(self, variable: str='IQData'):
+                """
+                Get the frames of a variable, stacked along the first axis in .mat list order.  Frames are read from
+                disk only when indexed.
+                :param variable: The variable to read from each .mat file
+                :return: A memory-mapped array for uncompressed caches, otherwise an h5py dataset
+                """
+                file = self._open()
+                if variable not in file['frames']:
+                        self._add_variable(variable)
+                        file = self._open()
+
+                dataset = file['frames'][variable]
+                offset = dataset.id.get_offset()
+                if dataset.chunks is None and offset is not None:
+                        return np.memmap(str(self.cache_path), dtype=dataset.dtype, mode='r',
+                                         offset=offset, shape=dataset.shape)
+
+                return dataset
+
+        def _open(self):
+                """Open the cache for reading, rebuilding it first if it is missing or stale"""
+                if self._file is None:
+                        if not self.is_valid():
+                                self._build()
+                        self._file = h5py.File(str(self.cache_path), 'r')
+
+                return self._file
+
+        def _build(self):
+                """Start a new cache holding the parameters and positions of the acquisition"""
+                print('Building acquisition cache {}'.format(self.cache_path))
+                os.makedirs(str(self.cache_path.parent), exist_ok=True)
+
+                params_raw = util.load_mat(self.mat_list[0], 'P')['P']
+                if self.pl_path is not None:
+                        pos_text = util.read_json(self.pl_path)
+                else:
+                        pos_text = None
+
+                with util.atomic_write(self.cache_path) as temp_path:
+                        with h5py.File(str(temp_path), 'w') as file:
+                                file.create_group('frames')
+                                file.attrs['params'] = json.dumps(params_raw, default=_to_json)
+                                file.attrs['positions'] = json.dumps(pos_text)
+                                file.attrs['manifest'] = json.dumps(self._manifest())
+
+        def _add_variable(self, variable: str):
+                """
+                Convert a variable from the .mat files into the cache, one frame at a time.  The dataset is only
+                given its final name once every frame is written.
+                """
+                print('Caching {} from {} .mat files'.format(variable, len(self.mat_list)))
+                self.close()
+
+                temp_name = '.tmp-' + variable
+                with h5py.File(str(self.cache_path), 'a') as file:
+                        frames = file['frames']
+                        if temp_name in frames:
+                                del frames[temp_name]
+
+                        dataset = None
+                        for idx, mat_path in enumerate(self.mat_list):
+                                frame = _read_variable(mat_path, variable)
+                                if dataset is None:
+                                        dataset = self._create_dataset(frames, temp_name, frame)
+                                dataset[idx] = frame
+
+                        frames.move(temp_name, variable)
+
+        def _create_dataset(self, group, name, frame):
+                shape = (len(self.mat_list),) + np.shape(frame)
+                if self.compression is None:
+                        return group.create_dataset(name, shape=shape, dtype=frame.dtype)
+
+                return group.create_dataset(name, shape=shape, dtype=frame.dtype, chunks=(1,) + np.shape(frame),
+                                            compression=self.compression)
+
+        def _manifest(self) -> list:
+                """List the name, size and modification time of every source file"""
+                sources = list(self.mat_list)
+                if self.pl_path is not None:
+                        sources.append(Path(self.pl_path))
+
+                manifest = []
+                for path in sources:
+                        stat = path.stat()
+                        manifest.append([path.name, stat.st_size, stat.st_mtime_ns])
+
+                return manifest
+
+        def close(self):
+                if self._file is not None:
+                        self._file.close()
+                        self._file = None
+
+        def __enter__(self):
+                return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+                self.close()
+
+
+def cache_path_for(cache_dir: Path, mat_dir: Path, search_str: str='.mat') -> Path:
+        """
+        Get the cache file for the .mat files in a directory.  The name includes a hash of the full directory path and
+        search string, so acquisitions in identically named run directories do not share a cache.
+        """
+        key = str(Path(mat_dir).resolve()) + '|' + search_str
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        return Path(cache_dir, '{}_{}.h5'.format(Path(mat_dir).name, digest))
+
+
+def _to_json(value):
+        """Convert the numpy values of a loaded .mat struct into types json can write"""
+        if isinstance(value, np.generic):
+                return value.item()
+        if isinstance(value, np.ndarray):
+                return value.tolist()
+
+        raise TypeError('{} cannot be written to json'.format(type(value)))
+
+
+def _read_variable(mat_path: Path, variable: str) -> np.ndarray:
+        """Read a variable without squeezing its singleton axes, as reconstruction.open_iq and open_rf do"""
+        if h5py.is_hdf5(str(mat_path)):
+                with util.MatlabHDF5Array(mat_path, variable) as array:
+                        return array[()]
+
+        return sio.loadmat(str(mat_path), variable_names=[variable])[variable]
@@ -30,56 +30,138 @@ import scipy.sparse as sp
 import scipy.signal as sig
 from pathlib import Path
 from tqdm import tqdm
+import hashlib
+import json
+import os
 
 import multiscale.utility_functions as util
-import multiscale.ultrasound.reconstruction as recon
+import multiscale.ultrasound.conversion as conv
+
+
+# Parameters that determine the delay matrix.  Other acquisition parameters do not change the beamforming geometry.
+DELAY_PARAMETERS = ('axial samples', 'lines', 'time samples', 'elements', 'transmit samples',
+                    'axial resolution', 'lateral resolution', 'transducer spacing', 'start depth',
+                    'sampling frequency', 'speed of sound')
 
 
 class Beamformer(object):
         def __init__(self, rf_array: np.ndarray, params: dict, delays):
+                """
+                Delay-and-sum beamforming of Verasonics RF data
+                :param rf_array: RF data for one frame, [time X element], or a stack of frames, [frame X time X element]
+                :param params: Acquisition parameters
+                :param delays: Delay matrix from DelayCalculator
+                """
                 self.rf_array = rf_array
                 self.params = params
                 self.delays = delays
                 self.rf_vector = None
+                self.rf_matrix = None
                 
                 self._format_rf()
                 
         def _format_rf(self):
                 """
-                Reformat the rf data so that the rf data is interleaved properly and in a vector
+                Reformat the rf data so that the rf data is interleaved properly and in a vector.  Stacks of frames
+                are reformatted into one matrix with a column per frame.
                 :return:
                 """
                 # Verasonics RF array is composed of two interleaved samples; however, the temporally first sample
                 # occurs in the second half of the array.  This part corrects the array so that samples are interleaved
                 # properly.
-                temp_array = np.zeros(np.shape(self.rf_array))
+                rf_stack = self._rf_stack()
+                num_frames, num_time, num_elements = np.shape(rf_stack)
                 half_time = int(self.params['time samples'] / 2)
+                
+                # Each column is a frame flattened in Fortran order, i.e. element-major, so the buffer is filled as
+                # [element X time X frame] through transposed views of the stack.
+                interleaved = np.empty([num_elements, num_time, num_frames])
+                interleaved[:, ::2] = np.transpose(rf_stack[:, half_time:], [2, 1, 0])
+                interleaved[:, 1::2] = np.transpose(rf_stack[:, :half_time], [2, 1, 0])
+                
+                self.rf_matrix = np.reshape(interleaved, [num_elements*num_time, num_frames])
+                if np.ndim(self.rf_array) == 2:
+                        self.rf_vector = self.rf_matrix[:, 0]
         
-                temp_array[::2] = self.rf_array[half_time:]
-                temp_array[1::2] = self.rf_array[:half_time]
-        
-                self.rf_vector = temp_array.flatten('F')
+        def _rf_stack(self) -> np.ndarray:
+                """Get the RF data as a [frame X time X element] stack"""
+                if np.ndim(self.rf_array) == 2:
+                        return self.rf_array[None]
+                elif np.ndim(self.rf_array) == 3:
+                        return self.rf_array
+                else:
+                        raise ValueError('RF data must be a single 2D frame or a 3D stack of frames')
                 
         def get_bmode(self):
-                summation = self.delays @ self.rf_vector
-                rf = np.reshape(summation, [self.params['axial samples'], self.params['lines']], order='F')
+                """
+                Beamform the RF data into bmode images
+                :return: 2D bmode for a single frame, or a [frame X axial X line] stack of bmodes
+                """
+                summation = self.delays @ self.rf_matrix
+                rf = np.reshape(summation, [self.params['lines'], self.params['axial samples'], -1])
+                rf = np.transpose(rf, [2, 1, 0])
                 iq = sig.hilbert(rf)
-                bmode = recon.iq_to_db(iq)
+                bmode = iq_stack_to_db(iq)
+                
+                if np.ndim(self.rf_array) == 2:
+                        return bmode[0]
+                
                 return bmode
                 
 
+def iq_stack_to_db(iq_stack: np.ndarray) -> np.ndarray:
+        """
+        Convert a [frame X axial X line] stack of IQ data to decibels, offsetting each frame by its own minimum
+        envelope as reconstruction.iq_to_db does for a single frame
+        """
+        return conv.decibels(iq_stack, per_frame=True)
+
+
 class DelayCalculator(object):
-        def __init__(self, params: dict, delays_path: Path):
+        def __init__(self, params: dict, delays_path: Path=None, chunk_entries: int=2**22,
+                     cache_dir: Path=None, cache_size_mb: float=4096):
+                """
+                Calculate, or load from file, the delay matrix used to beamform RF data
+                :param params: Acquisition parameters, as read by reconstruction.read_parameters
+                :param delays_path: Path to the .npz file holding the delay matrix
+                :param chunk_entries: Approximate number of (position, element, transmit) delays evaluated at once.
+                Bounds the size of the temporary arrays used while calculating the matrix.
+                :param cache_dir: Directory of a shared DelayCache.  Used instead of delays_path when given.
+                :param cache_size_mb: Size budget of the shared cache
+                """
+                if delays_path is None and cache_dir is None:
+                        raise ValueError('Either a delays_path or a cache_dir is needed to store the delay matrix')
+                
                 self.params = params
                 self.delays_path = delays_path
-                self.params_path = Path(self.delays_path.parent, self.delays_path.stem + '_params.json')
+                if delays_path is not None:
+                        self.params_path = Path(self.delays_path.parent, self.delays_path.stem + '_params.json')
+                else:
+                        self.params_path = None
+                
+                if cache_dir is not None:
+                        self.cache = DelayCache(cache_dir, cache_size_mb)
+                else:
+                        self.cache = None
+                
+                self.chunk_entries = chunk_entries
                 self.delays = None
                 
         def load_delays(self):
+                if self.cache is not None:
+                        self.delays = self.cache.get(self.params)
+                        if self.delays is None:
+                                print('No cached delay matrix found in {}.  Calculating new matrix.'.format(
+                                        self.cache.cache_dir))
+                                self._calculate_delays()
+                                self.cache.put(self.params, self.delays)
+                        return
+                
                 if self.params_path.is_file():
                         self._read_delays()
-                else:
-                        print('No delay file found at {}.  Calculating new matrix.'.format(self.delays_path))
+                
+                if self.delays is None:
+                        print('No matching delay file found at {}.  Calculating new matrix.'.format(self.delays_path))
                         self._calculate_delays()
                         self._write_delays()
                         
@@ -96,75 +178,56 @@ class DelayCalculator(object):
                 Each row is one physical position
                 This is typically a sparse matrix
                 
+                Each row holds one entry per (element, transmit) pair, so the CSR structure is built directly from
+                the time indices of blocks of positions.
+                
                 NOTE: Numpy is in row-major format, meaning that columns/rows are reversed from matlab
                 I.e., rows are element 0, columns element 1
                 :return:
                 """
                 num_positions = self.params['axial samples']*self.params['lines']
                 num_samples = self.params['time samples']*self.params['elements']
+                delays_per_position = self.params['elements']*self.params['transmit samples']
+                positions_per_chunk = max(1, int(self.chunk_entries // max(delays_per_position, 1)))
+                
                 time_indices = []
-                position_indices = []
-                for position in tqdm(range(num_positions)):
-                        position_delays = self._position_delay(position)
-                        time_indices.extend(position_delays)
-                        
-                        position_temp = [position]*len(position_delays)
-                        position_indices.extend(position_temp)
-                        
-                time_indices = np.array(time_indices)
-                position_indices = np.array(position_indices)
+                for start in tqdm(range(0, num_positions, positions_per_chunk)):
+                        end = min(start + positions_per_chunk, num_positions)
+                        time_indices.append(self._time_delays(np.arange(start, end)).ravel())
+                
+                time_indices = np.concatenate(time_indices)
+                indptr = np.arange(num_positions + 1, dtype=np.int64)*delays_per_position
                 weights = np.ones([len(time_indices)])
                 
-                self.delays = sp.csr_matrix((weights, (position_indices, time_indices)),
-                                            shape=[num_positions, num_samples])
-                                
-        def _position_delay(self, position_idx):
-                """
-                Calculate the row
-                :param position_idx:
-                :return:
-                """
-                position_delays = list()
-                for element in range(self.params['elements']):
-                        element_delays = self._element_delay(position_idx, element)
-                        position_delays.extend(element_delays)
-                        
-                return np.array(position_delays)
-        
-        def _element_delay(self, position_idx, element_idx) -> list:
+                self.delays = sp.csr_matrix((weights, time_indices, indptr), shape=[num_positions, num_samples])
+                self.delays.sum_duplicates()
+                
+        def _time_delays(self, positions: np.ndarray) -> np.ndarray:
                 """
-                Calculate which time samples from an element contribute to the position
-                :param position_idx: Index corresponding to the position
-                :param element_idx: Index of the element in question
-                :return:
+                Calculate which time samples contribute to a block of positions
+                :param positions: 1D array of position indices
+                :return: Integer array of time indices, shaped [position, element, transmit]
                 """
-                element_delays = []
-                for transmit in range(self.params['transmit samples']):
-                        time_delay = self._time_delay(position_idx, element_idx, transmit)
-                        element_delays.append(time_delay)
-                                
-                return element_delays
+                axial_index = positions % self.params['axial samples']
+                axial_distance = (axial_index * self.params['axial resolution'])[:, None, None]
                 
-        def _time_delay(self, position_idx, element_idx, transmit):
-                axial_index = position_idx % self.params['axial samples']
-                axial_distance = axial_index * self.params['axial resolution']
+                line = np.floor(positions/self.params['axial samples'])[:, None, None]
+                element = np.arange(self.params['elements'])[None, :, None]
+                transmit = np.arange(self.params['transmit samples'])[None, None, :]
                 
-                line = np.floor(position_idx/self.params['axial samples'])
                 lat_point_to_transmit = transmit*self.params['transducer spacing'] \
                                         - line*self.params['lateral resolution']
-                lat_point_to_element = element_idx*self.params['transducer spacing'] \
+                lat_point_to_element = element*self.params['transducer spacing'] \
                                        - line*self.params['lateral resolution']
                 dist_ptt = np.sqrt(axial_distance**2 + lat_point_to_transmit**2)
                 dist_pte = np.sqrt(axial_distance**2 + lat_point_to_element**2)
                 distance = dist_ptt + dist_pte
                 
-                angle = np.arctan(lat_point_to_element/axial_distance)
-                
-                time_delay = round((distance - self.params['start depth'])
-                                   * self.params['sampling frequency'] / self.params['speed of sound']
-                                   + transmit*self.params['transmit samples'])
+                time_delay = np.rint((distance - self.params['start depth'])
+                                     * self.params['sampling frequency'] / self.params['speed of sound']
+                                     + transmit*self.params['transmit samples'])
                 
-                return time_delay
+                return time_delay.astype(np.int64)
         
         # todo: contributions weighted from all samples in resolution area?  Sliding frame?
         
@@ -173,17 +236,121 @@ class DelayCalculator(object):
                 Write a delays file that contains the delay matrix so as to reduce time cost
                 :return:
                 """
-                sp.save_npz(str(self.delays_path), self.delays)
-                params_path = Path(self.delays_path.parent, self.delays_path.stem + '_params.json')
-                util.write_json(self.params, params_path)
+                with util.atomic_write(self.delays_path) as temp_path:
+                        sp.save_npz(str(temp_path), self.delays)
+                with util.atomic_write(self.params_path) as temp_path:
+                        util.write_json(geometry_parameters(self.params), temp_path)
         
         def _read_delays(self):
                 """
-                Find a delays file if it exists and read it in instead of calculating
+                Find a delays file if it exists and read it in instead of calculating.  Leaves the delays unset if the
+                file was made with a different geometry.
                 :return:
                 """
                 temp_params = util.read_json(self.params_path)
-                if self.params == temp_params:
-                        self.delays = sp.load_npz(self.delays_path)
+                try:
+                        matching = geometry_parameters(self.params) == geometry_parameters(temp_params)
+                except KeyError:
+                        # Written before the geometry parameters were all saved
+                        matching = False
+                
+                if matching and self.delays_path.is_file():
+                        self.delays = sp.load_npz(str(self.delays_path))
                 else:
-                        raise("The parameters do not match.\n Point to the right file or to an unused file name")
+                        print('The parameters in {} do not match.  Overwriting it.'.format(self.params_path))
+
+
+class DelayCache(object):
+        def __init__(self, cache_dir: Path, size_mb: float=4096):
+                """
+                Directory of delay matrices, keyed by a hash of the geometry parameters.
+                
+                Entries are written atomically, so any number of processes can read from the cache while another
+                writes to it.  Reading an entry marks it as recently used; the least recently used entries are
+                removed once the cache grows beyond its size budget.
+                :param cache_dir: Directory holding the cached matrices
+                :param size_mb: Maximum total size of the cached matrices, in megabytes
+                """
+                self.cache_dir = Path(cache_dir)
+                self.size_budget = size_mb*2**20
+                os.makedirs(str(self.cache_dir), exist_ok=True)
+        
+        def get(self, params: dict):
+                """
+                Read the delay matrix for a set of parameters
+                :param params: Acquisition parameters
+                :return: The delay matrix, or None if it is not cached
+                """
+                delays_path, params_path = self._entry_paths(params)
+                try:
+                        cached_params = util.read_json(params_path)
+                        if cached_params != geometry_parameters(params):
+                                return None
+                        
+                        delays = sp.load_npz(str(delays_path))
+                        os.utime(str(delays_path))
+                except (FileNotFoundError, ValueError):
+                        return None
+                
+                return delays
+        
+        def put(self, params: dict, delays):
+                """
+                Add a delay matrix to the cache, then evict old entries if the cache is over its size budget
+                :param params: Acquisition parameters the matrix was calculated from
+                :param delays: The delay matrix
+                :return:
+                """
+                delays_path, params_path = self._entry_paths(params)
+                with util.atomic_write(params_path) as temp_path:
+                        util.write_json(geometry_parameters(params), temp_path)
+                with util.atomic_write(delays_path) as temp_path:
+                        sp.save_npz(str(temp_path), delays)
+                
+                self._evict(keep=delays_path)
+        
+        def _entry_paths(self, params: dict) -> (Path, Path):
+                key = hash_geometry(params)
+                return Path(self.cache_dir, key + '.npz'), Path(self.cache_dir, key + '_params.json')
+        
+        def _list_entries(self) -> list:
+                return [path for path in self.cache_dir.glob('*.npz') if not path.name.startswith('.')]
+        
+        def _evict(self, keep: Path=None):
+                """Remove the least recently used entries until the cache fits inside its size budget"""
+                entries = []
+                for path in self._list_entries():
+                        try:
+                                stat = path.stat()
+                        except FileNotFoundError:
+                                continue
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                
+                total_size = sum(entry[1] for entry in entries)
+                for mtime, size, path in sorted(entries, key=lambda entry: entry[0]):
+                        if total_size <= self.size_budget:
+                                break
+                        if path == keep:
+                                continue
+                        
+                        try:
+                                os.remove(str(path))
+                        except OSError:  # Removed by another process, or still open for reading on Windows
+                                continue
+                        
+                        total_size -= size
+                        try:
+                                os.remove(str(Path(path.parent, path.stem + '_params.json')))
+                        except OSError:
+                                pass
+
+
+def geometry_parameters(params: dict) -> dict:
+        """Get the subset of acquisition parameters that determine the delay matrix, as plain floats"""
+        return {key: float(params[key]) for key in DELAY_PARAMETERS}
+
+
+def hash_geometry(params: dict) -> str:
+        """Get a stable hash of the parameters that determine the delay matrix"""
+        text = json.dumps(geometry_parameters(params), sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
@@ -0,0 +1,184 @@
+"""
+Conversion of ultrasound and OCT data from complex IQ or RF values into float32 envelope, B-mode, and decibel images
+
+Each conversion works through the input a chunk of rows at a time with in-place ufuncs, so the only full-size array
+is the float32 output.  Chunks may be converted in parallel by a thread pool, as numpy releases the GIL.
+
+Copyright (c) 2018, Michael Pinkert
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Laboratory for Optical and Computational Instrumentation nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def envelope(iq_array: np.ndarray, out: np.ndarray=None, num_workers: int=1, chunk_size: int=2**18) -> np.ndarray:
+        """
+        Get the magnitude of complex IQ data
+        :param iq_array: Array of IQ data
+        :param out: Array to write the envelope into.  Defaults to a new float32 array
+        :param num_workers: Number of threads converting chunks in parallel
+        :param chunk_size: Approximate number of elements converted at a time
+        :return: The envelope
+        """
+        out = _output_array(iq_array, out)
+
+        def convert(rows):
+                np.abs(iq_array[rows], out=out[rows])
+
+        _map_rows(convert, iq_array, num_workers, chunk_size)
+        return out
+
+
+def bmode(iq_array: np.ndarray, out: np.ndarray=None, num_workers: int=1, chunk_size: int=2**18) -> np.ndarray:
+        """
+        Convert complex IQ data into a bmode image, 20*log10(envelope + 1)
+        :param iq_array: Array of IQ data
+        :param out: Array to write the bmode into.  Defaults to a new float32 array
+        :param num_workers: Number of threads converting chunks in parallel
+        :param chunk_size: Approximate number of elements converted at a time
+        :return: The bmode image
+        """
+        out = _output_array(iq_array, out)
+
+        def convert(rows):
+                chunk = out[rows]
+                np.abs(iq_array[rows], out=chunk)
+                chunk += 1
+                np.log10(chunk, out=chunk)
+                chunk *= 20
+
+        _map_rows(convert, iq_array, num_workers, chunk_size)
+        return out
+
+
+def decibels(iq_array: np.ndarray, dynamic_range=None, per_frame: bool=False, offset_fraction: float=0.001,
+             out: np.ndarray=None, num_workers: int=1, chunk_size: int=2**18) -> np.ndarray:
+        """
+        Convert complex IQ data into decibels, 20*log10(envelope + offset_fraction*minimum envelope), and optionally
+        window it to a dynamic range as an 8-bit image.
+
+        The IQ data is read once.  The envelope and its minimum are found in the first pass, and the log compression
+        is applied in place in the second, which also finds the maximum for windowing.
+        :param iq_array: Array of IQ data
+        :param dynamic_range: Width of the window in dB, measured down from the maximum.  Default returns the float32
+        decibels without windowing
+        :param per_frame: Offset each frame along the first axis by its own minimum envelope, instead of the global one
+        :param offset_fraction: Fraction of the minimum envelope added before the log, to avoid log(0)
+        :param out: Array to write the result into.  Defaults to a new float32 array, or uint8 with a dynamic range
+        :param num_workers: Number of threads converting chunks in parallel
+        :param chunk_size: Approximate number of elements converted at a time
+        :return: The decibel image
+        """
+        if dynamic_range is None:
+                db = _output_array(iq_array, out)
+        else:
+                db = np.empty(np.shape(iq_array), dtype=np.float32)
+
+        row_axes = tuple(range(1, np.ndim(iq_array)))
+        row_min = np.empty(len(iq_array), dtype=np.float64)
+        row_max = np.empty(len(iq_array), dtype=np.float64)
+
+        def find_envelope(rows):
+                chunk = db[rows]
+                np.abs(iq_array[rows], out=chunk)
+                row_min[rows] = np.min(chunk, axis=row_axes)
+
+        _map_rows(find_envelope, iq_array, num_workers, chunk_size)
+
+        if per_frame:
+                offsets = row_min*offset_fraction
+        else:
+                offsets = np.full(len(iq_array), np.min(row_min)*offset_fraction)
+        offsets = np.reshape(offsets, (-1,) + (1,)*len(row_axes)).astype(np.float32)
+
+        def compress(rows):
+                chunk = db[rows]
+                chunk += offsets[rows]
+                np.log10(chunk, out=chunk)
+                chunk *= 20
+                row_max[rows] = np.max(chunk, axis=row_axes)
+
+        _map_rows(compress, iq_array, num_workers, chunk_size)
+        if dynamic_range is None:
+                return db
+
+        maximum = np.max(row_max)
+        return window_dynamic_range(db, dynamic_range, maximum, out=out, num_workers=num_workers,
+                                    chunk_size=chunk_size)
+
+
+def window_dynamic_range(image_array: np.ndarray, dynamic_range, maximum=None, out: np.ndarray=None,
+                         num_workers: int=1, chunk_size: int=2**18) -> np.ndarray:
+        """
+        Window an image from maximum - dynamic range to its maximum, as an 8-bit image.
+
+        Matches itk.process.window_image, which is sitk.IntensityWindowing followed by a cast to uint8.
+        :param image_array: Image to window, e.g. in dB
+        :param dynamic_range: Width of the window, measured down from the maximum
+        :param maximum: Top of the window.  Defaults to the maximum of the image
+        :param out: Array to write the result into.  Defaults to a new uint8 array
+        :param num_workers: Number of threads converting chunks in parallel
+        :param chunk_size: Approximate number of elements converted at a time
+        :return: The windowed image
+        """
+        if maximum is None:
+                maximum = np.max(image_array)
+        if out is None:
+                out = np.empty(np.shape(image_array), dtype=np.uint8)
+
+        minimum = maximum - dynamic_range
+        scale = 255. / dynamic_range
+
+        def window(rows):
+                chunk = np.subtract(image_array[rows], minimum, dtype=np.float32)
+                chunk *= scale
+                np.clip(chunk, 0, 255, out=chunk)
+                out[rows] = chunk
+
+        _map_rows(window, image_array, num_workers, chunk_size)
+        return out
+
+
+def _output_array(input_array, out):
+        if out is None:
+                return np.empty(np.shape(input_array), dtype=np.float32)
+
+        return out
+
+
+def _map_rows(function, array, num_workers, chunk_size):
+        """Call function on slices of rows along the first axis that together cover the array"""
+        num_rows = len(array)
+        row_size = max(int(np.prod(np.shape(array)[1:])), 1)
+        rows_per_chunk = max(1, chunk_size // row_size)
+        chunks = [slice(start, min(start + rows_per_chunk, num_rows)) for start in range(0, num_rows, rows_per_chunk)]
+
+        if num_workers > 1 and len(chunks) > 1:
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                        list(executor.map(function, chunks))
+        else:
+                for rows in chunks:
+                        function(rows)
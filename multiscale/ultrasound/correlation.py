@@ -5,14 +5,19 @@ Organization: Laboratory for Optical and Computation Instrumentation, University
 """
 
 import numpy as np
+import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import scipy.signal as sig
-import matplotlib.pyplot as plt
+import scipy.fft as fft
 from scipy.interpolate import interp1d
 
-plt.ion()
-
 import multiscale.ultrasound.reconstruction as recon
+import multiscale.ultrasound.acquisition_cache as cache
+import multiscale.ultrasound.conversion as conv
+import multiscale.utility_functions as util
+
+plt = util.lazy_import('matplotlib.pyplot', on_import=lambda pyplot: pyplot.ion())
 
 
 def define_correlation_window(params_acquisition: dict):
@@ -28,32 +33,40 @@ def define_correlation_window(params_acquisition: dict):
     return params_window
 
 
-def determine_window_sweep():
-    """Define the range the window sweeps over within the frames"""
-    return
+def determine_window_sweep(params_window: dict, params_acq: dict) -> np.ndarray:
+    """Define the range the window sweeps over within the frames
 
+    Windows of the axial size start at the start of the depth range and step by the depth step, as long as they end
+    within the depth range.
 
-def detrend_and_add_back_mean(array_im: np.ndarray, dim_detrend:int) -> np.ndarray:
+    Output:
+    Array of [start index, end index] along the axial axis, one row per window depth
+    """
+    resolution = params_acq['Axial resolution']
+    idx_start = int(np.floor(params_window['Start of depth range mm'] / resolution))
+    idx_end = int(np.floor(params_window['End of depth range mm'] / resolution))
+    size = int(np.round(params_window['Axial size mm'] / resolution))
+    step = max(int(np.round(params_window['Depth step mm'] / resolution)), 1)
+    
+    starts = np.arange(idx_start, idx_end - size + 1, step)
+    depths_start_end = np.stack([starts, starts + size], axis=1)
+    
+    return depths_start_end
+
+
+def detrend_and_add_back_mean(array_im: np.ndarray, dim_detrend:int, out: np.ndarray=None) -> np.ndarray:
     """Detrend along a dimension
 
+    The mean added back is that of the detrended lines, which is zero, so the output is the linear detrend, in float64
+    unless out is given.
+
     axis 0 = elevation
     axis 1 = axial
     axis 2 = lateral
     """
-    shape_array = np.shape(array_im)
-    array_detrend = sig.detrend(array_im, axis=dim_detrend)
-    array_mean = np.mean(array_detrend, axis=dim_detrend)
-
-    if dim_detrend is 2:  # lateral
-        array_output = array_detrend + array_mean[:, :, None]
-    elif dim_detrend is 1:  # axial
-        array_output = array_detrend + np.reshape(array_mean, [shape_array[0], 1, shape_array[2]])
-    elif dim_detrend is 0:  # elevation
-        array_output = array_detrend + array_mean
-    else:
-        raise ValueError('Please enter a valid dimension (0, 1, or 2)')
-
-    return array_output
+    if out is None:
+        out = np.empty(np.shape(array_im), dtype=np.float64)
+    return detrend_window(array_im, dim_detrend, mean='subtract', out=out)
 
 
 def detrend_along_dimension(array_im: np.ndarray, dim_detrend: int) -> np.ndarray:
@@ -68,28 +81,71 @@ def detrend_along_dimension(array_im: np.ndarray, dim_detrend: int) -> np.ndarra
     return array_detrend
 
 
-def detrend_and_subtract_mean(array_im: np.ndarray, dim_detrend: int) -> np.ndarray:
+def detrend_and_subtract_mean(array_im: np.ndarray, dim_detrend: int, out: np.ndarray=None) -> np.ndarray:
     """Detrend along a dimension, and subtract a mean of the detrend along another dimension
 
+    Output is float64 unless out is given.
+
     axis 0 = elevation
     axis 1 = axial
     axis 2 = lateral
     """
-    
-    array_detrend = sig.detrend(array_im, axis=dim_detrend)
-    array_mean = np.mean(array_detrend, dim_detrend)
-    shape_array = np.shape(array_detrend)
-    
-    if dim_detrend is 2: # lateral
-        array_detrend_avg = array_detrend - array_mean[:, :, None]
-    elif dim_detrend is 1: # axial
-        array_detrend_avg = array_detrend - np.reshape(array_mean, [shape_array[0], 1, shape_array[2]])
-    elif dim_detrend is 0: # elevation
-        array_detrend_avg = array_detrend - array_mean
-    else:
+    if out is None:
+        out = np.empty(np.shape(array_im), dtype=np.float64)
+    return detrend_window(array_im, dim_detrend, mean='subtract', out=out)
+
+
+def detrend_window(window: np.ndarray, axis: int, mean: str='add', square: bool=False,
+                   out: np.ndarray=None) -> np.ndarray:
+    """Remove the least-squares line along an axis, without the copies of scipy.signal.detrend
+
+    The slope of each line is a closed form sum against the centred sample positions, so the only temporaries are
+    per-line sums.  The window is then written into out one sample of every line at a time.
+
+    Input:
+    window: array to detrend
+    axis: axis to detrend along
+    mean: 'add' keeps the mean of each line, as detrend_and_square_window, and 'subtract' removes it, as
+    scipy.signal.detrend
+    square: square the result, e.g. to get intensity from an envelope
+    out: array to write the result into, which may be the window itself.  Defaults to a new float32 array
+
+    Output:
+    The detrended window
+    """
+    window = np.asarray(window)
+    if not -window.ndim <= axis < window.ndim:
         raise ValueError('Please enter a valid dimension (0, 1, or 2)')
+    if mean not in ['add', 'subtract']:
+        raise ValueError('mean must be add or subtract')
+    
+    axis = axis % window.ndim
+    if out is None:
+        out = np.empty(np.shape(window), dtype=np.float32)
+    
+    num_samples = np.shape(window)[axis]
+    positions = np.arange(num_samples) - (num_samples - 1)/2
+    other_axes = [dim for dim in range(window.ndim) if dim != axis]
+    slopes = np.einsum(window, list(range(window.ndim)), positions, [axis], other_axes)
+    slopes = np.expand_dims(slopes/max(np.sum(np.square(positions)), 1), axis)
+    if mean == 'subtract':
+        offsets = np.sum(window, axis=axis, keepdims=True, dtype=np.float64)/max(num_samples, 1)
+    else:
+        offsets = 0
+    
+    trend = np.empty(np.shape(slopes), dtype=np.float64)
+    for sample, position in enumerate(positions):
+        idx = [slice(None)]*window.ndim
+        idx[axis] = slice(sample, sample + 1)
+        idx = tuple(idx)
+        
+        np.multiply(slopes, position, out=trend)
+        np.add(trend, offsets, out=trend)
+        np.subtract(window[idx], trend, out=out[idx], casting='unsafe')
+        if square:
+            np.square(out[idx], out=out[idx])
     
-    return array_detrend_avg
+    return out
 
 
 def calculate_1d_autocorrelation(line: np.ndarray, shift: int) -> np.double:
@@ -101,87 +157,201 @@ def calculate_1d_autocorrelation(line: np.ndarray, shift: int) -> np.double:
     return coef
 
 
-def calculate_1d_autocorrelation_curve(window: np.ndarray, dim_of_corr: int, threshold: np.double=0.1) -> np.ndarray:
+def calculate_1d_autocorrelation_curve(window: np.ndarray, dim_of_corr: int, threshold: np.double=0.1,
+                                       max_lag: int=10) -> np.ndarray:
     """Calculate the auto-correlation curve along a submitted dimension.  Averages over all 1d lines in array
     """
+    num_lags = min(int(np.shape(window)[dim_of_corr]/2), max_lag) + 1
+    corr_along_lines = calculate_autocorrelation_along_axis(window, dim_of_corr, num_lags)
+    corr_curve = np.mean(corr_along_lines, axis=tuple(range(1, corr_along_lines.ndim)))
+    
+    return corr_curve
+
+
+def calculate_autocorrelation_along_axis(window: np.ndarray, axis: int, num_lags: int) -> np.ndarray:
+    """Calculate the Pearson correlation between each 1d line and itself shifted, for every line and shift at once
+
+    Matches calculate_1d_autocorrelation: the correlation at shift s is between line[0:n-s] and line[s:n].  The lagged
+    products come from an FFT of each line, and the segment sums and sums of squares from cumulative sums.
+
+    Input:
+    window: array of lines
+    axis: axis the lines lie along
+    num_lags: number of shifts, starting at 0
+
+    Output:
+    Array of correlations, with the shift along the first axis followed by the remaining axes of the window
+    """
+    lines = np.asarray(window, dtype=np.float64)
+    lines = lines - np.mean(lines, axis=axis, keepdims=True)
+    return _autocorrelation_of_centred(lines, np.square(lines), axis, num_lags)
+
+
+def _autocorrelation_of_centred(centred: np.ndarray, squares: np.ndarray, axis: int, num_lags: int) -> np.ndarray:
+    """Autocorrelation of calculate_autocorrelation_along_axis, from a window with its mean removed and its squares
+
+    The Pearson correlation does not depend on the offset of each line, so any mean may be removed, and one window
+    and its squares can serve every axis.
+    """
+    lines = np.moveaxis(centred, axis, -1)
+    n = lines.shape[-1]
     
-    shape_window = np.shape(window)
-    corr_curve = []
+    size_fft = fft.next_fast_len(2*n)
+    spectrum = fft.rfft(lines, size_fft, axis=-1)
+    sum_xy = fft.irfft(spectrum*np.conj(spectrum), size_fft, axis=-1)[..., :num_lags]
     
-    for shift in range(int(shape_window[dim_of_corr]/2 + 1)):
-        if shift > 10:
-            break
-            
-        corr_along_lines = np.apply_along_axis(calculate_1d_autocorrelation, dim_of_corr, window, shift)
-        average_corr = np.mean(corr_along_lines)
-        # if average_corr < threshold:
-        #     corr_curve.append(average_corr)
-        #     break
-        
-        corr_curve.append(average_corr)
+    sum_lines = _running_sum(lines, -1)
+    sum_squares = _running_sum(np.moveaxis(squares, axis, -1), -1)
     
-    corr_curve = np.array(corr_curve)
+    shifts = np.arange(num_lags)
+    length = n - shifts
+    sum_x = sum_lines[..., n - shifts]
+    sum_y = sum_lines[..., [n]] - sum_lines[..., shifts]
+    sum_xx = sum_squares[..., n - shifts]
+    sum_yy = sum_squares[..., [n]] - sum_squares[..., shifts]
     
-    return corr_curve
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = sum_xy - sum_x*sum_y/length
+        variance = (sum_xx - np.square(sum_x)/length)*(sum_yy - np.square(sum_y)/length)
+        corr_along_lines = covariance/np.sqrt(variance)
+    
+    return np.moveaxis(corr_along_lines, -1, 0)
 
 
-def calculate_curves_per_window(window: np.ndarray) -> dict:
+def calculate_curves_per_window(window: np.ndarray, max_lag: int=10) -> dict:
     """Calculate the elevation, axial, and lateral autocorrelation curves using whole window averaging
 
+    The window is converted, centred on its mean, and squared once for all three axes.  Only the lagged products
+    differ between axes, so each axis still takes its own FFT.
+
     Input:
     Window: a 3d numpy array over which to calculate the correlation
+    max_lag: largest shift of the curves
 
     Output:
     curve_elevation: 1d correlation curve along elevational axis y
     curve_axial: 1d correlation curve along axial axis z
     curve_lateral: 1d correlation curve along lateral axis x
     """
-    curve_axial = calculate_1d_autocorrelation_curve(window, 1)
-    curve_lateral = calculate_1d_autocorrelation_curve(window, 2)
-    curve_elevation = calculate_1d_autocorrelation_curve(window, 0)
+    centred = np.asarray(window, dtype=np.float64)
+    centred = centred - np.mean(centred)
+    squares = np.square(centred)
+    
+    curves = {}
+    for axis, name in enumerate(['Elevational', 'Axial', 'Lateral']):
+        num_lags = min(int(np.shape(centred)[axis]/2), max_lag) + 1
+        corr_along_lines = _autocorrelation_of_centred(centred, squares, axis, num_lags)
+        curves[name] = np.mean(corr_along_lines, axis=tuple(range(1, corr_along_lines.ndim)))
+    
+    return curves
+
 
-    curves = {'Elevational': curve_elevation, 'Axial': curve_axial, 'Lateral': curve_lateral}
+def calculate_correlation_curves_at_all_depths(env_array: np.ndarray, depths_start_end: np.ndarray,
+                                               max_lag: int=10) -> np.ndarray:
+    """For each starting window depth, calculate each correlation curve
+
+    Each window is detrended along depth on its own, as in calc_corr_curves, since attenuation is not linear over the
+    whole swept range.  The line fit of every window comes from sums of the envelope and of depth times the envelope
+    between consecutive window boundaries, which overlapping windows share, so the envelope is only read once for
+    them.  Each depth matches calculate_curves_per_window(detrend_and_square_window(window)).
+
+    Input:
+    env_array: 3d envelope, in [elevation, axial, lateral] order
+    depths_start_end: [start index, end index] of each window along the axial axis, as from determine_window_sweep
+    max_lag: largest shift of the curves
+
+    Output:
+    Array of [depth, shift, axis] correlations, with the axes in elevational, axial, lateral order.  Shifts beyond
+    half of a window's size along an axis are nan.
+    """
+    bounds = np.unique(depths_start_end)
+    depths = np.arange(np.shape(env_array)[1], dtype=np.float64)
+    sum_env = _running_sum(np.stack([np.sum(env_array[:, a:b], axis=1, dtype=np.float64)
+                                     for a, b in zip(bounds[:-1], bounds[1:])], axis=1), 1)
+    sum_depth_env = _running_sum(np.stack([np.einsum('ezl,z->el', env_array[:, a:b], depths[a:b])
+                                           for a, b in zip(bounds[:-1], bounds[1:])], axis=1), 1)
+    
+    curves = np.full([len(depths_start_end), max_lag + 1, 3], np.nan)
+    for idx_depth, (start, end) in enumerate(depths_start_end):
+        idx_start, idx_end = np.searchsorted(bounds, [start, end])
+        centre = (start + end - 1)/2
+        positions = depths[start:end] - centre
+        sum_window = sum_env[:, idx_end] - sum_env[:, idx_start]
+        sum_positions_window = sum_depth_env[:, idx_end] - sum_depth_env[:, idx_start] - centre*sum_window
+        slopes = sum_positions_window/max(np.sum(np.square(positions)), 1)
+        
+        # Closed-form equivalent of detrend_and_square_window on this window
+        intensity = np.multiply(slopes[:, np.newaxis, :], positions[:, np.newaxis], dtype=np.float32)
+        np.subtract(env_array[:, start:end], intensity, out=intensity, casting='unsafe')
+        np.square(intensity, out=intensity)
+        
+        curves_window = calculate_curves_per_window(intensity, max_lag)
+        for idx_axis, axis in enumerate(['Elevational', 'Axial', 'Lateral']):
+            num_lags = min(len(curves_window[axis]), max_lag + 1)
+            curves[idx_depth, :num_lags, idx_axis] = curves_window[axis][:num_lags]
     
     return curves
 
 
-def calculate_correlation_curves_at_all_depths(window_shape: np.ndarray, depths_start_end: np.ndarray):
-    """For each starting window depth, calculate each correlation curve"""
-    return
+def _running_sum(array: np.ndarray, axis: int) -> np.ndarray:
+    """Cumulative sum along an axis, starting from 0, so the sum over [a, b) is the difference of entries b and a"""
+    shape_zeros = list(np.shape(array))
+    shape_zeros[axis] = 1
+    return np.concatenate([np.zeros(shape_zeros), np.cumsum(array, axis=axis)], axis=axis)
+
+
+def calc_corr_curves_at_all_depths(env_array: np.ndarray, params_window: dict, params_acq: dict) -> (np.ndarray,
+                                                                                                     np.ndarray):
+    """Sweep the correlation window across the depth range
+
+    Output:
+    depths_mm: depth of the start of each window
+    curves: array of [depth, shift, axis] correlations, as from calculate_correlation_curves_at_all_depths
+    """
+    depths_start_end = determine_window_sweep(params_window, params_acq)
+    curves = calculate_correlation_curves_at_all_depths(env_array, depths_start_end)
+    depths_mm = depths_start_end[:, 0]*params_acq['Axial resolution']
+    
+    return depths_mm, curves
 
 
-def load_iq(dir_iq: Path) -> (np.ndarray, dict):
+def load_iq(dir_iq: Path, num_workers: int=1, cache_dir: Path=None) -> (np.ndarray, dict):
     list_iq = recon.get_sorted_list_mats(dir_iq, search_str='IQ.mat')
-    array_iq, params = recon.mat_list_to_iq_array(list_iq)
+    acquisition_cache = open_acquisition_cache(list_iq, dir_iq, 'IQ.mat', cache_dir)
+    array_iq, params = recon.mat_list_to_iq_array(list_iq, num_workers=num_workers,
+                                                  acquisition_cache=acquisition_cache)
     
     return array_iq, params
 
 
-def load_rf(dir_rf:Path) -> (np.ndarray, dict):
+def load_rf(dir_rf:Path, num_workers: int=1, cache_dir: Path=None) -> (np.ndarray, dict):
     list_rf = recon.get_sorted_list_mats(dir_rf, search_str='RF.mat')
-    array_rf, params = recon.mat_list_to_rf_array(list_rf)
+    acquisition_cache = open_acquisition_cache(list_rf, dir_rf, 'RF.mat', cache_dir)
+    array_rf, params = recon.mat_list_to_rf_array(list_rf, num_workers=num_workers,
+                                                  acquisition_cache=acquisition_cache)
     return array_rf, params
 
 
+def open_acquisition_cache(mat_list: list, mat_dir: Path, search_str: str, cache_dir: Path=None):
+    """Get the acquisition cache for a directory of .mat files, or None if caching is not used"""
+    if cache_dir is None:
+        return None
+    
+    return cache.AcquisitionCache(mat_list, cache.cache_path_for(cache_dir, mat_dir, search_str))
+
+
 def iq_to_envelope(iq_array: np.ndarray) -> np.ndarray:
     """"Detrend iq along axial direction then use hilbert transform to get envelope"""
     
-    env = np.abs(iq_array)
+    env = conv.envelope(iq_array)
     env_detrended = detrend_along_dimension(env, 1)
     
     return env_detrended
 
 
-def detrend_and_square_window(window: np.ndarray) -> np.ndarray:
+def detrend_and_square_window(window: np.ndarray, out: np.ndarray=None) -> np.ndarray:
     """Detrend the window, adding the pre-detrend mean to prevent frequency loss, then squaring to get intensity"""
-    shape_array = np.shape(window)
-    axial_means = np.mean(window, 1)
-    
-    window_detrended = detrend_along_dimension(window, 1)
-    window_mean_added = window_detrended + np.reshape(axial_means, [shape_array[0], 1, shape_array[2]])
-    window_squared = np.square(window_mean_added)
-    
-    return window_squared
+    return detrend_window(window, 1, mean='add', square=True, out=out)
 
 
 def calc_corr_curves(env_array: np.ndarray, params_window: dict, params_acq: dict) -> np.ndarray:
@@ -234,8 +404,9 @@ def plot_single_curves(dict_curves: dict, params_acq: dict, dir_output: Path=Non
             plt.savefig(str(name_output))
 
 
-def calc_plot_corr_curves(dir_iq: Path, dir_output: Path=None, suffix_output: str='', elevation_res: np.double=0.05):
-    iq_array, params_acquisition = load_iq(dir_iq)
+def calc_plot_corr_curves(dir_iq: Path, dir_output: Path=None, suffix_output: str='', elevation_res: np.double=0.05,
+                          cache_dir: Path=None):
+    iq_array, params_acquisition = load_iq(dir_iq, cache_dir=cache_dir)
     env_array = iq_to_envelope(iq_array)
     
     # todo automate this calculation
@@ -251,13 +422,13 @@ def calc_plot_corr_curves(dir_iq: Path, dir_output: Path=None, suffix_output: st
 
 def rf_to_envelope(rf_array):
     """Take the hilbert transform along the axial direction"""
-    env = np.abs(sig.hilbert(rf_array, axis=1))
+    env = conv.envelope(sig.hilbert(rf_array, axis=1))
     return env
 
 
 def process_rf_to_correlation(dir_rf: Path, dir_output: Path = None, suffix_output: str = '',
-                              elevation_res: np.double = 0.01848):
-    rf_array, params_acquisition = load_rf(dir_rf)
+                              elevation_res: np.double = 0.01848, cache_dir: Path=None):
+    rf_array, params_acquisition = load_rf(dir_rf, cache_dir=cache_dir)
     rf_detrended = detrend_along_dimension(rf_array, 1)
     env_array = rf_to_envelope(rf_detrended)
     
@@ -272,14 +443,108 @@ def process_rf_to_correlation(dir_rf: Path, dir_output: Path = None, suffix_outp
     return
 
 
-def bulk_plot_corr_curves(list_dirs: list, dir_output: Path=None, suffix_output: str='', elevation_res: np.double=0.02):
+def bulk_plot_corr_curves(list_dirs: list, dir_output: Path=None, suffix_output: str='', elevation_res: np.double=0.02,
+                          cache_dir: Path=None):
     
     for dir_iq in list_dirs:
-        iq_array, params_acquisition = load_iq(dir_iq)
+        iq_array, params_acquisition = load_iq(dir_iq, cache_dir=cache_dir)
         env_array = iq_to_envelope(iq_array)
         
         # todo automate this calculation
         params_acquisition['Elevational resolution'] = elevation_res
         
         params_window = define_correlation_window(params_acquisition)
-        curves = calc_corr_curves(env_array, params_window, params_acquisition)
\ No newline at end of file
+        curves = calc_corr_curves(env_array, params_window, params_acquisition)
+
+
+def bulk_corr_curves_to_table(list_dirs: list, path_output: Path=None, num_workers: int=1, max_in_flight: int=None,
+                              elevation_res: np.double=0.02, cache_dir: Path=None) -> pd.DataFrame:
+    """Calculate the correlation curves of many acquisitions without plotting, one directory per process
+
+    Input:
+    list_dirs: directories holding the IQ .mat files of each acquisition
+    path_output: csv to write the results table to
+    num_workers: number of processes calculating curves
+    max_in_flight: most directories submitted to the pool at once, which bounds the volumes held in memory.
+    Defaults to num_workers
+    elevation_res: elevational resolution of the acquisitions, in mm
+    cache_dir: directory of acquisition caches, as for load_iq
+
+    Output:
+    Tidy table with one row per directory, axis, and lag, holding the correlation 'value' and the 'lag mm'
+    """
+    if max_in_flight is None:
+        max_in_flight = num_workers
+    
+    if num_workers > 1:
+        tables = []
+        dirs_to_submit = iter(list_dirs)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            in_flight = set()
+            for dir_iq in dirs_to_submit:
+                in_flight.add(executor.submit(corr_curves_to_table, dir_iq, elevation_res, cache_dir))
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    tables.extend(future.result() for future in done)
+            
+            tables.extend(future.result() for future in in_flight)
+    else:
+        tables = [corr_curves_to_table(dir_iq, elevation_res, cache_dir) for dir_iq in list_dirs]
+    
+    if not tables:
+        tables = [curves_to_table({}, {}, '')]
+    
+    order = {str(dir_iq): idx for idx, dir_iq in enumerate(list_dirs)}
+    table = pd.concat(tables, ignore_index=True)
+    table = table.sort_values(by='directory', key=lambda column: column.map(order), kind='stable')
+    table = table.reset_index(drop=True)
+    
+    if path_output is not None:
+        with util.atomic_write(path_output) as path_temp:
+            table.to_csv(path_temp, index=False)
+    
+    return table
+
+
+def corr_curves_to_table(dir_iq: Path, elevation_res: np.double=0.02, cache_dir: Path=None) -> pd.DataFrame:
+    """Calculate the correlation curves of one acquisition as a tidy table"""
+    iq_array, params_acquisition = load_iq(dir_iq, cache_dir=cache_dir)
+    env_array = iq_to_envelope(iq_array)
+    del iq_array
+    
+    # todo automate this calculation
+    params_acquisition['Elevational resolution'] = elevation_res
+    
+    params_window = define_correlation_window(params_acquisition)
+    curves = calc_corr_curves(env_array, params_window, params_acquisition)
+    
+    return curves_to_table(curves, params_acquisition, str(dir_iq))
+
+
+def curves_to_table(dict_curves: dict, params_acq: dict, directory: str) -> pd.DataFrame:
+    """Convert a dictionary of correlation curves into rows of directory, axis, lag, value, and lag in mm"""
+    rows = []
+    for axis, curve in dict_curves.items():
+        spacing = params_acq[axis + ' resolution']
+        for lag, value in enumerate(curve):
+            rows.append({'directory': directory, 'axis': axis, 'lag': lag, 'value': value, 'lag mm': lag*spacing})
+    
+    return pd.DataFrame(rows, columns=['directory', 'axis', 'lag', 'value', 'lag mm'])
+
+
+def plot_corr_curves_from_table(table: pd.DataFrame, dir_output: Path=None, suffix_output: str=''):
+    """Plot each directory's curves from a results table, as plot_single_curves does for a single acquisition"""
+    for directory, table_dir in table.groupby('directory', sort=False):
+        suffix_dir = Path(directory).name + suffix_output
+        for axis, table_axis in table_dir.groupby('axis', sort=False):
+            curve = table_axis.sort_values('lag')
+            if len(curve) < 2:
+                print('Skipping the {} curve of {}, which has a single lag'.format(axis, directory))
+                continue
+            
+            spacing = curve['lag mm'].iloc[1] - curve['lag mm'].iloc[0]
+            plot_corr_curve(curve['value'].values, axis, spacing)
+            
+            if dir_output is not None:
+                name_output = Path(dir_output, axis + '_' + suffix_dir + '.png')
+                plt.savefig(str(name_output))
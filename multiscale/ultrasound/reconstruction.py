@@ -11,15 +11,26 @@ import multiscale.utility_functions as util
 import re
 import SimpleITK as sitk
 import multiscale.imagej.stitching as st
+import multiscale.ultrasound.acquisition_cache as cache
+import multiscale.ultrasound.conversion as conv
+import multiscale.microscopy.ome as ome
 import os
 import tiffile as tif
 import warnings
+import tempfile
+import time
+import h5py
+import copy
+import math
+from functools import partial, lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 class UltrasoundImageAssembler(object):
         def __init__(self, mat_dir: Path, output_dir: Path, ij, pl_path: Path=None,
                      intermediate_save_dir: Path=None, dataset_args: dict=None, fuse_args: dict=None,
                      search_str: str='.mat', output_name='fused_tp_0_ch_0.tif', params_path=None,
-                     overwrite_dataset=None, overwrite_tif=None):
+                     overwrite_dataset=None, overwrite_tif=None, streaming: bool=False, memmap_dir: Path=None,
+                     num_workers: int=1, cache_dir: Path=None, native_fusion: bool=False, pyramid_levels: int=None):
                 """
                 Class for assembling a 3D Ultrasound image taken with the LINK imaging system
                 :param mat_dir: Directory holding the Verasonics generated .mat files
@@ -34,6 +45,16 @@ class UltrasoundImageAssembler(object):
                 :param params_path: Path to a Verasonics settings file
                 :param overwrite_dataset: Overwrite an intermediate dataset that exists. Default queries the user
                 :param overwrite_tif: Whether to overwrite a final tif if it already exists. Default queries the user
+                :param streaming: Convert each .mat file as it is read, keeping only one frame of raw data in memory
+                :param memmap_dir: Directory to hold the streamed output as a memory-mapped .npy file.  Default keeps
+                the output in RAM
+                :param num_workers: Number of processes reading .mat files in parallel
+                :param cache_dir: Directory for an acquisition cache.  The .mat files are then decoded only once, and
+                later assemblies of the same scan read the cached frames, parameters and positions
+                :param native_fusion: Fuse lateral tiles in Python with linear feathering, instead of through a
+                BigStitcher dataset.  No ImageJ instance is needed
+                :param pyramid_levels: Save the output as a tiled, compressed OME-TIFF with this many resolution
+                levels, which can be read a region or level at a time.  Default saves an uncompressed ImageJ tif
                 """
 
                 self.mat_dir = mat_dir
@@ -49,10 +70,19 @@ class UltrasoundImageAssembler(object):
                 os.makedirs(str(output_dir), exist_ok=True)
                 
                 self.search_str = search_str
+                self.mat_list = self._read_sorted_list_mats()
+                if cache_dir is not None:
+                        self.cache = cache.AcquisitionCache(self.mat_list,
+                                                            cache.cache_path_for(cache_dir, mat_dir, search_str),
+                                                            pl_path=pl_path)
+                else:
+                        self.cache = None
+                
                 self.pos_list, self.pos_labels = self._read_position_list()
                 
-                self.mat_list = self._read_sorted_list_mats()
-                if params_path == None:
+                if params_path is None and self.cache is not None:
+                        self.params = clean_parameters(self.cache.get_parameters())
+                elif params_path is None:
                         self.params = read_parameters(self.mat_list[0])
                 else:
                         self.params = read_parameters(params_path)
@@ -61,6 +91,11 @@ class UltrasoundImageAssembler(object):
                 self.dataset_args = self._assemble_dataset_arguments(dataset_args)
                 self.overwrite_dataset = overwrite_dataset
                 self.overwrite_tif = overwrite_tif
+                self.streaming = streaming
+                self.memmap_dir = memmap_dir
+                self.num_workers = num_workers
+                self.native_fusion = native_fusion
+                self.pyramid_levels = pyramid_levels
 
         def get_acquisition_parameters(self):
                 """Get the US acquisition parameters"""
@@ -84,13 +119,21 @@ class UltrasoundImageAssembler(object):
                 path = str(Path(self.output_dir, file_name))
                 print('Saving {}'.format(path))
                 spacing = self._get_spacing()
-                ijstyle = bmode.astype(np.float32)
+                if self.pyramid_levels is not None:
+                        ome.write_pyramid(bmode, path, spacing, origin=self._get_origin(),
+                                          num_levels=self.pyramid_levels)
+                        print('Finished saving {}'.format(path))
+                        return
+
+                ijstyle = np.asarray(bmode, dtype=np.float32)
                 shape = ijstyle.shape
-                ijstyle.shape = 1, shape[0], 1, shape[1], shape[2], 1
+                ijstyle = np.reshape(ijstyle, [1, shape[0], 1, shape[1], shape[2], 1])
                 
-                tif.imwrite(path, ijstyle, imagej=True,
-                            resolution=(1./self.params['lateral resolution'], 1./self.params['axial resolution']),
-                            metadata={'spacing': spacing[2], 'unit': 'um'})
+                with util.atomic_write(path) as temp_path:
+                        tif.imwrite(str(temp_path), ijstyle, imagej=True,
+                                    resolution=(1./self.params['lateral resolution'],
+                                                1./self.params['axial resolution']),
+                                    metadata={'spacing': spacing[2], 'unit': 'um'})
                 
                 print('Finished saving {}'.format(path))
         
@@ -110,6 +153,10 @@ class UltrasoundImageAssembler(object):
                         stitcher._fuse_dataset(self.fuse_args, self.output_name)
                         return
                 
+                if self.streaming:
+                        self._stream_bmode_image(base_image_data)
+                        return
+                
                 image_list = self._mat_list_to_variable_list(base_image_data)
                 if len(self.pos_list) == 0 or self._count_unique_positions(0) == 1:
                         image_array = np.array(image_list)
@@ -137,6 +184,10 @@ class UltrasoundImageAssembler(object):
                         stitcher._fuse_dataset(self.fuse_args, self.output_name)
                         return
         
+                if self.streaming:
+                        self._stream_qus_image(base_image_data)
+                        return
+                
                 image_list = self._mat_list_to_variable_list(base_image_data)
                 if len(self.pos_list) == 0 or self._count_unique_positions(0) == 1:
                         image_array = np.array(image_list).astype(np.float32)
@@ -146,6 +197,262 @@ class UltrasoundImageAssembler(object):
                                 _image_list_to_laterally_separate_3d_images(image_list)
                         self._stitch_image(separate_3d_images)
                         
+        def _stream_bmode_image(self, base_image_data='IQData'):
+                """
+                Assemble the bmode image one .mat file at a time, so peak memory is the output plus one frame
+                :param base_image_data: The variable being stitched in the .mat files
+                :return:
+                """
+                if self._is_single_lateral_position():
+                        bmode = self._mat_list_to_array(base_image_data, iq_to_bmode)
+                        self._save_us_image(self.output_name, bmode)
+                else:
+                        bmode = self._mat_list_to_array(base_image_data, iq_to_bmode, select_2d=True)
+                        self._stitch_image(self._array_to_laterally_separate_3d_images(bmode))
+        
+        def _stream_qus_image(self, base_image_data='param_map'):
+                """
+                Assemble the QUS image one .mat file at a time, so peak memory is the output plus one frame
+                :param base_image_data: The variable being stitched in the .mat files
+                :return:
+                """
+                if self._is_single_lateral_position():
+                        image_array = self._mat_list_to_array(base_image_data)
+                        self._save_us_image(self.output_name, image_array)
+                else:
+                        image_array = self._mat_list_to_array(base_image_data, select_2d=True)
+                        self._stitch_image(self._array_to_laterally_separate_3d_images(image_array))
+        
+        def watch_bmode_image(self, base_image_data='IQData', poll_interval: float=30, timeout: float=None):
+                """
+                Assemble the bmode image while the acquisition is still writing .mat files, refreshing the output as
+                elevational slices complete
+                :param base_image_data: The variable being stitched in the .mat files
+                :param poll_interval: Seconds to wait between checks for new .mat files
+                :param timeout: Seconds without a new .mat file before giving up.  Default waits until every position
+                in the position list is converted
+                :return: Whether every position was converted
+                """
+                last_new_frame = time.monotonic()
+                while True:
+                        if self.update_bmode_image(base_image_data):
+                                last_new_frame = time.monotonic()
+
+                        if self._read_progress()['complete_slices'] == self._count_incremental_slices():
+                                return True
+                        if timeout is not None and time.monotonic() - last_new_frame > timeout:
+                                print('No new .mat files in {} s.  Stopping'.format(timeout))
+                                return False
+
+                        time.sleep(poll_interval)
+
+        def update_bmode_image(self, base_image_data='IQData') -> int:
+                """
+                Convert the .mat files written since the last update into a persistent, partially filled bmode volume,
+                and refresh the output if more elevational slices are complete.
+
+                The volume is a memory-mapped .npy file in memmap_dir, or the output directory by default, with a
+                progress file listing the size and modification time of each converted .mat.  Files that change are
+                converted again, and files that cannot be read yet, e.g. because they are still being written, are
+                retried on the next update.  Unconverted frames are 0.  The acquisition cache is not used, as it is
+                rebuilt whenever a file is added.
+
+                Tiled images are refreshed with native fusion each time a slice completes.  BigStitcher fusion only
+                runs once the whole volume is converted.
+                :param base_image_data: The variable being stitched in the .mat files
+                :return: Number of .mat files converted
+                """
+                if len(self.pos_list) == 0:
+                        raise ValueError('Incremental assembly needs a position list to know the size of the volume')
+
+                progress = self._read_progress()
+                volume_path = self._incremental_path('.npy')
+                if not volume_path.is_file():
+                        progress['converted'] = {}
+                        progress['complete_slices'] = 0
+
+                pending = self._find_pending_mats(progress)
+                if not pending:
+                        return 0
+
+                read_frame = partial(read_converted_variable, variable=base_image_data, convert_frame=iq_to_bmode,
+                                     select_2d=not self._is_single_lateral_position())
+                converted = []
+                if not volume_path.is_file():
+                        first_idx, first_path, _ = pending[0]
+                        try:
+                                first_frame = read_frame(first_path)
+                        except (OSError, ValueError) as error:
+                                print('Could not read {} yet: {}'.format(first_path.name, error))
+                                return 0
+                        volume = _allocate_stack((len(self.pos_list),) + np.shape(first_frame), np.float32,
+                                                 volume_path)
+                        volume[first_idx] = first_frame
+                        volume.flush()
+                        del volume
+                        converted.append(pending[0])
+
+                converted += self._convert_pending_mats(pending[len(converted):], read_frame, volume_path)
+                # Stamped with the size and time from before the file was read, so a file still being written then
+                # is seen as changed and converted again
+                for _, mat_path, file_stat in converted:
+                        progress['converted'][mat_path.name] = file_stat
+                print('Converted {} of {} new .mat files'.format(len(converted), len(pending)))
+
+                complete_slices = self._count_complete_slices(progress)
+                if complete_slices > progress['complete_slices']:
+                        print('{} of {} elevational slices complete'.format(complete_slices,
+                                                                           self._count_incremental_slices()))
+                        self._refresh_incremental_output(np.load(str(volume_path), mmap_mode='r'), complete_slices)
+                        progress['complete_slices'] = complete_slices
+
+                with util.atomic_write(self._incremental_path('.json')) as temp_path:
+                        util.write_json(progress, temp_path)
+
+                return len(converted)
+
+        def _incremental_path(self, suffix) -> Path:
+                """Get the path of the partial volume (.npy) or its progress file (.json)"""
+                if self.memmap_dir is None:
+                        state_dir = self.output_dir
+                else:
+                        state_dir = self.memmap_dir
+                os.makedirs(str(state_dir), exist_ok=True)
+
+                return Path(state_dir, Path(self.output_name).stem + '_partial' + suffix)
+
+        def _read_progress(self) -> dict:
+                progress_path = self._incremental_path('.json')
+                if progress_path.is_file():
+                        return util.read_json(progress_path)
+
+                return {'first_iteration': extract_iteration_from_path(Path(self.mat_list[0])),
+                        'converted': {}, 'complete_slices': 0}
+
+        def _find_pending_mats(self, progress: dict) -> list:
+                """List the (stack index, path, [size, modification time]) of each .mat that is new or changed since it
+                was converted"""
+                self.mat_list = self._read_sorted_list_mats()
+                pending = []
+                for mat_path in self.mat_list:
+                        mat_path = Path(mat_path)
+                        stat = mat_path.stat()
+                        file_stat = [stat.st_size, stat.st_mtime_ns]
+                        if progress['converted'].get(mat_path.name) == file_stat:
+                                continue
+
+                        idx = extract_iteration_from_path(mat_path) - progress['first_iteration']
+                        if 0 <= idx < len(self.pos_list):
+                                pending.append((int(self.grid.stack_index(idx)), mat_path, file_stat))
+                        else:
+                                warnings.warn('{} is outside the position list.  Skipping'.format(mat_path.name))
+
+                return pending
+
+        def _convert_pending_mats(self, pending: list, read_frame, volume_path: Path) -> list:
+                """Convert each pending .mat into its frame of the volume, returning the pending entries that were read"""
+                converted = []
+                if self.num_workers <= 1:
+                        for entry in pending:
+                                idx, mat_path, _ = entry
+                                try:
+                                        _read_frame_into_stack(mat_path, read_frame, volume_path, idx)
+                                        converted.append(entry)
+                                except (OSError, ValueError) as error:
+                                        print('Could not read {} yet: {}'.format(mat_path.name, error))
+
+                        return converted
+
+                with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                        futures = {executor.submit(_read_frame_into_stack, entry[1], read_frame, volume_path, entry[0]):
+                                   entry for entry in pending}
+                        for future in as_completed(futures):
+                                try:
+                                        future.result()
+                                        converted.append(futures[future])
+                                except (OSError, ValueError) as error:
+                                        print('Could not read {} yet: {}'.format(futures[future][1].name, error))
+
+                return converted
+
+        def _count_incremental_slices(self) -> int:
+                return self.grid.shape[1]
+
+        def _count_complete_slices(self, progress: dict) -> int:
+                """
+                Count the leading elevational slices converted at every lateral position
+                """
+                is_converted = np.zeros(self.grid.shape, dtype=bool)
+                for mat_path in self.mat_list:
+                        idx = extract_iteration_from_path(Path(mat_path)) - progress['first_iteration']
+                        if Path(mat_path).name in progress['converted'] and 0 <= idx < len(self.pos_list):
+                                is_converted[self.grid.lateral_index[idx], self.grid.elevational_index[idx]] = True
+
+                slice_is_complete = np.all(is_converted, axis=0)
+                if np.all(slice_is_complete):
+                        return len(slice_is_complete)
+
+                return int(np.argmin(slice_is_complete))
+
+        def _refresh_incremental_output(self, volume: np.ndarray, complete_slices: int):
+                """Write the output image from the complete elevational slices of the partial volume"""
+                if self._is_single_lateral_position():
+                        self._save_us_image(self.output_name, volume[:complete_slices])
+                        return
+
+                tiles = self._array_to_laterally_separate_3d_images(volume)[:, :complete_slices]
+                if self.native_fusion or self.dataset_args['overlap_x_(%)'] is None:
+                        self._stitch_image(tiles)
+                elif complete_slices == self._count_incremental_slices():
+                        self._stitch_image(np.array(tiles))
+
+        def _is_single_lateral_position(self):
+                return len(self.pos_list) == 0 or self._count_unique_positions(0) == 1
+        
+        def _mat_list_to_array(self, variable, convert_frame=None, select_2d=False) -> np.ndarray:
+                """
+                Read the variable from each .mat file, convert it, and write it into a preallocated float32 array
+                :param variable: The variable to read from each .mat file
+                :param convert_frame: Module level function converting a single frame of the variable into its output
+                :param select_2d: Read only the 2D image of each frame, as selected by get_2d_array
+                :return: Array of the converted frames, stacked along the first axis in .mat list order
+                """
+                if self.memmap_dir is None:
+                        memmap_path = None
+                else:
+                        os.makedirs(str(self.memmap_dir), exist_ok=True)
+                        memmap_path = Path(self.memmap_dir, Path(self.output_name).stem + '_' + variable + '.npy')
+                
+                if self.cache is not None:
+                        return self._cached_frames_to_array(variable, convert_frame, select_2d, memmap_path)
+                
+                read_frame = partial(read_converted_variable, variable=variable, convert_frame=convert_frame,
+                                     select_2d=select_2d)
+                output, _ = read_mat_list(self.mat_list, read_frame, num_workers=self.num_workers,
+                                          output_path=memmap_path, dtype=np.float32,
+                                          output_indices=self._stack_indices())
+                return output
+
+        def _cached_frames_to_array(self, variable, convert_frame, select_2d, memmap_path) -> np.ndarray:
+                """Convert the cached frames of a variable into a preallocated float32 array, one frame at a time"""
+                frames = self.cache.get_frames(variable)
+                output_indices = self._stack_indices()
+                if output_indices is None:
+                        output_indices = np.arange(len(frames))
+
+                output = None
+                for idx in range(len(frames)):
+                        frame = read_squeezed_frame(frames, idx, select_2d)
+                        
+                        if convert_frame is not None:
+                                frame = convert_frame(frame)
+                        if output is None:
+                                output = _allocate_stack((len(frames),) + np.shape(frame), np.float32, memmap_path)
+                        
+                        output[output_indices[idx]] = frame
+                
+                return output
+
         def _check_for_output(self):
                 output_path = Path(self.fuse_args['output_file_directory'].replace('[', '').replace(']', ''),
                                    self.output_name)
@@ -177,7 +484,7 @@ class UltrasoundImageAssembler(object):
         
         def _stitch_image(self, bmode):
                 """
-                Stitch the image using the BigStticher plugin
+                Stitch the image using the BigStticher plugin, or natively if native_fusion is set
                 :param bmode: the 4D array (3 dimensions + lateral tiles) bmode of the US
                 :return:
                 """
@@ -185,6 +492,19 @@ class UltrasoundImageAssembler(object):
                 if self.dataset_args['overlap_x_(%)'] is None:
                         self._save_us_image(self.output_name, bmode[0])
                         return
+                
+                if self.native_fusion and self.pyramid_levels is not None:
+                        fused = st.fuse_tiles_along_x(bmode, self.dataset_args['overlap_x_(%)'],
+                                                      num_workers=self.num_workers)
+                        self._save_us_image(self.output_name, fused)
+                        return
+
+                if self.native_fusion:
+                        output_path = Path(self.fuse_args['output_file_directory'].replace('[', '').replace(']', ''),
+                                           self.output_name)
+                        st.fuse_tiles_to_tif(bmode, self.dataset_args['overlap_x_(%)'], output_path,
+                                             self._get_spacing(), num_workers=self.num_workers)
+                        return
                         
                 stitcher = st.BigStitcher(self._ij)
                 stitcher.stitch_from_numpy(bmode, self.dataset_args, self.fuse_args,
@@ -258,9 +578,10 @@ class UltrasoundImageAssembler(object):
                 """Get the spacing of the resulting image in microns"""
                 lateral_spacing = self.params['lateral resolution']
                 axial_spacing = self.params['axial resolution']
-                try:
+                elevational_spacing = None
+                if len(self.pos_list) > 0:
                         elevational_spacing = self._calculate_position_separation(1)
-                except TypeError:
+                if elevational_spacing is None:
                         elevational_spacing = np.max([lateral_spacing, axial_spacing])
                         warning = 'No elevational spacing found. Setting to max of lateral and axial: {}'.format(
                                 elevational_spacing)
@@ -269,18 +590,34 @@ class UltrasoundImageAssembler(object):
                 spacing = [lateral_spacing, axial_spacing, elevational_spacing]
                 return spacing
 
+        def _get_origin(self):
+                """
+                Get the X, Y, Z origin of the output image in microns: the stage position of the first lateral and
+                elevational tile, with the top of the image as the axial origin.  None without a position list
+                """
+                if len(self.pos_list) == 0:
+                        return None
+
+                xy_origin = np.min(self.pos_list, 0)
+                return [xy_origin[0], 0, xy_origin[1]]
+
         def _image_list_to_laterally_separate_3d_images(self, image_list):
                 """
                 Convert a list of 2d numpy arrays into 4d numpy array of laterally separate 3d images
                 """
                 # todo: check for multiple angles and select middle angle if exists?
                 image_array = self._get_2d_array(np.array(image_list))
+                stack = np.empty(np.shape(image_array), dtype=image_array.dtype)
+                stack[self._stack_indices()] = image_array
+                return self._array_to_laterally_separate_3d_images(stack)
+        
+        def _array_to_laterally_separate_3d_images(self, image_array):
+                """
+                Reshape a 3D array of 2D images, placed by _stack_indices, into a 4d array of laterally separate 3d
+                images
+                """
                 shape_2d = np.shape(image_array[0])
-                
-                num_lateral = self._count_unique_positions(0)
-                num_elevational = self._count_unique_positions(1)
-                
-                list_shape = [num_lateral, num_elevational, shape_2d[0], shape_2d[1]]
+                list_shape = [self.grid.shape[0], self.grid.shape[1], shape_2d[0], shape_2d[1]]
                 array_of_3d_images = np.reshape(image_array, list_shape)
                 
                 return array_of_3d_images
@@ -292,21 +629,19 @@ class UltrasoundImageAssembler(object):
                 :param image_list: list of each IQData array from the .mat files
                 :return: image_array: A 3D numpy array corresponding to a list of 2D IQ images
                 """
-                shape = np.shape(image_list[0])
-                dims = np.size(shape)
-                if dims == 3:
-                        image_array = np.array(image_list[:, :, :, np.int(np.floor(shape[2] / 2))])
-                elif dims == 5:
-                        image_array = np.array(image_list[:, :, :, np.int(np.floor(shape[2] / 2)), 1, 1])
-                elif dims == 2:
-                        image_array = np.array(image_list)
-                else:
-                        raise(NotImplementedError, 'Image conversion not implemented for this {} IQ dimensions'.format(dims))
-                
-                return image_array
+                return get_2d_array(image_list)
         # Images
         def _mat_list_to_variable_list(self, variable):
                 """Acquire a sorted list containing the specified variable in each mat file"""
+                if self.cache is not None:
+                        frames = self.cache.get_frames(variable)
+                        return [read_squeezed_frame(frames, idx) for idx in range(len(frames))]
+                
+                if self.num_workers > 1:
+                        variable_array, _ = read_mat_list(self.mat_list, partial(read_variable, variable=variable),
+                                                          num_workers=self.num_workers)
+                        return list(variable_array)
+                
                 variable_list = [read_variable(file_path, variable) for file_path in self.mat_list]
                 return variable_list
         
@@ -316,34 +651,46 @@ class UltrasoundImageAssembler(object):
                 if self.pl_path is None:
                         return [], []
 
-                acquisition_dict = util.read_json(self.pl_path)
+                if self.cache is not None:
+                        acquisition_dict = self.cache.get_positions()
+                else:
+                        acquisition_dict = util.read_json(self.pl_path)
                 return clean_position_text(acquisition_dict)
         
+        @property
+        def pos_list(self):
+                return self._pos_list
+
+        @pos_list.setter
+        def pos_list(self, pos_list):
+                self._pos_list = pos_list
+                self._grid = None
+
+        @property
+        def grid(self):
+                """The grid index of the position list, built the first time it is needed"""
+                if self._grid is None:
+                        self._grid = PositionGrid(self.pos_list)
+
+                return self._grid
+
         def _count_unique_positions(self, axis):
                 """Determine how many unique positions the position list holds along a particular axis"""
-                num_unique = len(np.unique(self.pos_list[:, axis]))
-                return num_unique
+                return self.grid.shape[axis]
         
         def _calculate_position_separation(self, axis):
                 """Check the distance between points along an axis"""
-                unique = np.unique(self.pos_list[:, axis])
-                
-                if len(unique) > 1:
-                        separations = np.array([unique[i+1] - unique[i] for i in range(len(unique)-1)])
-                        unique_separations = np.unique(separations)
-                        
-                        if len(unique_separations) > 1:
-                                if not util.list_values_approx_equal(unique_separations, 1E-3):
-                                        raise ValueError('There is more than one separation distance.' \
-                                                         + ' This grid is irregular\n' \
-                                                         + str(unique_separations))
-                        
-                        return np.abs(unique_separations[0])
-                        
-                else:
-                        separation = None
-                
-                return separation
+                return self.grid.separation(axis)
+
+        def _stack_indices(self):
+                """
+                Get the index in the stack of [lateral, elevational] frames of each .mat in mat_list, or None if there
+                is no position list to place them by
+                """
+                if len(self.pos_list) == 0:
+                        return None
+
+                return self.grid.stack_index(np.arange(len(self.mat_list)))
 
         def _calculate_percent_overlap(self, transducer_fov=12800) -> int:
                 """Calculate the percentage overlap between X images"""
@@ -367,13 +714,101 @@ class UltrasoundImageAssembler(object):
                 return list_mats_sorted
 
         # Parameters
-        
-        
+
+
+class PositionGrid(object):
+        def __init__(self, pos_list, rel_tol: float=1E-3):
+                """
+                Index of the lateral (X) and elevational (Y) grid of a position list, built once.
+
+                Each position is placed on the grid by the rank of its X and Y among the unique values, so frames can
+                be written straight into a [lateral, elevational] stack whatever order they were acquired or read in.
+                :param pos_list: Array of X, Y positions, one per .mat iteration
+                :param rel_tol: Relative tolerance for the separations along an axis to count as one regular spacing
+                """
+                positions = np.reshape(np.asarray(pos_list, dtype=float), [-1, 2])
+                self.rel_tol = rel_tol
+
+                self.unique_positions = []
+                indices = []
+                for axis in range(2):
+                        unique, index = np.unique(positions[:, axis], return_inverse=True)
+                        self.unique_positions.append(unique)
+                        indices.append(np.reshape(index, -1))
+
+                self.lateral_index, self.elevational_index = indices
+                self.shape = (len(self.unique_positions[0]), len(self.unique_positions[1]))
+                self._separations = [self._find_separation(unique) for unique in self.unique_positions]
+
+        def stack_index(self, position_index):
+                """Get the index of a position in a [lateral, elevational] stack flattened in C order"""
+                return self.lateral_index[position_index]*self.shape[1] + self.elevational_index[position_index]
+
+        def separation(self, axis: int):
+                """
+                Get the separation between neighbouring positions along an axis, or None if there is only one
+                :raises ValueError: If the separations along the axis differ by more than rel_tol
+                """
+                separation = self._separations[axis]
+                if isinstance(separation, ValueError):
+                        raise separation
+
+                return separation
+
+        def _find_separation(self, unique: np.ndarray):
+                if len(unique) < 2:
+                        return None
+
+                separations = np.unique(np.diff(unique))
+                # The differences are positive, so they are all close to each other if the extremes are
+                if not math.isclose(separations[0], separations[-1], rel_tol=self.rel_tol):
+                        return ValueError('There is more than one separation distance.  This grid is irregular\n'
+                                          + str(separations))
+
+                return np.abs(separations[0])
+
+
 def read_parameters(mat_path: Path) -> dict:
         """
         Get the parameters from an acquisition and return a cleaned up dictionary
         """
-        params_raw = read_variable(mat_path, 'P')
+        params_raw = read_raw_parameters(mat_path)
+        return clean_parameters(params_raw)
+
+
+def read_raw_parameters(mat_path: Path) -> dict:
+        """Get the raw P parameter struct of an acquisition, without reading the image data of the .mat file"""
+        return copy.deepcopy(read_metadata(mat_path)['P'])
+
+
+def read_variable_info(mat_path: Path, variable: str) -> tuple:
+        """Get the (shape, MATLAB class) of a variable in a .mat file, without reading its data"""
+        return read_metadata(mat_path)['variables'][variable]
+
+
+def read_metadata(mat_path: Path) -> dict:
+        """
+        Read the P parameter struct and the shape and class of every variable in a .mat file.
+        
+        Only the struct is decoded, and the result is remembered for each file until the file changes, so every
+        parameter reader of an acquisition shares a single read.
+        :param mat_path: Path to the .mat file
+        :return: Dictionary with the raw 'P' struct and the 'variables' listing of the file
+        """
+        stat = os.stat(str(mat_path))
+        return _read_metadata(str(Path(mat_path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=256)
+def _read_metadata(mat_path: str, size: int, mtime_ns: int) -> dict:
+        """Memoized by path, size and modification time so that a rewritten file is read again"""
+        return {'P': read_variable(mat_path, 'P'), 'variables': util.whos_mat(mat_path)}
+
+
+def clean_parameters(params_raw: dict) -> dict:
+        """
+        Convert the raw P parameter struct of an acquisition into a cleaned up dictionary, in units of microns
+        """
         params = {}
         
         wl = params_raw['wavelength_micron']
@@ -407,6 +842,187 @@ def read_variable(file_path, variable):
         return util.load_mat(file_path, variables=variable)[variable]
 
 
+def read_2d_variable(file_path, variable):
+        """
+        Read the 2D image of a variable from a .mat file, defaulting to the middle angle and first frame.
+        
+        For v7.3 .mat files only the 2D image is read from disk.
+        """
+        if h5py.is_hdf5(str(file_path)):
+                try:
+                        with util.MatlabHDF5Array(file_path, variable) as array:
+                                return array[get_2d_index(array.shape)]
+                except NotImplementedError:
+                        pass
+        
+        return frame_to_2d(read_variable(file_path, variable))
+
+
+def read_converted_variable(file_path, variable, convert_frame=None, select_2d=False):
+        """
+        Read a variable from a .mat file and convert it with a module level function, e.g. iq_to_bmode
+        :param file_path: Path to the .mat file
+        :param variable: The variable to read
+        :param convert_frame: Function to convert the variable with.  Default returns it unchanged
+        :param select_2d: Read only the 2D image of the variable, as selected by get_2d_array
+        :return: The converted variable
+        """
+        if select_2d:
+                frame = read_2d_variable(file_path, variable)
+        else:
+                frame = read_variable(file_path, variable)
+        
+        if convert_frame is None:
+                return frame
+        
+        return convert_frame(frame)
+
+
+def read_mat_list(mat_list: list, read_frame, num_workers: int=1, output_path: Path=None,
+                  dtype=None, output_indices=None) -> (np.ndarray, list):
+        """
+        Read one array from each .mat file into a single array stacked along the first axis, in mat_list order
+        
+        With more than one worker the files are read by a process pool.  Each worker writes its frame straight into a
+        memory-mapped .npy file instead of pickling it back to the parent process.
+        :param mat_list: Sorted list of .mat files
+        :param read_frame: Picklable function that reads the array from one .mat file, e.g. a partial of read_variable
+        :param num_workers: Number of processes reading files
+        :param output_path: Path of a .npy file to memory map the output to.  Default holds the output in RAM
+        :param dtype: Data type of the output.  Default is the type of the first frame
+        :param output_indices: Index in the output of the frame of each file, e.g. from PositionGrid.stack_index.
+        Default stacks the frames in mat_list order
+        :return: The stacked array, and the time in seconds taken to read each file
+        """
+        if output_indices is None:
+                output_indices = np.arange(len(mat_list))
+
+        start = time.perf_counter()
+        first_frame = read_frame(mat_list[0])
+        timings = [time.perf_counter() - start]
+        
+        if dtype is None:
+                dtype = first_frame.dtype
+        shape = tuple([len(mat_list)] + list(np.shape(first_frame)))
+        
+        if num_workers <= 1:
+                output = _allocate_stack(shape, dtype, output_path)
+                output[output_indices[0]] = first_frame
+                for idx in range(1, len(mat_list)):
+                        start = time.perf_counter()
+                        output[output_indices[idx]] = read_frame(mat_list[idx])
+                        timings.append(time.perf_counter() - start)
+        elif output_path is None:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                        temp_path = Path(temp_dir, 'stack.npy')
+                        _read_frames_in_pool(mat_list, read_frame, num_workers, temp_path, shape, dtype,
+                                             first_frame, timings, output_indices)
+                        output = np.load(str(temp_path))
+        else:
+                output = _read_frames_in_pool(mat_list, read_frame, num_workers, output_path, shape, dtype,
+                                              first_frame, timings, output_indices)
+        
+        print('Read {} files in {:.1f} s: {:.2f} s per file, {:.2f} s for the slowest ({})'.format(
+                len(mat_list), np.sum(timings), np.mean(timings), np.max(timings),
+                Path(mat_list[int(np.argmax(timings))]).name))
+        
+        return output, timings
+
+
+def _allocate_stack(shape, dtype, output_path: Path=None) -> np.ndarray:
+        if output_path is None:
+                return np.empty(shape, dtype=dtype)
+        
+        return np.lib.format.open_memmap(str(output_path), mode='w+', dtype=dtype, shape=shape)
+
+
+def _read_frames_in_pool(mat_list, read_frame, num_workers, output_path, shape, dtype, first_frame, timings,
+                         output_indices):
+        """Fill a memory-mapped stack with a process pool, appending the read time of each file to timings"""
+        output = _allocate_stack(shape, dtype, output_path)
+        output[output_indices[0]] = first_frame
+        output.flush()
+        
+        timings.extend([0]*(len(mat_list) - 1))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(_read_frame_into_stack, mat_list[idx], read_frame, output_path,
+                                           int(output_indices[idx])): idx
+                           for idx in range(1, len(mat_list))}
+                for future in as_completed(futures):
+                        timings[futures[future]] = future.result()
+        
+        return output
+
+
+def _read_frame_into_stack(mat_path, read_frame, stack_path, idx) -> float:
+        """Worker for read_mat_list: read one frame and write it into its slot of the memory-mapped stack"""
+        start = time.perf_counter()
+        frame = read_frame(mat_path)
+        stack = np.load(str(stack_path), mmap_mode='r+')
+        stack[idx] = frame
+        stack.flush()
+        del stack
+        return time.perf_counter() - start
+
+
+def get_2d_array(image_list):
+        """
+        Return a list of 2D IQ data arrays, defaulting to the middle angle and first frame
+        
+        :param image_list: list of each IQData array from the .mat files
+        :return: image_array: A 3D numpy array corresponding to a list of 2D IQ images
+        """
+        index_2d = get_2d_index(np.shape(image_list[0]))
+        image_array = np.array(image_list[(slice(None),) + index_2d])
+        
+        return image_array
+
+
+def get_2d_index(shape) -> tuple:
+        """
+        Get the index selecting the 2D image from a single frame of IQ data, defaulting to the middle angle and first
+        frame
+        :param shape: Shape of the frame
+        :return: Tuple to index the frame with
+        """
+        dims = np.size(shape)
+        if dims == 3:
+                return slice(None), slice(None), int(np.floor(shape[2] / 2))
+        elif dims == 5:
+                return slice(None), slice(None), int(np.floor(shape[2] / 2)), 1, 1
+        elif dims == 2:
+                return slice(None), slice(None)
+        else:
+                raise NotImplementedError('Image conversion not implemented for {} IQ dimensions'.format(dims))
+
+
+def read_squeezed_frame(frames, idx: int, select_2d: bool=False) -> np.ndarray:
+        """
+        Read one frame of an AcquisitionCache without its singleton axes, as read_variable returns it
+        :param frames: Frames from AcquisitionCache.get_frames, which keeps every axis
+        :param idx: Index of the frame
+        :param select_2d: Read only the 2D image of the frame, as frame_to_2d selects it
+        :return: The frame
+        """
+        frame_shape = frames.shape[1:]
+        kept_axes = [axis for axis, length in enumerate(frame_shape) if length != 1]
+        key = [0]*len(frame_shape)
+        
+        if select_2d:
+                index_2d = get_2d_index(tuple(frame_shape[axis] for axis in kept_axes))
+        else:
+                index_2d = [slice(None)]*len(kept_axes)
+        for axis, item in zip(kept_axes, index_2d):
+                key[axis] = item
+        
+        return np.asarray(frames[(idx,) + tuple(key)])
+
+
+def frame_to_2d(frame: np.ndarray) -> np.ndarray:
+        """Select the 2D image of a single .mat frame, as get_2d_array does for a list of frames"""
+        return np.array(np.asarray(frame)[get_2d_index(np.shape(frame))])
+
+
 def clean_position_text(pos_text: dict) -> (np.ndarray, list):
         """Convert a Micromanager acquired position file into a list of X, Y positions"""
         pos_list_raw = pos_text['POSITIONS']
@@ -425,8 +1041,7 @@ def extract_iteration_from_path(file_path):
 
 
 def iq_to_db(image_array):
-        db = 20 * np.log10(np.abs(image_array) + np.min(np.abs(image_array))*0.001)
-        return db.astype('f')
+        return conv.decibels(image_array)
 
 
 def get_origin(pl_path, params_path, gauge_value):
@@ -489,15 +1104,22 @@ def open_iq(iq_path: Path) -> np.ndarray:
         return iq_data
 
 
+def open_rf(rf_path: Path) -> np.ndarray:
+        """Open a .mat that holds RData from the Verasonics system"""
+        mat_data = sio.loadmat(str(rf_path))
+        rf_data = mat_data['RData']
+        
+        return rf_data
+
+
 def open_parameters(iq_path: Path) -> dict:
         """Get the parameters from an acquisition and return a cleaned up dictionary"""
-        mat_data = sio.loadmat(str(iq_path))
-        param_raw = mat_data['P']
+        param_raw = read_raw_parameters(iq_path)
         parameters = format_parameters(param_raw)
         return parameters
 
 
-def format_parameters(param_raw: np.ndarray) -> dict:
+def format_parameters(param_raw: dict) -> dict:
         """Format the parameters array loaded from matlab struct
     
         All numeric values are currently in units of wavelength"""
@@ -523,10 +1145,7 @@ def format_parameters(param_raw: np.ndarray) -> dict:
 
 def iq_to_bmode(iq_array: np.ndarray) -> np.ndarray:
         """Convert complex IQ data into bmode through squared transform"""
-        env = np.abs(iq_array)
-        bmode = 20*np.log10(env + 1)
-        
-        return bmode
+        return conv.bmode(iq_array)
 
 
 def read_position_list(pl_path: Path) -> list:
@@ -583,32 +1202,39 @@ def get_idx_img_z(idx_raw: int, num_xy: np.ndarray, num_imgs: int) -> [int, int]
         return int(idx_img), int(idx_z)
 
 
-def mat_list_to_iq_array(mats_list: list) -> (np.ndarray, dict):
-        """Make an IQ array from a list of mats"""
+def mat_list_to_iq_array(mats_list: list, num_workers: int=1, acquisition_cache=None) -> (np.ndarray, dict):
+        """Make an IQ array from a list of mats, or from an AcquisitionCache of them"""
+        if acquisition_cache is not None:
+                parameters = format_parameters(acquisition_cache.get_parameters())
+                iq_array = np.array(acquisition_cache.get_frames('IQData'))
+                return iq_array, parameters
+        
         parameters = open_parameters(mats_list[0])
         
-        iq_array = np.array(
-                [open_iq(x) for x in mats_list]
-        )
+        iq_array, _ = read_mat_list(mats_list, open_iq, num_workers=num_workers)
         
         # todo: fix horizontal flipping in final image
         
         return iq_array, parameters
 
 
-def mat_list_to_rf_array(mats_list: list) -> (np.ndarray, dict):
-        """Make an RF array from a list of mats"""
-        rf_array = np.array(
-                [open_rf(x) for x in mats_list]
-        )
+def mat_list_to_rf_array(mats_list: list, num_workers: int=1, acquisition_cache=None) -> (np.ndarray, dict):
+        """Make an RF array from a list of mats, or from an AcquisitionCache of them"""
+        if acquisition_cache is not None:
+                parameters = format_parameters(acquisition_cache.get_parameters())
+                rf_array = np.array(acquisition_cache.get_frames('RData'))
+                return rf_array, parameters
+        
+        rf_array, _ = read_mat_list(mats_list, open_rf, num_workers=num_workers)
         parameters = open_parameters(mats_list[0])
         
         return rf_array, parameters
 
 
-def assemble_4d_envelope(mats_list: list, num_lateral_elevational: np.ndarray) -> (np.ndarray, dict):
+def assemble_4d_envelope(mats_list: list, num_lateral_elevational: np.ndarray,
+                         acquisition_cache=None) -> (np.ndarray, dict):
         """Compile IQ Data US .mats into separate 3d images"""
-        array_3d_multi_img, parameters = mat_list_to_iq_array(mats_list)
+        array_3d_multi_img, parameters = mat_list_to_iq_array(mats_list, acquisition_cache=acquisition_cache)
         array_3d_env = np.abs(array_3d_multi_img)
         shape_image = np.shape(array_3d_env[0, :, :])
         
@@ -619,9 +1245,10 @@ def assemble_4d_envelope(mats_list: list, num_lateral_elevational: np.ndarray) -
         return array_4d, parameters
 
 
-def assemble_4d_bmode(mats_list: list, num_lateral_elevational: np.ndarray) -> (np.ndarray, dict):
+def assemble_4d_bmode(mats_list: list, num_lateral_elevational: np.ndarray,
+                      acquisition_cache=None) -> (np.ndarray, dict):
         """Compile IQ Data US .mats into separate 3d images"""
-        array_3d_multi_img, parameters = mat_list_to_iq_array(mats_list)
+        array_3d_multi_img, parameters = mat_list_to_iq_array(mats_list, acquisition_cache=acquisition_cache)
         array_3d_bmode = iq_to_bmode(array_3d_multi_img)
         shape_image = np.shape(array_3d_bmode[0, :, :])
         
@@ -638,16 +1265,22 @@ def calculate_percent_overlap(x_sep: float) -> int:
         return percent_sep
 
 
-def assemble_4d_data(mats_dir: Path, pl_path: Path, data_to_return: str = 'bmode') -> (np.ndarray, dict, int):
+def assemble_4d_data(mats_dir: Path, pl_path: Path, data_to_return: str = 'bmode',
+                     cache_dir: Path=None) -> (np.ndarray, dict, int):
         list_mats = get_sorted_list_mats(mats_dir)
         list_pos = read_position_list(pl_path)
         num_lateral_elevational, lateral_separation, elevational_sep = count_xy_positions(list_pos)
         percent_overlap = calculate_percent_overlap(lateral_separation)
         
+        if cache_dir is not None:
+                acquisition_cache = cache.AcquisitionCache(list_mats, cache.cache_path_for(cache_dir, mats_dir, 'mat'))
+        else:
+                acquisition_cache = None
+        
         if data_to_return == 'bmode':
-                array_4d, parameters = assemble_4d_bmode(list_mats, num_lateral_elevational)
+                array_4d, parameters = assemble_4d_bmode(list_mats, num_lateral_elevational, acquisition_cache)
         elif data_to_return == 'envelope':
-                array_4d, parameters = assemble_4d_envelope(list_mats, num_lateral_elevational)
+                array_4d, parameters = assemble_4d_envelope(list_mats, num_lateral_elevational, acquisition_cache)
         else:
                 raise NotImplementedError
 
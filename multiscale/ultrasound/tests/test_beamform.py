@@ -27,3 +27,175 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import pytest
 
+import numpy as np
+import scipy.sparse as sp
+import scipy.signal as sig
+from pathlib import Path
+
+import multiscale.ultrasound.beamform as beam
+import multiscale.utility_functions as util
+
+
+@pytest.fixture()
+def beam_params():
+        params = {'axial samples': 12,
+                  'lines': 5,
+                  'time samples': 64,
+                  'elements': 6,
+                  'transmit samples': 3,
+                  'axial resolution': 24.64,
+                  'lateral resolution': 49.28,
+                  'transducer spacing': 100.00000000000004,
+                  'start depth': 0,
+                  'sampling frequency': 62.5E6,
+                  'speed of sound': 1540E6}
+        return params
+
+
+def looped_delays(params):
+        """Per-sample reference implementation of the delay matrix"""
+        num_positions = params['axial samples']*params['lines']
+        num_samples = params['time samples']*params['elements']
+        time_indices = []
+        position_indices = []
+        for position in range(num_positions):
+                for element in range(params['elements']):
+                        for transmit in range(params['transmit samples']):
+                                axial_distance = (position % params['axial samples'])*params['axial resolution']
+                                line = np.floor(position/params['axial samples'])
+                                lat_ptt = transmit*params['transducer spacing'] - line*params['lateral resolution']
+                                lat_pte = element*params['transducer spacing'] - line*params['lateral resolution']
+                                distance = np.sqrt(axial_distance**2 + lat_ptt**2) \
+                                        + np.sqrt(axial_distance**2 + lat_pte**2)
+                                time_indices.append(round((distance - params['start depth'])
+                                                          * params['sampling frequency'] / params['speed of sound']
+                                                          + transmit*params['transmit samples']))
+                                position_indices.append(position)
+        
+        weights = np.ones([len(time_indices)])
+        return sp.csr_matrix((weights, (np.array(position_indices), np.array(time_indices))),
+                             shape=[num_positions, num_samples])
+
+
+class TestDelayCalculator(object):
+        @pytest.mark.parametrize('chunk_entries', [1, 7, 18, 2**22])
+        def test_delays_match_looped_calculation(self, tmpdir, beam_params, chunk_entries):
+                calculator = beam.DelayCalculator(beam_params, Path(tmpdir, 'delays.npz'),
+                                                  chunk_entries=chunk_entries)
+                calculator._calculate_delays()
+                expected = looped_delays(beam_params)
+                
+                assert calculator.delays.shape == expected.shape
+                assert (calculator.delays.indptr == expected.indptr).all()
+                assert (calculator.delays.indices == expected.indices).all()
+                assert (calculator.delays.data == expected.data).all()
+
+        def test_mismatched_delay_file_is_recalculated(self, tmpdir, beam_params):
+                delays_path = Path(tmpdir, 'delays.npz')
+                beam.DelayCalculator(beam_params, delays_path).load_delays()
+                
+                beam_params['start depth'] = 10
+                calculator = beam.DelayCalculator(beam_params, delays_path)
+                calculator.load_delays()
+                
+                assert (calculator.delays != looped_delays(beam_params)).nnz == 0
+
+        
+        def test_old_parameter_file_is_recalculated(self, tmpdir, beam_params):
+                delays_path = Path(tmpdir, 'delays.npz')
+                calculator = beam.DelayCalculator(beam_params, delays_path)
+                calculator.load_delays()
+                old_params = beam.geometry_parameters(beam_params)
+                del old_params[beam.DELAY_PARAMETERS[0]]
+                util.write_json(old_params, calculator.params_path)
+                
+                calculator = beam.DelayCalculator(beam_params, delays_path)
+                calculator.load_delays()
+                
+                assert (calculator.delays != looped_delays(beam_params)).nnz == 0
+                assert util.read_json(calculator.params_path) == beam.geometry_parameters(beam_params)
+
+class TestDelayCache(object):
+        def test_cache_round_trip(self, tmpdir, beam_params):
+                cache = beam.DelayCache(Path(tmpdir))
+                delays = looped_delays(beam_params)
+                assert cache.get(beam_params) is None
+                
+                cache.put(beam_params, delays)
+                cached = cache.get(beam_params)
+                
+                assert (cached != delays).nnz == 0
+        
+        def test_hash_ignores_non_geometry_parameters(self, beam_params):
+                other_params = dict(beam_params)
+                other_params['end depth'] = 5000
+                other_params['axial samples'] = float(beam_params['axial samples'])
+                
+                assert beam.hash_geometry(beam_params) == beam.hash_geometry(other_params)
+        
+        def test_cache_holds_several_geometries(self, tmpdir, beam_params):
+                cache = beam.DelayCache(Path(tmpdir))
+                other_params = dict(beam_params)
+                other_params['start depth'] = 10
+                
+                cache.put(beam_params, looped_delays(beam_params))
+                cache.put(other_params, looped_delays(other_params))
+                
+                assert (cache.get(beam_params) != looped_delays(beam_params)).nnz == 0
+                assert (cache.get(other_params) != looped_delays(other_params)).nnz == 0
+        
+        def test_least_recently_used_entry_is_evicted(self, tmpdir, beam_params):
+                cache = beam.DelayCache(Path(tmpdir), size_mb=0)
+                other_params = dict(beam_params)
+                other_params['start depth'] = 10
+                
+                cache.put(beam_params, looped_delays(beam_params))
+                cache.put(other_params, looped_delays(other_params))
+                
+                assert cache.get(beam_params) is None
+                assert cache.get(other_params) is not None
+        
+        def test_calculator_uses_cache(self, tmpdir, beam_params, monkeypatch):
+                beam.DelayCalculator(beam_params, cache_dir=Path(tmpdir)).load_delays()
+                
+                calculator = beam.DelayCalculator(beam_params, cache_dir=Path(tmpdir))
+                monkeypatch.setattr(calculator, '_calculate_delays', lambda: pytest.fail('Delays were recalculated'))
+                
+                assert (calculator.get_delays() != looped_delays(beam_params)).nnz == 0
+
+
+def looped_bmode(rf_frame, params, delays):
+        """Single frame reference beamforming"""
+        temp_array = np.zeros(np.shape(rf_frame))
+        half_time = int(params['time samples'] / 2)
+        temp_array[::2] = rf_frame[half_time:]
+        temp_array[1::2] = rf_frame[:half_time]
+        summation = delays @ temp_array.flatten('F')
+        rf = np.reshape(summation, [params['axial samples'], params['lines']], order='F')
+        env = np.abs(sig.hilbert(rf))
+        db = 20 * np.log10(env + np.min(env)*0.001)
+        return db.astype('f')
+
+
+class TestBeamformer(object):
+        @pytest.fixture()
+        def rf_stack(self, beam_params):
+                return np.random.randint(-2**10, 2**10, size=[4, beam_params['time samples'],
+                                                               beam_params['elements']]).astype(np.int16)
+        
+        def test_single_frame_matches_reference(self, beam_params, rf_stack):
+                delays = looped_delays(beam_params)
+                bmode = beam.Beamformer(rf_stack[0], beam_params, delays).get_bmode()
+                expected = looped_bmode(rf_stack[0], beam_params, delays)
+                
+                assert bmode.shape == (beam_params['axial samples'], beam_params['lines'])
+                assert np.allclose(bmode, expected, rtol=1E-6)
+        
+        def test_stack_matches_single_frames(self, beam_params, rf_stack):
+                delays = looped_delays(beam_params)
+                bmode = beam.Beamformer(rf_stack, beam_params, delays).get_bmode()
+                
+                assert bmode.shape == (4, beam_params['axial samples'], beam_params['lines'])
+                for idx in range(len(rf_stack)):
+                        expected = looped_bmode(rf_stack[idx], beam_params, delays)
+                        assert np.allclose(bmode[idx], expected, rtol=1E-6)
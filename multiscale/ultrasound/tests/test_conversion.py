@@ -0,0 +1,54 @@
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+import multiscale.ultrasound.conversion as conv
+import multiscale.itk.process as proc
+
+
+@pytest.fixture(scope='module')
+def iq_array():
+        return 100*(np.random.rand(6, 40, 30) + 1j*np.random.rand(6, 40, 30))
+
+
+@pytest.mark.parametrize('num_workers, chunk_size', [(1, 2**18), (3, 1000)])
+def test_envelope_and_bmode(iq_array, num_workers, chunk_size):
+        envelope = conv.envelope(iq_array, num_workers=num_workers, chunk_size=chunk_size)
+        bmode = conv.bmode(iq_array, num_workers=num_workers, chunk_size=chunk_size)
+        
+        assert envelope.dtype == np.float32 and bmode.dtype == np.float32
+        assert np.allclose(envelope, np.abs(iq_array), rtol=1E-6)
+        assert np.allclose(bmode, 20*np.log10(np.abs(iq_array) + 1), rtol=1E-6, atol=1E-5)
+
+
+@pytest.mark.parametrize('num_workers, chunk_size', [(1, 2**18), (3, 1000)])
+def test_decibels(iq_array, num_workers, chunk_size):
+        env = np.abs(iq_array)
+        expected = 20*np.log10(env + np.min(env)*0.001)
+        output = conv.decibels(iq_array, num_workers=num_workers, chunk_size=chunk_size)
+        assert output.dtype == np.float32
+        assert np.allclose(output, expected, rtol=1E-6, atol=1E-5)
+
+
+def test_decibels_per_frame(iq_array):
+        env = np.abs(iq_array)
+        expected = 20*np.log10(env + np.min(env, axis=(1, 2), keepdims=True)*0.001)
+        assert np.allclose(conv.decibels(iq_array, per_frame=True), expected, rtol=1E-6, atol=1E-5)
+
+
+def test_decibels_written_into_out(iq_array):
+        out = np.empty(iq_array.shape, dtype=np.float32)
+        output = conv.decibels(iq_array, out=out)
+        assert output is out
+
+
+def test_window_matches_sitk(iq_array):
+        db = conv.decibels(iq_array)
+        expected = sitk.GetArrayFromImage(proc.window_image(sitk.GetImageFromArray(db), 20))
+        
+        output = conv.window_dynamic_range(db, 20, num_workers=2, chunk_size=500)
+        fused = conv.decibels(iq_array, dynamic_range=20)
+        
+        assert output.dtype == np.uint8
+        assert np.abs(output.astype(int) - expected).max() <= 1
+        assert (fused == output).all()
@@ -2,6 +2,9 @@ import numpy as np
 import scipy.signal as sig
 import multiscale.ultrasound.correlation as corr
 import pytest
+import pandas as pd
+import scipy.io as sio
+from pathlib import Path
 
 
 @pytest.fixture(scope='module')
@@ -85,3 +88,151 @@ class TestDetrend(object):
 #
 #         array_from_func = corr.detrend_along_dimension_and_subtract_mean(array_dummy, dim_detrend=0, dim_to_average=1)
 #         assert (array_mean == array_from_func).all()
+
+
+def looped_autocorrelation_curve(window, dim_of_corr):
+    """Reference curve, calculated one line and one shift at a time with np.corrcoef"""
+    corr_curve = []
+    for shift in range(min(int(np.shape(window)[dim_of_corr]/2), 10) + 1):
+        corr_along_lines = np.apply_along_axis(corr.calculate_1d_autocorrelation, dim_of_corr, window, shift)
+        corr_curve.append(np.mean(corr_along_lines))
+    
+    return np.array(corr_curve)
+
+
+class TestAutocorrelation(object):
+    @pytest.fixture(scope='class')
+    def window(self):
+        return np.random.rand(6, 30, 9)**2 + 3
+    
+    @pytest.mark.parametrize('dim_of_corr', [0, 1, 2])
+    def test_curve_matches_looped_corrcoef(self, window, dim_of_corr):
+        expected = looped_autocorrelation_curve(window, dim_of_corr)
+        output = corr.calculate_1d_autocorrelation_curve(window, dim_of_corr)
+        assert len(output) == len(expected)
+        assert np.allclose(output, expected)
+    
+    def test_each_line_matches_corrcoef(self, window):
+        output = corr.calculate_autocorrelation_along_axis(window, 1, 4)
+        assert output.shape == (4, 6, 9)
+        assert np.isclose(output[3, 2, 5], corr.calculate_1d_autocorrelation(window[2, :, 5], 3))
+    
+    def test_curves_per_window(self, window):
+        curves = corr.calculate_curves_per_window(window)
+        assert [len(curves[axis]) for axis in ['Elevational', 'Axial', 'Lateral']] == [4, 11, 5]
+        for dim_of_corr, axis in enumerate(['Elevational', 'Axial', 'Lateral']):
+            assert np.allclose(curves[axis], looped_autocorrelation_curve(window, dim_of_corr))
+
+
+class TestDepthSweep(object):
+    def test_window_sweep(self):
+        params_window = {'Axial size mm': 1, 'Start of depth range mm': 6, 'End of depth range mm': 8,
+                         'Depth step mm': 0.25}
+        output = corr.determine_window_sweep(params_window, {'Axial resolution': 0.05})
+        assert (output[:, 1] - output[:, 0] == 20).all()
+        assert (output[:, 0] == np.arange(120, 141, 5)).all()
+    
+    def test_each_depth_matches_calc_corr_curves(self):
+        # Uncorrelated speckle attenuating with depth, so a single line fit over the whole range would not detrend it
+        env_array = np.random.rayleigh(size=(4, 400, 6))*np.exp(-np.arange(400)/80)[:, np.newaxis]
+        params_window = {'Axial size mm': 60, 'Start of depth range mm': 0, 'End of depth range mm': 400,
+                         'Depth step mm': 20}
+        params_acq = {'Axial resolution': 1}
+        depths_start_end = corr.determine_window_sweep(params_window, params_acq)
+        output = corr.calculate_correlation_curves_at_all_depths(env_array, depths_start_end)
+        
+        for idx, (start, end) in enumerate(depths_start_end):
+            params_single = {'Start of depth range mm': start, 'End of depth range mm': end}
+            curves = corr.calc_corr_curves(env_array, params_single, params_acq)
+            for idx_axis, axis in enumerate(['Elevational', 'Axial', 'Lateral']):
+                num_lags = len(curves[axis])
+                assert np.allclose(output[idx, :num_lags, idx_axis], curves[axis], atol=1E-5)
+                assert np.isnan(output[idx, num_lags:, idx_axis]).all()
+        
+        assert np.all(np.abs(output[:, 1:, 1]) < 0.3)
+    
+    def test_max_lag_is_passed_to_windows(self):
+        env_array = np.random.rand(3, 80, 50) + 1
+        output = corr.calculate_correlation_curves_at_all_depths(env_array, np.array([[0, 60]]), max_lag=20)
+        assert not np.isnan(output[0, :, 1:]).any()
+
+
+class TestBulkCorrelation(object):
+    @pytest.fixture()
+    def iq_dirs(self, tmpdir):
+        params = {'lateral_resolution': 0.1, 'axial_resolution': 0.1, 'speed_of_sound': 1540, 'txFocus': 80,
+                  'startDepth': 5, 'endDepth': 120, 'transducer_spacing': 0.1, 'wavelength_micron': 100}
+        list_dirs = []
+        for name in ['scan_a', 'scan_b']:
+            dir_iq = tmpdir.mkdir(name)
+            for idx in range(6):
+                iq = np.random.rand(100, 16) + 1j*np.random.rand(100, 16)
+                sio.savemat(str(Path(dir_iq, 'Frame_It-{}_IQ.mat'.format(idx))), {'IQData': iq, 'P': params})
+            list_dirs.append(Path(dir_iq))
+        
+        return list_dirs
+    
+    @pytest.mark.parametrize('num_workers', [1, 2])
+    def test_table_matches_single_directory(self, tmpdir, iq_dirs, num_workers):
+        path_output = Path(tmpdir, 'curves.csv')
+        table = corr.bulk_corr_curves_to_table(iq_dirs, path_output, num_workers=num_workers, max_in_flight=1)
+        
+        iq_array, params = corr.load_iq(iq_dirs[1])
+        params['Elevational resolution'] = 0.02
+        curves = corr.calc_corr_curves(corr.iq_to_envelope(iq_array), corr.define_correlation_window(params), params)
+        rows = table[(table['directory'] == str(iq_dirs[1])) & (table['axis'] == 'Axial')]
+        
+        assert list(table.columns) == ['directory', 'axis', 'lag', 'value', 'lag mm']
+        assert list(table['directory'].unique()) == [str(path) for path in iq_dirs]
+        assert np.allclose(rows['value'].values, curves['Axial'])
+        assert (pd.read_csv(str(path_output))['lag'] == table['lag']).all()
+
+    
+    def test_no_directories_give_empty_table(self, tmpdir):
+        table = corr.bulk_corr_curves_to_table([], Path(tmpdir, 'curves.csv'), num_workers=2)
+        assert table.empty
+        assert list(table.columns) == ['directory', 'axis', 'lag', 'value', 'lag mm']
+    
+    def test_single_lag_curves_are_not_plotted(self, monkeypatch):
+        plotted = []
+        monkeypatch.setattr(corr, 'plot_corr_curve', lambda curve, axis, spacing: plotted.append((axis, spacing)))
+        curves = {'Elevational': np.array([1.0]), 'Axial': np.array([1.0, 0.5, 0.2])}
+        table = corr.curves_to_table(curves, {'Elevational resolution': 0.02, 'Axial resolution': 0.05}, 'scan')
+        
+        corr.plot_corr_curves_from_table(table)
+        assert plotted == [('Axial', pytest.approx(0.05))]
+
+
+class TestDetrendWindow(object):
+    @pytest.mark.parametrize('dim_detrend', [0, 1, 2])
+    def test_add_back_mean_matches_scipy(self, rand_array, dim_detrend):
+        array_detrend = sig.detrend(rand_array, axis=dim_detrend)
+        expected = array_detrend + np.mean(array_detrend, axis=dim_detrend, keepdims=True)
+        output = corr.detrend_and_add_back_mean(rand_array, dim_detrend)
+        assert output.dtype == np.float64
+        assert np.allclose(output, expected, atol=1E-12)
+    
+    @pytest.mark.parametrize('dim_detrend', [0, 1, 2])
+    def test_subtract_mean_matches_scipy(self, rand_array, dim_detrend):
+        expected = sig.detrend(rand_array, axis=dim_detrend)
+        output = corr.detrend_and_subtract_mean(rand_array, dim_detrend)
+        assert output.dtype == np.float64
+        assert np.allclose(output, expected, atol=1E-12)
+    
+    def test_square_in_place(self):
+        window = np.random.rand(7, 20, 9).astype(np.float32) + 1
+        axial_means = np.mean(window, 1, keepdims=True, dtype=np.float64)
+        expected = np.square(sig.detrend(window.astype(np.float64), axis=1) + axial_means)
+        
+        output = corr.detrend_window(window, 1, square=True, out=window)
+        assert output is window
+        assert np.allclose(window, expected, rtol=1E-5)
+    
+    def test_single_line_matches_scipy(self):
+        line = np.random.rand(50) + 1
+        output = corr.detrend_window(line, 0, mean='subtract', out=np.empty(50))
+        assert np.allclose(output, sig.detrend(line), atol=1E-12)
+    
+    def test_invalid_dimension_raises_error(self, rand_array):
+        with pytest.raises(ValueError):
+            corr.detrend_and_add_back_mean(rand_array, 3)
@@ -1,9 +1,16 @@
 import pytest
 import multiscale.ultrasound.reconstruction as recon
+import multiscale.ultrasound.acquisition_cache as cache
+import multiscale.imagej.stitching as st
+import multiscale.microscopy.ome as ome
+import tiffile as tif
 import multiscale.utility_functions as util
 import scipy.io as sio
+import h5py
 import numpy as np
 from pathlib import Path
+from functools import partial
+import shutil
 
 
 #
@@ -194,8 +201,8 @@ class TestUltrasoundImageAssembler(object):
                              'start depth':  492.8, 'end depth': 15769.6, 'transducer spacing': 100.00000000000004,
                              'sampling wavelength': 98.56, 'speed of sound': 1540E6}
                 
-                monkeypatch.setattr('multiscale.ultrasound.reconstruction.read_variable',
-                                    lambda x, y: raw_params)
+                monkeypatch.setattr('multiscale.ultrasound.reconstruction.read_raw_parameters',
+                                    lambda x: raw_params)
                 
                 params = recon.read_parameters(Path('Test'))
                 
@@ -226,6 +233,340 @@ class TestUltrasoundImageAssembler(object):
                 assert (output == expected).all()
 
 
+class TestStreamingAssembly(object):
+        @pytest.fixture()
+        def assemblers(self, tmpdir, us_files):
+                def _assemblers(memmap_dir=None):
+                        mats_dir, pl_path = us_files
+                        output_dir = tmpdir.mkdir('recon')
+                        assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path,
+                                                                   overwrite_tif=True)
+                        streamer = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path,
+                                                                  overwrite_tif=True, streaming=True,
+                                                                  memmap_dir=memmap_dir)
+                        return assembler, streamer
+                
+                return _assemblers
+        
+        def test_streamed_image_matches_list_assembly(self, assemblers, monkeypatch):
+                assembler, streamer = assemblers()
+                assembler.pos_list = []
+                streamer.pos_list = []
+                saved = []
+                monkeypatch.setattr(recon.UltrasoundImageAssembler, '_save_us_image',
+                                    lambda self, name, bmode: saved.append(np.array(bmode)))
+                
+                assembler.assemble_bmode_image()
+                streamer.assemble_bmode_image()
+                
+                assert saved[1].dtype == np.float32
+                assert np.allclose(saved[0], saved[1], rtol=1E-6)
+        
+        def test_streamed_tiles_match_list_assembly(self, tmpdir, assemblers, monkeypatch):
+                assembler, streamer = assemblers(Path(tmpdir, 'memmap'))
+                stitched = []
+                monkeypatch.setattr(recon.UltrasoundImageAssembler, '_stitch_image',
+                                    lambda self, bmode: stitched.append(np.array(bmode)))
+                
+                assembler.assemble_bmode_image()
+                streamer.assemble_bmode_image()
+                
+                assert stitched[1].shape == (3, 3, 128, 128)
+                assert np.allclose(stitched[0], stitched[1], rtol=1E-6)
+                assert Path(tmpdir, 'memmap', 'fused_tp_0_ch_0_IQData.npy').is_file()
+
+
+class TestPositionGrid(object):
+        def test_positions_are_placed_by_rank(self):
+                grid = recon.PositionGrid(np.array([[200, 0], [0, 100], [100, 0], [0, 0], [200, 100], [100, 100]]))
+
+                assert grid.shape == (3, 2)
+                assert list(grid.lateral_index) == [2, 0, 1, 0, 2, 1]
+                assert list(grid.elevational_index) == [0, 1, 0, 0, 1, 1]
+                assert list(grid.stack_index(np.arange(6))) == [4, 1, 2, 0, 5, 3]
+
+        def test_separation_is_found_once(self):
+                grid = recon.PositionGrid(np.array([[0, 0], [1.5, 0], [3.0015, 0]]))
+
+                assert grid.separation(0) == pytest.approx(1.5)
+                assert grid.separation(1) is None
+
+        def test_irregular_separation_raises_when_requested(self):
+                grid = recon.PositionGrid(np.array([[0, 0], [1.5, 0], [2, 0]]))
+
+                assert grid.shape == (3, 1)
+                with pytest.raises(ValueError):
+                        grid.separation(0)
+
+        def test_frames_acquired_out_of_order_are_placed_on_the_grid(self, tmpdir, us_files, pos_file):
+                mats_dir, pl_path = us_files
+                order = [4, 0, 8, 2, 6, 1, 3, 7, 5]
+                positions = [[100*(idx // 3), 100*(idx % 3)] for idx in order]
+                pos_file(pl_path, positions, None)
+
+                output_dir = tmpdir.mkdir('recon')
+                stitched = []
+                for num_workers in [1, 3]:
+                        assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path,
+                                                                   overwrite_tif=True, streaming=True,
+                                                                   num_workers=num_workers)
+                        assembler._stitch_image = lambda bmode: stitched.append(np.array(bmode))
+                        assembler.assemble_bmode_image()
+
+                frames = [recon.iq_to_bmode(recon.read_variable(path, 'IQData'))
+                          for path in recon.get_sorted_list_mats(mats_dir)]
+                for mat_idx, grid_idx in enumerate(order):
+                        for tiles in stitched:
+                                assert np.allclose(tiles[grid_idx // 3, grid_idx % 3], frames[mat_idx], rtol=1E-6)
+
+
+class TestNativeFusion(object):
+        def test_tiles_fused_without_imagej(self, tmpdir, us_files, monkeypatch):
+                mats_dir, pl_path = us_files
+                output_dir = tmpdir.mkdir('recon')
+                assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path, overwrite_tif=True,
+                                                           dataset_args={'overlap_x_(%)': 10}, native_fusion=True)
+                tiles = []
+                monkeypatch.setattr(recon.st, 'fuse_tiles_to_tif',
+                                    lambda bmode, *args, **kwargs: tiles.append(np.array(bmode)))
+                assembler.assemble_bmode_image()
+                monkeypatch.undo()
+                
+                assembler.assemble_bmode_image()
+                output = tif.imread(str(Path(output_dir, 'fused_tp_0_ch_0.tif')))
+                
+                assert output.shape == (3, 128, 358)
+                assert np.allclose(output, st.fuse_tiles_along_x(tiles[0], 10))
+
+
+        def test_tiles_fused_into_pyramid(self, tmpdir, us_files):
+                mats_dir, pl_path = us_files
+                output_dir = tmpdir.mkdir('recon')
+                assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path, overwrite_tif=True,
+                                                           dataset_args={'overlap_x_(%)': 10}, native_fusion=True,
+                                                           output_name='fused.ome.tif', pyramid_levels=2)
+                assembler.assemble_bmode_image()
+                output_path = Path(output_dir, 'fused.ome.tif')
+
+                assert ome.get_pyramid_shapes(output_path) == [(3, 128, 358), (3, 64, 179)]
+                assert ome.get_spacing(output_path) == assembler._get_spacing()
+                assert ome.read_pyramid_region(output_path, 0, np.s_[1:2, :, 200:]).shape == (1, 128, 158)
+
+
+class TestIncrementalAssembly(object):
+        def test_output_grows_as_slices_complete(self, tmpdir, us_files):
+                mats_dir, pl_path = us_files
+                mat_list = recon.get_sorted_list_mats(mats_dir)
+                arriving_dir = tmpdir.mkdir('arriving')
+                for mat_path in mat_list[:7]:
+                        shutil.copy(str(mat_path), str(arriving_dir))
+
+                output_dir = tmpdir.mkdir('incremental')
+                assembler = recon.UltrasoundImageAssembler(arriving_dir, output_dir, None, pl_path,
+                                                           dataset_args={'overlap_x_(%)': 10}, native_fusion=True)
+                output_path = Path(output_dir, 'fused_tp_0_ch_0.tif')
+
+                assert assembler.update_bmode_image() == 7
+                assert tif.imread(str(output_path)).shape == (128, 358)
+                assert assembler.update_bmode_image() == 0
+
+                for mat_path in mat_list[7:]:
+                        shutil.copy(str(mat_path), str(arriving_dir))
+                assert assembler.watch_bmode_image(poll_interval=0)
+
+                full_dir = tmpdir.mkdir('full')
+                full = recon.UltrasoundImageAssembler(mats_dir, full_dir, None, pl_path, overwrite_tif=True,
+                                                      dataset_args={'overlap_x_(%)': 10}, native_fusion=True)
+                full.assemble_bmode_image()
+                expected = tif.imread(str(Path(full_dir, 'fused_tp_0_ch_0.tif')))
+
+                assert np.allclose(tif.imread(str(output_path)), expected)
+
+        def test_changed_file_is_converted_again(self, tmpdir, us_files):
+                mats_dir, pl_path = us_files
+                output_dir = tmpdir.mkdir('incremental')
+                assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path,
+                                                           dataset_args={'overlap_x_(%)': 10}, native_fusion=True)
+                assert assembler.update_bmode_image() == 9
+
+                mat_path = recon.get_sorted_list_mats(mats_dir)[4]
+                params = util.load_mat(mat_path, 'P')['P']
+                sio.savemat(str(mat_path), {'IQData': np.ones([128, 128], dtype=complex), 'P': params})
+
+                assert assembler.update_bmode_image() == 1
+                volume = np.load(str(Path(output_dir, 'fused_tp_0_ch_0_partial.npy')))
+                assert np.allclose(volume[4], 20*np.log10(2))
+
+        def test_file_written_while_converting_is_converted_again(self, tmpdir, us_files, monkeypatch):
+                mats_dir, pl_path = us_files
+                growing_path = Path(recon.get_sorted_list_mats(mats_dir)[4])
+                read_converted_variable = recon.read_converted_variable
+                finished = []
+                
+                def read_then_finish_writing(file_path, *args, **kwargs):
+                        frame = read_converted_variable(file_path, *args, **kwargs)
+                        if Path(file_path).name == growing_path.name and not finished:
+                                params = util.load_mat(growing_path, 'P')['P']
+                                sio.savemat(str(growing_path), {'IQData': np.ones([128, 128], dtype=complex),
+                                                                'P': params})
+                                finished.append(True)
+                        return frame
+                
+                monkeypatch.setattr(recon, 'read_converted_variable', read_then_finish_writing)
+                output_dir = tmpdir.mkdir('incremental')
+                assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path,
+                                                           dataset_args={'overlap_x_(%)': 10}, native_fusion=True)
+                
+                assert assembler.update_bmode_image() == 9
+                assert assembler.update_bmode_image() == 1
+                volume = np.load(str(Path(output_dir, 'fused_tp_0_ch_0_partial.npy')))
+                assert np.allclose(volume[4], 20*np.log10(2))
+
+
+class TestReadMatList(object):
+        @pytest.mark.parametrize('num_workers', [1, 3])
+        def test_frames_are_read_in_list_order(self, us_files, num_workers):
+                mat_list = recon.get_sorted_list_mats(us_files[0])
+                expected = np.array([recon.read_variable(path, 'IQData') for path in mat_list])
+                
+                output, timings = recon.read_mat_list(mat_list, partial(recon.read_variable, variable='IQData'),
+                                                      num_workers=num_workers)
+                
+                assert (output == expected).all()
+                assert len(timings) == len(mat_list)
+        
+        def test_pool_writes_to_memmap(self, tmpdir, us_files):
+                mat_list = recon.get_sorted_list_mats(us_files[0])
+                output_path = Path(tmpdir, 'bmode.npy')
+                read_frame = partial(recon.read_converted_variable, variable='IQData',
+                                     convert_frame=recon.iq_to_bmode, select_2d=True)
+                
+                recon.read_mat_list(mat_list, read_frame, num_workers=2, output_path=output_path, dtype=np.float32)
+                expected = np.array([recon.iq_to_bmode(recon.frame_to_2d(recon.read_variable(path, 'IQData')))
+                                     for path in mat_list])
+                
+                output = np.load(str(output_path))
+                assert output.dtype == np.float32
+                assert np.allclose(output, expected)
+
+
+class TestAcquisitionCache(object):
+        @pytest.fixture()
+        def mat_list(self, us_files):
+                return recon.get_sorted_list_mats(us_files[0])
+        
+        @pytest.mark.parametrize('compression, frame_type', [('lzf', h5py.Dataset), (None, np.memmap)])
+        def test_frames_match_mat_files(self, tmpdir, mat_list, compression, frame_type):
+                expected = np.array([recon.read_variable(path, 'IQData') for path in mat_list])
+                with cache.AcquisitionCache(mat_list, Path(tmpdir, 'cache.h5'), compression=compression) as acq:
+                        frames = acq.get_frames('IQData')
+                        assert isinstance(frames, frame_type)
+                        assert (frames[:] == expected).all()
+        
+        def test_singleton_axes_match_uncached_readers(self, tmpdir, mat_list):
+                for mat_path in mat_list:
+                        frame = recon.open_iq(mat_path)
+                        sio.savemat(str(mat_path), {'IQData': frame[:, :, None, None],
+                                                    'P': recon.read_variable(mat_path, 'P')})
+                
+                with cache.AcquisitionCache(mat_list, Path(tmpdir, 'cache.h5')) as acq:
+                        cached, _ = recon.mat_list_to_iq_array(mat_list, acquisition_cache=acq)
+                        uncached, _ = recon.mat_list_to_iq_array(mat_list)
+                        assert cached.shape == uncached.shape
+                        assert (cached == uncached).all()
+                        
+                        frames = acq.get_frames('IQData')
+                        for idx, mat_path in enumerate(mat_list):
+                                expected = recon.read_variable(mat_path, 'IQData')
+                                assert (recon.read_squeezed_frame(frames, idx) == expected).all()
+                                assert recon.read_squeezed_frame(frames, idx).shape == expected.shape
+        
+        def test_parameters_and_positions_match_sources(self, tmpdir, us_files, mat_list):
+                mats_dir, pl_path = us_files
+                with cache.AcquisitionCache(mat_list, Path(tmpdir, 'cache.h5'), pl_path) as acq:
+                        assert recon.clean_parameters(acq.get_parameters()) == recon.read_parameters(mat_list[0])
+                        assert acq.get_positions() == util.read_json(pl_path)
+        
+        def test_changed_source_invalidates_cache(self, tmpdir, mat_list):
+                acq = cache.AcquisitionCache(mat_list, Path(tmpdir, 'cache.h5'))
+                acq.get_frames('IQData')
+                acq.close()
+                assert acq.is_valid()
+                
+                new_frame = np.ones([128, 128], dtype=complex)
+                sio.savemat(str(mat_list[0]), {'IQData': new_frame, 'P': recon.read_variable(mat_list[0], 'P')})
+                assert not acq.is_valid()
+                
+                with cache.AcquisitionCache(mat_list, Path(tmpdir, 'cache.h5')) as rebuilt:
+                        assert (rebuilt.get_frames('IQData')[0] == new_frame).all()
+        
+        def test_cached_assembly_matches_mat_assembly(self, tmpdir, us_files, monkeypatch):
+                mats_dir, pl_path = us_files
+                output_dir = tmpdir.mkdir('recon')
+                assembler = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path, overwrite_tif=True)
+                cached = recon.UltrasoundImageAssembler(mats_dir, output_dir, None, pl_path, overwrite_tif=True,
+                                                        cache_dir=Path(tmpdir, 'cache'))
+                assert cached.params == assembler.params
+                assert (cached.pos_list == assembler.pos_list).all()
+                
+                stitched = []
+                monkeypatch.setattr(recon.UltrasoundImageAssembler, '_stitch_image',
+                                    lambda self, bmode: stitched.append(np.array(bmode)))
+                assembler.assemble_bmode_image()
+                cached.assemble_bmode_image()
+                
+                assert np.allclose(stitched[0], stitched[1])
+
+
+class TestReadMetadata(object):
+        def test_parameters_match_full_read(self, us_files):
+                mat_path = recon.get_sorted_list_mats(us_files[0])[0]
+                expected = recon.clean_parameters(util.load_mat(mat_path)['P'])
+                assert recon.read_parameters(mat_path) == expected
+                assert recon.read_variable_info(mat_path, 'IQData') == ((128, 128), 'double')
+        
+        def test_file_is_read_once(self, us_files, monkeypatch):
+                mat_path = recon.get_sorted_list_mats(us_files[0])[0]
+                recon.read_parameters(mat_path)
+                monkeypatch.setattr(recon, 'read_variable', lambda x, y: pytest.fail('P was read twice'))
+                
+                recon.read_parameters(mat_path)
+                recon.open_parameters(mat_path)
+        
+        def test_rewritten_file_is_read_again(self, us_files):
+                mat_path = recon.get_sorted_list_mats(us_files[0])[0]
+                params_raw = recon.read_raw_parameters(mat_path)
+                params_raw['startDepth'] = 10
+                sio.savemat(str(mat_path), {'IQData': np.ones([64, 64], dtype=complex), 'P': params_raw})
+                
+                assert recon.read_raw_parameters(mat_path)['startDepth'] == 10
+                assert recon.read_variable_info(mat_path, 'IQData')[0] == (64, 64)
+
+
+class TestRead2dVariable(object):
+        @pytest.fixture()
+        def iq_frame(self):
+                return np.random.rand(6, 5, 3) + 1j*np.random.rand(6, 5, 3)
+        
+        def test_v5_mat_selects_middle_angle(self, tmpdir, iq_frame):
+                mat_path = Path(tmpdir, 'Image_It-1.mat')
+                sio.savemat(str(mat_path), {'IQData': iq_frame})
+                output = recon.read_2d_variable(mat_path, 'IQData')
+                assert (output == iq_frame[:, :, 1]).all()
+        
+        def test_hdf5_mat_selects_middle_angle(self, tmpdir, iq_frame):
+                mat_path = Path(tmpdir, 'Image_It-1.mat')
+                compound = np.dtype([('real', np.float64), ('imag', np.float64)])
+                stored = np.empty(iq_frame.T.shape, dtype=compound)
+                stored['real'] = iq_frame.T.real
+                stored['imag'] = iq_frame.T.imag
+                with h5py.File(str(mat_path), 'w') as file:
+                        file['IQData'] = stored
+                
+                output = recon.read_2d_variable(mat_path, 'IQData')
+                assert (output == iq_frame[:, :, 1]).all()
+
+
 class TestGetOrigin(object):
         def test_get_origin(self, us_files):
                 mats_dir, pl_path = us_files
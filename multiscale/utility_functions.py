@@ -12,6 +12,9 @@ import scipy.io as sio
 import numpy as np
 import math
 import h5py
+import uuid
+import importlib
+from contextlib import contextmanager
 
 def write_json(dictionary: dict, path_dict: Path):
         with open(str(path_dict), 'w') as file:
@@ -24,6 +27,54 @@ def read_json(path_dict: Path):
                 return dictionary
 
 
+@contextmanager
+def atomic_write(path_output: Path):
+        """
+        Yield a temporary path next to path_output, and move it onto path_output only once writing succeeds.
+        
+        Readers never see a partially written file, and an interrupted write leaves the original file untouched.
+        :param path_output: Final path of the file
+        :return: Temporary path to write to.  It keeps the suffix of path_output so writers pick the same format
+        """
+        path_output = Path(path_output)
+        path_temp = Path(path_output.parent, '.tmp-{}-{}{}'.format(path_output.stem, uuid.uuid4().hex,
+                                                                    path_output.suffix))
+        try:
+                yield path_temp
+                os.replace(str(path_temp), str(path_output))
+        finally:
+                if path_temp.exists():
+                        os.remove(str(path_temp))
+
+
+class LazyModule(object):
+        def __init__(self, module_name: str, on_import=None):
+                """
+                Stand-in for a module that is only imported when one of its attributes is first used.
+                
+                Keeps plotting and JVM-backed dependencies out of the import of modules that rarely need them.
+                :param module_name: Full name of the module to import
+                :param on_import: Function called with the module once it is imported, e.g. to set up a backend
+                """
+                self._module_name = module_name
+                self._on_import = on_import
+                self._module = None
+
+        def __getattr__(self, name):
+                if self._module is None:
+                        module = importlib.import_module(self._module_name)
+                        if self._on_import is not None:
+                                self._on_import(module)
+                        self._module = module
+
+                return getattr(self._module, name)
+
+
+def lazy_import(module_name: str, on_import=None) -> LazyModule:
+        """Import a module on first use.  See LazyModule"""
+        return LazyModule(module_name, on_import)
+
+
 def move_files_to_new_folder(list_files: list, dir_new: Path):
         os.makedirs(dir_new, exist_ok=True)
         for file in list_files:
@@ -186,7 +237,7 @@ def load_mat(file_path, variables=None):
                                 elem_list.append(sub_elem)
                 return elem_list
 
-        def read_hdf_matlab(filename):
+        def read_hdf_matlab(filename, root=''):
                 def conv(path=''):
                         p = path or '/'
                         paths[p] = ret = {}
@@ -205,21 +256,150 @@ def load_mat(file_path, variables=None):
         
                 paths = {}
                 with h5py.File(filename, 'r') as f:
-                        return conv()
+                        return conv(root)
 
-        try:
+        if h5py.is_hdf5(file_name):
                 if variables is None:
-                        data = sio.loadmat(file_name, struct_as_record=False, squeeze_me=True)
-                else:
-                        data = sio.loadmat(file_name, struct_as_record=False, squeeze_me=True, variable_names=variables)
-                return _check_keys(data)
-        except NotImplementedError:
-                data = read_hdf_matlab(file_name)
-                if variables is None:
-                        return data
-                else:
-                        return data[variables]
-                        
+                        return read_hdf_matlab(file_name)
+                
+                try:
+                        with MatlabHDF5Array(file_name, variables) as array:
+                                return {variables: array[()]}
+                except NotImplementedError:
+                        return {variables: read_hdf_matlab(file_name, '/' + variables)}
+
+        if variables is None:
+                data = sio.loadmat(file_name, struct_as_record=False, squeeze_me=True)
+        else:
+                data = sio.loadmat(file_name, struct_as_record=False, squeeze_me=True, variable_names=variables)
+        return _check_keys(data)
+
+
+def whos_mat(file_path) -> dict:
+        """
+        List the variables of a .mat file without reading their data
+        :param file_path: Path to the .mat file
+        :return: Dictionary of variable name to (shape, MATLAB class), with the shape in MATLAB axis order
+        """
+        file_name = str(file_path)
+        if not h5py.is_hdf5(file_name):
+                return {name: (tuple(shape), mat_class) for name, shape, mat_class in sio.whosmat(file_name)}
+
+        variables = {}
+        with h5py.File(file_name, 'r') as file:
+                for name, item in file.items():
+                        if name.startswith('#'):
+                                continue
+                        mat_class = item.attrs.get('MATLAB_class', b'')
+                        if isinstance(mat_class, bytes):
+                                mat_class = mat_class.decode()
+                        if isinstance(item, h5py.Group):
+                                variables[name] = ((1, 1), mat_class)
+                        else:
+                                variables[name] = (tuple(reversed(item.shape)), mat_class)
+
+        return variables
+
+
+class MatlabHDF5Array(object):
+        def __init__(self, file_path, variable: str):
+                """
+                Lazily indexable array for one numeric variable of a MATLAB v7.3 (HDF5) .mat file.
+                
+                Indexing reads only the requested hyperslab from disk.  The array is presented in MATLAB axis order, as
+                scipy.io.loadmat returns it, and MATLAB complex data is viewed as a numpy complex array without copying.
+                :param file_path: Path to the .mat file
+                :param variable: Name of the variable to open
+                """
+                self._file = h5py.File(str(file_path), 'r')
+                try:
+                        dataset = self._file[variable]
+                except KeyError:
+                        self.close()
+                        raise KeyError('{} is not in {}'.format(variable, file_path))
+                
+                if not isinstance(dataset, h5py.Dataset) or dataset.dtype.kind not in 'biufcV':
+                        self.close()
+                        raise NotImplementedError('{} is not a numeric array'.format(variable))
+                
+                self._dataset = dataset
+                self._complex_dtype = _matlab_complex_dtype(dataset.dtype)
+                if dataset.dtype.kind == 'V' and self._complex_dtype is None:
+                        self.close()
+                        raise NotImplementedError('{} is not a numeric array'.format(variable))
+        
+        @property
+        def shape(self) -> tuple:
+                return tuple(reversed(self._dataset.shape))
+        
+        @property
+        def ndim(self) -> int:
+                return len(self._dataset.shape)
+        
+        @property
+        def dtype(self):
+                if self._complex_dtype is not None:
+                        return self._complex_dtype
+                return self._dataset.dtype
+        
+        def __len__(self):
+                return self.shape[0]
+        
+        def __getitem__(self, key):
+                if not isinstance(key, tuple):
+                        key = (key,)
+                
+                if Ellipsis in key:
+                        idx = key.index(Ellipsis)
+                        key = key[:idx] + (slice(None),)*(self.ndim - len(key) + 1) + key[idx + 1:]
+                key = key + (slice(None),)*(self.ndim - len(key))
+                
+                data = self._dataset[tuple(reversed(key))]
+                if self._complex_dtype is not None:
+                        data = _matlab_compound_to_complex(np.asarray(data), self._complex_dtype)
+                
+                return np.transpose(data)
+        
+        def __array__(self, dtype=None, copy=None):
+                data = self[()]
+                if dtype is not None:
+                        return data.astype(dtype)
+                return data
+        
+        def close(self):
+                self._file.close()
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_val, exc_tb):
+                self.close()
+
+
+def _matlab_complex_dtype(dtype):
+        """Get the numpy complex type matching a MATLAB complex compound type, or None if it is not complex"""
+        if dtype.names != ('real', 'imag'):
+                return None
+        
+        real = dtype.fields['real']
+        imag = dtype.fields['imag']
+        if real[0] != imag[0] or real[1] != 0 or imag[1] != real[0].itemsize or dtype.itemsize != 2*real[0].itemsize:
+                return None
+        
+        return np.result_type(real[0], np.complex64)
+
+
+def _matlab_compound_to_complex(data: np.ndarray, complex_dtype) -> np.ndarray:
+        """View a real/imag compound array as complex without copying when the layouts match, e.g. float64 pairs as
+        complex128, and otherwise cast it, e.g. int16 pairs to complex64"""
+        real_dtype = data.dtype.fields['real'][0]
+        if real_dtype.kind == 'f' and data.dtype.itemsize == complex_dtype.itemsize:
+                return data.view(complex_dtype)
+        
+        output = np.empty(data.shape, dtype=complex_dtype)
+        output.real = data['real']
+        output.imag = data['imag']
+        return output
 
 
 def list_values_approx_equal(num_list, rel_tol):